@@ -3,6 +3,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
 import os
+import logging
 from dotenv import load_dotenv
 
 # Load environment variables from .env file if it exists
@@ -23,15 +24,36 @@ app.config['WTF_CSRF_ENABLED'] = True  # CSRF protection is essential for securi
 from app.csrf_config import configure_csrf
 csrf = configure_csrf(app)
 
+# Select engine settings (SQLite PRAGMAs or PostgreSQL pooling) before the engine is created
+from app.db_config import configure_database
+configure_database(app)
+
+# Optional read replica (REPLICA_DATABASE_URL) for read-only endpoints
+from app.db_routing import configure_replica, register_write_tracking, RoutingSession
+configure_replica(app)
+
 # initialize the database and migration
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+register_write_tracking(db)
 migrate = Migrate(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 
 # import models
-from app.models import user, travel_plan, memory
+from app.models import user, destination, travel_plan, memory, stat_digest, fragment_revision
+
+# Track data revisions used as fragment cache keys
+from app import fragment_cache
+
+# Keep the full-text search and spatial indexes in sync with plans and memories
+from app import search, spatial
+
+# Invalidate cached map cluster hierarchies when points change
+from app import clustering
+
+# Log itinerary item changes per plan for delta sync, and push them to open plan pages
+from app import itinerary_sync, plan_events
 
 def create_app():
     
@@ -48,15 +70,29 @@ def create_app():
     from app.routes.memories import memories_bp
     from app.routes.main import main_bp
     from app.routes.statistics import statistics_bp
+    from app.routes.maps import maps_bp
+    from app.routes.exports import exports_bp
     
     app.register_blueprint(auth_bp)
     app.register_blueprint(planner_bp)
     app.register_blueprint(memories_bp)
     app.register_blueprint(main_bp)
     app.register_blueprint(statistics_bp)
+    app.register_blueprint(maps_bp)
+    app.register_blueprint(exports_bp)
+    
+    # Register maintenance commands
+    from app.commands import register_commands
+    register_commands(app, db)
     
     # Create database tables
     with app.app_context():
         db.create_all()
+        
+        # Report the effective database settings
+        from app.db_config import log_database_settings
+        if app.logger.level == logging.NOTSET:
+            app.logger.setLevel(logging.INFO)
+        log_database_settings(app, db.engine)
     
     return app
@@ -0,0 +1,324 @@
+"""Point Clustering Module
+
+Serves zoomed-out travel maps with a few hundred clusters instead of every
+memory, itinerary item or trip destination of a user:
+
+1. Points are projected to Web Mercator and binned into square grid cells of
+   ``CELL_SIZE`` screen pixels. At zoom ``z`` the world is
+   ``GRID_BASE << z`` cells wide, so the four cells of zoom ``z + 1`` inside a
+   cell of zoom ``z`` are its children and every level is built from the one
+   below it, from ``MAX_CLUSTER_ZOOM`` up to zoom 0
+2. Each cluster has a count (per layer too), a centroid, up to
+   ``MAX_REPRESENTATIVES`` representative ids (the lowest ids it contains)
+   and the zoom at which it splits, for click-to-zoom
+3. The hierarchy of a user is built on first use and kept in process memory,
+   keyed by the revision of the user's points. Every write that moves, adds
+   or removes a user's points, or changes which shared plans they can see,
+   bumps that revision in the same transaction (see the session hooks at the
+   bottom of this module). Code that writes with Core statements calls
+   ``invalidate`` itself, before committing
+
+Revisions are stored with the fragment cache's (``('user_points', user_id)``
+keys of the ``fragment_revision`` table), so a write made through one worker
+process invalidates the hierarchies cached by all of them.
+"""
+import heapq
+import threading
+from collections import OrderedDict
+from math import log, pi, radians, tan
+
+from sqlalchemy import event, inspect, or_, select
+
+from app import app, db, fragment_cache
+
+TILE_SIZE = 256
+CELL_SIZE = 64  # pixels
+GRID_BASE = TILE_SIZE // CELL_SIZE
+MAX_CLUSTER_ZOOM = 16  # Views zoomed in further get the clusters of this level
+MAX_REPRESENTATIVES = 5
+MAX_MERCATOR_LAT = 85.05112878
+DEFAULT_MAX_HIERARCHIES = 64
+
+_hierarchies = OrderedDict()  # (user_id, layers) -> (revision, hierarchy)
+_lock = threading.Lock()
+
+
+def project(lat, lng):
+    """Web Mercator (x, y) in [0, 1], y growing southwards"""
+    lat = min(max(lat, -MAX_MERCATOR_LAT), MAX_MERCATOR_LAT)
+    x = (lng + 180) / 360
+    y = 0.5 - log(tan(pi / 4 + radians(lat) / 2)) / (2 * pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def _cell(x, y, cells_per_side):
+    return min(int(x * cells_per_side), cells_per_side - 1), min(int(y * cells_per_side), cells_per_side - 1)
+
+
+class Cluster:
+    """Points sharing a grid cell"""
+
+    __slots__ = ('count', 'lat_sum', 'lng_sum', 'counts', 'representatives', 'expansion_zoom')
+
+    def __init__(self, count, lat_sum, lng_sum, counts, representatives, expansion_zoom=None):
+        self.count = count
+        self.lat_sum = lat_sum
+        self.lng_sum = lng_sum
+        self.counts = counts
+        self.representatives = representatives
+        self.expansion_zoom = expansion_zoom
+
+    @classmethod
+    def combine(cls, children, expansion_zoom):
+        counts = {}
+        for child in children:
+            for point_type, count in child.counts.items():
+                counts[point_type] = counts.get(point_type, 0) + count
+        return cls(
+            sum(child.count for child in children),
+            sum(child.lat_sum for child in children),
+            sum(child.lng_sum for child in children),
+            counts,
+            heapq.nsmallest(MAX_REPRESENTATIVES, (ref for child in children for ref in child.representatives)),
+            expansion_zoom,
+        )
+
+    @property
+    def lat(self):
+        return self.lat_sum / self.count
+
+    @property
+    def lng(self):
+        return self.lng_sum / self.count
+
+    def to_dict(self):
+        return {
+            'lat': self.lat,
+            'lng': self.lng,
+            'count': self.count,
+            'counts': dict(self.counts),
+            'ids': [{'type': point_type, 'id': row_id} for point_type, row_id in self.representatives],
+            'expansion_zoom': self.expansion_zoom,
+        }
+
+
+class ClusterHierarchy:
+    """Clusters of a set of points at every zoom level from 0 to MAX_CLUSTER_ZOOM
+
+    Args:
+        points: (type, id, lat, lng) tuples
+    """
+
+    def __init__(self, points):
+        side = GRID_BASE << MAX_CLUSTER_ZOOM
+        groups = {}
+        for point_type, row_id, lat, lng in points:
+            groups.setdefault(_cell(*project(lat, lng), side), []).append((point_type, row_id, lat, lng))
+
+        finest = {}
+        for key, group in groups.items():
+            counts = {}
+            for point_type, _, _, _ in group:
+                counts[point_type] = counts.get(point_type, 0) + 1
+            finest[key] = Cluster(
+                len(group), sum(lat for _, _, lat, _ in group), sum(lng for _, _, _, lng in group),
+                counts, heapq.nsmallest(MAX_REPRESENTATIVES, ((t, i) for t, i, _, _ in group)),
+            )
+
+        # A parent with one child is that child, so sparse areas cost one object for every level
+        self.levels = [None] * (MAX_CLUSTER_ZOOM + 1)
+        self.levels[MAX_CLUSTER_ZOOM] = finest
+        for zoom in range(MAX_CLUSTER_ZOOM - 1, -1, -1):
+            children = {}
+            for (x, y), cluster in self.levels[zoom + 1].items():
+                children.setdefault((x >> 1, y >> 1), []).append(cluster)
+            self.levels[zoom] = {
+                key: group[0] if len(group) == 1 else Cluster.combine(group, zoom + 1)
+                for key, group in children.items()
+            }
+
+    @property
+    def count(self):
+        return sum(cluster.count for cluster in self.levels[0].values())
+
+    def cells(self, zoom, x0, y0, x1, y1):
+        """(cell, cluster) pairs of ``zoom`` with x0 <= x <= x1 and y0 <= y <= y1"""
+        cells = self.levels[zoom]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(cells):
+            return [((x, y), cells[(x, y)]) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                    if (x, y) in cells]
+        return [((x, y), cluster) for (x, y), cluster in cells.items()
+                if x0 <= x <= x1 and y0 <= y <= y1]
+
+    def clusters(self, bbox, zoom):
+        """Clusters whose cell overlaps ``bbox`` at ``zoom``, largest first"""
+        zoom = min(max(int(zoom), 0), MAX_CLUSTER_ZOOM)
+        side = GRID_BASE << zoom
+
+        found = []
+        for west, south, east, north in bbox.parts():
+            x0, y0 = _cell(*project(north, west), side)
+            x1, y1 = _cell(*project(south, east), side)
+            found.extend(cluster for _, cluster in self.cells(zoom, x0, y0, x1, y1))
+        found.sort(key=lambda cluster: (-cluster.count, cluster.representatives))
+        return found
+
+
+def load_points(user_id, layers):
+    """(type, id, lat, lng) of a user's points in ``layers``"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem, PlanShare
+    from app.models.memory import Memory
+
+    points = []
+    if 'memories' in layers:
+        rows = db.session.execute(
+            select(Memory.id, Memory.lat, Memory.lng)
+            .where(Memory.user_id == user_id, Memory.lat.isnot(None), Memory.lng.isnot(None))
+        )
+        points.extend(('memory', row_id, lat, lng) for row_id, lat, lng in rows)
+    if 'items' in layers:
+        shared_plan_ids = select(PlanShare.travel_plan_id).where(
+            PlanShare.shared_user_id == user_id, PlanShare.status == 'accepted'
+        )
+        rows = db.session.execute(
+            select(ItineraryItem.id, ItineraryItem.lat, ItineraryItem.lng)
+            .join(TravelPlan, TravelPlan.id == ItineraryItem.travel_plan_id)
+            .where(or_(TravelPlan.user_id == user_id, TravelPlan.id.in_(shared_plan_ids)),
+                   ItineraryItem.lat.isnot(None), ItineraryItem.lng.isnot(None))
+        )
+        points.extend(('item', row_id, lat, lng) for row_id, lat, lng in rows)
+    if 'plans' in layers:
+        rows = db.session.execute(
+            select(TravelPlan.id, TravelPlan.dest_lat, TravelPlan.dest_lng, TravelPlan.centroid_lat,
+                   TravelPlan.centroid_lng, TravelPlan.geo_count)
+            .where(TravelPlan.user_id == user_id)
+        )
+        # Same fallback as TravelPlan.coordinates
+        for row_id, dest_lat, dest_lng, centroid_lat, centroid_lng, geo_count in rows:
+            if dest_lat and dest_lng:
+                points.append(('plan', row_id, dest_lat, dest_lng))
+            elif geo_count:
+                points.append(('plan', row_id, centroid_lat, centroid_lng))
+    return points
+
+
+def _revision_key(user_id):
+    return ('user_points', user_id)
+
+
+def revision(user_id):
+    """Current revision of a user's map points"""
+    return fragment_cache.revision(_revision_key(user_id))
+
+
+def invalidate(*user_ids, connection=None):
+    """Invalidate the cluster hierarchies of ``user_ids`` once the transaction commits
+
+    Args:
+        user_ids: Users whose points changed
+        connection: Connection of the transaction (default: the session's)
+    """
+    fragment_cache.bump(*(_revision_key(user_id) for user_id in user_ids), connection=connection)
+
+
+def clear():
+    """Drop all hierarchies cached by this process"""
+    with _lock:
+        _hierarchies.clear()
+
+
+def hierarchy_for(user_id, layers):
+    """The cluster hierarchy of a user's points in ``layers``, built if needed"""
+    layers = tuple(sorted(layers))
+    key = (user_id, layers)
+    current = revision(user_id)
+    with _lock:
+        entry = _hierarchies.get(key)
+        if entry and entry[0] == current:
+            _hierarchies.move_to_end(key)
+            return entry[1]
+
+    # Points read after the revision are at least as new as it; a write in between only
+    # makes the next call build again
+    hierarchy = ClusterHierarchy(load_points(user_id, layers))
+    with _lock:
+        _hierarchies[key] = (current, hierarchy)
+        _hierarchies.move_to_end(key)
+        max_entries = app.config.get('CLUSTER_CACHE_MAX_HIERARCHIES', DEFAULT_MAX_HIERARCHIES)
+        while len(_hierarchies) > max_entries:
+            _hierarchies.popitem(last=False)
+    return hierarchy
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+def _history_values(obj, attr):
+    """Current and previous values of an attribute inside a flush"""
+    history = inspect(obj).attrs[attr].history
+    values = set(history.added or ()) | set(history.deleted or ()) | set(history.unchanged or ())
+    values.add(getattr(obj, attr))
+    values.discard(None)
+    return values
+
+
+def plan_users(connection, plan_ids):
+    """Owners and accepted share recipients of plans"""
+    from app.models.travel_plan import TravelPlan, PlanShare
+
+    owners = connection.execute(select(TravelPlan.user_id).where(TravelPlan.id.in_(plan_ids))).scalars()
+    shared = connection.execute(
+        select(PlanShare.shared_user_id)
+        .where(PlanShare.travel_plan_id.in_(plan_ids), PlanShare.status == 'accepted')
+    ).scalars()
+    return set(owners) | set(shared)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_cascaded_cluster_users(session, flush_context, instances):
+    """Remember who sees the items of deleted plans, whose shares ON DELETE CASCADE removes"""
+    from app.models.travel_plan import TravelPlan
+
+    plan_ids = [obj.id for obj in session.deleted if isinstance(obj, TravelPlan)]
+    if plan_ids:
+        session.info.setdefault('cluster_users', set()).update(plan_users(session.connection(), plan_ids))
+
+
+@event.listens_for(db.session, 'after_flush')
+def invalidate_cluster_users(session, flush_context):
+    """Bump the revisions of the users whose map points were written in this flush"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem, PlanShare
+    from app.models.memory import Memory
+
+    user_ids, plan_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        dirty = obj in session.dirty
+        if isinstance(obj, Memory):
+            if not dirty or _changed(obj, 'lat', 'lng', 'user_id'):
+                user_ids.update(_history_values(obj, 'user_id'))
+        elif isinstance(obj, ItineraryItem):
+            if not dirty or _changed(obj, 'lat', 'lng', 'travel_plan_id'):
+                plan_ids.update(_history_values(obj, 'travel_plan_id'))
+        elif isinstance(obj, TravelPlan):
+            if not dirty or _changed(obj, 'user_id', 'dest_lat', 'dest_lng',
+                                     'centroid_lat', 'centroid_lng', 'geo_count'):
+                user_ids.update(_history_values(obj, 'user_id'))
+                if dirty and _changed(obj, 'user_id'):
+                    plan_ids.add(obj.id)
+        elif isinstance(obj, PlanShare):
+            if not dirty or _changed(obj, 'status', 'shared_user_id'):
+                user_ids.update(_history_values(obj, 'shared_user_id'))
+
+    if plan_ids:
+        user_ids.update(plan_users(session.connection(), plan_ids))
+    # Including the users collected before the flush
+    user_ids.update(session.info.pop('cluster_users', ()))
+    if user_ids:
+        invalidate(*user_ids, connection=session.connection())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_cluster_users(session):
+    session.info.pop('cluster_users', None)
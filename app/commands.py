@@ -0,0 +1,122 @@
+"""Command Line Interface Module
+
+Maintenance commands registered on the Flask CLI (``flask <command>``).
+"""
+import click
+
+
+def register_commands(app, db):
+    """Register the maintenance commands on the Flask application"""
+
+    @app.cli.command('replica-sync')
+    def replica_sync():
+        """Copy the SQLite primary database into the SQLite replica"""
+        from app.db_routing import REPLICA_BIND, sync_sqlite_replica
+
+        replica = db.engines.get(REPLICA_BIND)
+        if replica is None:
+            raise click.ClickException('REPLICA_DATABASE_URL is not set')
+        if db.engine.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+            raise click.ClickException('replica-sync only supports SQLite files; '
+                                       'use database replication for other engines')
+        sync_sqlite_replica(db.engine, replica)
+        click.echo(f'Copied {db.engine.url.database} to {replica.url.database}')
+
+    @app.cli.command('repair-plan-totals')
+    @click.option('--plan-id', 'plan_ids', type=int, multiple=True,
+                  help='Only recompute these plans (repeatable)')
+    def repair_plan_totals(plan_ids):
+        """Recompute the denormalized counters and geo summary of travel plans"""
+        from app.models.travel_plan import recompute_plan_totals, recompute_plan_geo
+
+        connection = db.session.connection()
+        updated = recompute_plan_totals(connection, plan_ids or None)
+        recompute_plan_geo(connection, plan_ids or None)
+        db.session.commit()
+        click.echo(f'Recomputed totals for {updated} travel plan(s)')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        """Rebuild the full-text search indexes of travel plans and memories"""
+        from app.search import create_search_tables, reindex_plans, reindex_memories, supported
+
+        connection = db.session.connection()
+        if not supported(connection.dialect.name):
+            raise click.ClickException('Full-text search needs SQLite or PostgreSQL')
+        create_search_tables(connection)
+        reindex_plans(connection)
+        reindex_memories(connection)
+        db.session.commit()
+        click.echo('Rebuilt the plan and memory search indexes')
+
+    @app.cli.command('rebuild-spatial-index')
+    def rebuild_spatial_index():
+        """Rebuild the spatial indexes of memory and itinerary item coordinates"""
+        from app.spatial import (create_spatial_tables, reindex_memory_points, reindex_item_points,
+                                 supported)
+
+        connection = db.session.connection()
+        if not supported(connection.dialect.name):
+            raise click.ClickException('Spatial indexes need SQLite or PostgreSQL')
+        create_spatial_tables(connection)
+        reindex_memory_points(connection)
+        reindex_item_points(connection)
+        db.session.commit()
+        click.echo('Rebuilt the memory and itinerary item spatial indexes')
+
+    @app.cli.command('prune-heatmap-tiles')
+    @click.option('--max-age-days', type=float, help='Remove tiles not served for this long (default: 30)')
+    @click.option('--max-mb', type=float, help='Then remove the oldest tiles above this size (default: 512)')
+    def prune_heatmap_tiles(max_age_days, max_mb):
+        """Remove stored heatmap tiles that were not served recently"""
+        from app.heatmap import prune_tiles, tile_dir
+
+        removed, size = prune_tiles(max_age_days, max_mb)
+        click.echo(f'Removed {removed} tile file(s); {size / (1024 * 1024):.1f} MB left in {tile_dir()}')
+
+    @app.cli.command('import-itinerary')
+    @click.argument('plan_id', type=int)
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format', type=click.Choice(['csv', 'json']),
+                  help='File format (default: from the file extension)')
+    @click.option('--skip-invalid', is_flag=True, help='Import the valid rows even if some rows have errors')
+    def import_itinerary(plan_id, path, file_format, skip_invalid):
+        """Bulk-add itinerary items to a travel plan from a CSV or JSON file"""
+        from app.itinerary_import import ImportFileError, detect_format, import_items
+        from app.models.travel_plan import TravelPlan
+
+        plan = db.session.get(TravelPlan, plan_id)
+        if plan is None:
+            raise click.ClickException(f'Travel plan {plan_id} does not exist')
+        try:
+            with open(path, 'rb') as stream:
+                result = import_items(plan, stream, detect_format(path, requested=file_format),
+                                      skip_invalid=skip_invalid)
+        except ImportFileError as e:
+            raise click.ClickException(str(e))
+
+        for error in result.errors:
+            click.echo(f'Row {error["row"]}: {"; ".join(error["errors"])}', err=True)
+        if result.error_count > len(result.errors):
+            click.echo(f'... and {result.error_count - len(result.errors)} more invalid row(s)', err=True)
+        if result.error_count and not result.imported:
+            raise click.ClickException(f'Nothing imported: {result.error_count} of {result.rows} row(s) are invalid')
+        click.echo(f'Imported {result.imported} of {result.rows} row(s) into "{plan.title}"')
+
+    @app.cli.command('export-account')
+    @click.argument('user_id', type=int)
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    def export_account(user_id, path):
+        """Write a ZIP backup of a user's plans, memories and photos"""
+        from app.exports import archive_chunks
+        from app.models.user import User
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            raise click.ClickException(f'User {user_id} does not exist')
+        size = 0
+        with open(path, 'wb') as output:
+            for chunk in archive_chunks(user.id):
+                output.write(chunk)
+                size += len(chunk)
+        click.echo(f'Exported the account of {user.username} to {path} ({size} bytes)')
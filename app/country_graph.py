@@ -0,0 +1,146 @@
+"""Country Adjacency Graph Module
+
+Nearby-country recommendations are answered from a country graph built once
+from the bundled ``app/data/country_borders.json`` dataset:
+
+- ``land`` lists the land borders of every country (ISO 3166-1 alpha-2)
+- ``sea`` adds short sea crossings so island nations (UK, Japan, New
+  Zealand...) still have neighbours
+
+A multi-source breadth-first search starts from every country a user has
+visited at once, so each country is reached at its smallest hop distance in a
+single O(V + E) pass. Results are ranked by hop count and then by how often
+the country is visited across all travel plans, and are cached per user until
+that user's set of visited countries changes.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from functools import lru_cache
+
+from app.destinations import DATA_DIR, country_code_for, country_name_for
+
+DEFAULT_MAX_HOPS = 2
+MAX_CACHED_USERS = 1024
+
+_cache = OrderedDict()  # user id -> (visited codes, max hops, ranked results)
+_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def load_country_graph():
+    """Load the adjacency dataset once and return code -> frozenset of neighbours"""
+    with open(os.path.join(DATA_DIR, 'country_borders.json'), encoding='utf-8') as f:
+        data = json.load(f)
+
+    graph = {}
+    for code, neighbours in data['land'].items():
+        for neighbour in neighbours:
+            graph.setdefault(code, set()).add(neighbour)
+            graph.setdefault(neighbour, set()).add(code)
+    for a, b in data['sea']:
+        graph.setdefault(a, set()).add(b)
+        graph.setdefault(b, set()).add(a)
+
+    return {code: frozenset(neighbours) for code, neighbours in graph.items()}
+
+
+def countries_within(visited_codes, max_hops=DEFAULT_MAX_HOPS):
+    """Multi-source BFS from all visited countries
+
+    Returns:
+        dict: country code -> hop distance (1..max_hops), excluding visited ones
+    """
+    graph = load_country_graph()
+    distances = {code: 0 for code in visited_codes if code in graph}
+    queue = deque(distances)
+
+    while queue:
+        code = queue.popleft()
+        hops = distances[code]
+        if hops >= max_hops:
+            continue
+        for neighbour in graph[code]:
+            if neighbour not in distances:
+                distances[neighbour] = hops + 1
+                queue.append(neighbour)
+
+    return {code: hops for code, hops in distances.items() if hops > 0}
+
+
+def country_visit_counts():
+    """Count travel plans per destination country across all users (one GROUP BY)"""
+    from sqlalchemy import func
+    from app import db
+    from app.models.travel_plan import TravelPlan
+    from app.models.destination import Destination
+
+    rows = db.session.query(
+        Destination.country_code, func.count(TravelPlan.id)
+    ).join(TravelPlan, TravelPlan.destination_id == Destination.id).filter(
+        Destination.country_code.isnot(None)
+    ).group_by(Destination.country_code).all()
+    return dict(rows)
+
+
+def rank_nearby_countries(visited_codes, max_hops=DEFAULT_MAX_HOPS, visit_counts=None):
+    """Rank countries near the visited ones by hop count, then popularity
+
+    Returns:
+        list of dicts with ``code``, ``name``, ``hops`` and ``visits``
+    """
+    distances = countries_within(visited_codes, max_hops)
+    if visit_counts is None:
+        visit_counts = country_visit_counts() if distances else {}
+
+    ranked = sorted(
+        distances.items(),
+        key=lambda pair: (pair[1], -visit_counts.get(pair[0], 0), country_name_for(pair[0]) or pair[0])
+    )
+    return [
+        {
+            'code': code,
+            'name': country_name_for(code) or code,
+            'hops': hops,
+            'visits': visit_counts.get(code, 0)
+        }
+        for code, hops in ranked
+    ]
+
+
+def nearby_countries_for_user(user_id, visited_countries, max_hops=DEFAULT_MAX_HOPS):
+    """Cached nearby-country ranking for one user
+
+    Args:
+        user_id: Cache key
+        visited_countries: Country names or aliases the user has visited
+        max_hops: How far from the visited countries to look
+
+    Returns:
+        list of ranked countries (see rank_nearby_countries)
+    """
+    visited_codes = frozenset(
+        code for code in (country_code_for(name) for name in visited_countries) if code
+    )
+
+    with _cache_lock:
+        cached = _cache.get(user_id)
+        if cached and cached[0] == visited_codes and cached[1] == max_hops:
+            _cache.move_to_end(user_id)
+            return cached[2]
+
+    ranked = rank_nearby_countries(visited_codes, max_hops)
+
+    with _cache_lock:
+        _cache[user_id] = (visited_codes, max_hops, ranked)
+        _cache.move_to_end(user_id)
+        while len(_cache) > MAX_CACHED_USERS:
+            _cache.popitem(last=False)
+    return ranked
+
+
+def clear_cache():
+    """Drop all cached rankings"""
+    with _cache_lock:
+        _cache.clear()
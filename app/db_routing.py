@@ -0,0 +1,105 @@
+"""Read Replica Routing Module
+
+Lets read-heavy endpoints (statistics, listings, itinerary data) read from a
+replica database while every write still goes to the primary:
+
+1. ``REPLICA_DATABASE_URL`` adds a ``replica`` entry to SQLALCHEMY_BINDS.
+   Without it everything stays on the primary
+2. ``RoutingSession.get_bind`` sends plain SELECTs to the replica only when
+   the session has been opted in (``db.session.info['use_replica']``, set by
+   the ``@read_replica`` decorator). Flushes, INSERT/UPDATE/DELETE and
+   ``session.connection()`` always use the primary
+3. Read-your-writes: when a request commits ORM changes, the time is stored
+   in the user's session cookie. For ``READ_YOUR_WRITES_SECONDS`` after that,
+   ``@read_replica`` endpoints keep reading from the primary so users see
+   their own edits even if the replica lags behind
+
+For local testing, point DATABASE_URL and REPLICA_DATABASE_URL at two SQLite
+files and copy the primary into the replica with ``flask replica-sync``.
+"""
+import os
+import sqlite3
+import time
+from functools import wraps
+
+from flask import has_request_context, session as cookie_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, event
+
+REPLICA_BIND = 'replica'
+DEFAULT_READ_YOUR_WRITES_SECONDS = 5
+LAST_WRITE_KEY = '_last_write_at'
+
+
+def configure_replica(app):
+    """Register the replica bind from REPLICA_DATABASE_URL, if set"""
+    replica_url = os.environ.get('REPLICA_DATABASE_URL')
+    if replica_url:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = replica_url
+        app.config['SQLALCHEMY_BINDS'] = binds
+    app.config.setdefault(
+        'READ_YOUR_WRITES_SECONDS',
+        float(os.environ.get('READ_YOUR_WRITES_SECONDS', DEFAULT_READ_YOUR_WRITES_SECONDS))
+    )
+
+
+class RoutingSession(Session):
+    """Session that reads from the replica when asked to"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('use_replica') and not self._flushing \
+                and isinstance(clause, Select):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def recently_wrote(app):
+    """Whether the current user committed changes within the read-your-writes window"""
+    if not has_request_context():
+        return False
+    last_write = cookie_session.get(LAST_WRITE_KEY)
+    return last_write is not None and \
+        time.time() - last_write < app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def read_replica(view):
+    """Serve a read-only view from the replica (outside the read-your-writes window)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from app import app, db
+
+        db.session.info['use_replica'] = not recently_wrote(app)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            db.session.info.pop('use_replica', None)
+    return wrapper
+
+
+def register_write_tracking(db):
+    """Record the commit time of ORM changes in the user's session cookie"""
+
+    @event.listens_for(db.session, 'after_flush')
+    def remember_write(session, flush_context):
+        session.info['wrote'] = True
+
+    @event.listens_for(db.session, 'after_commit')
+    def stamp_last_write(session):
+        if session.info.pop('wrote', False) and has_request_context():
+            cookie_session[LAST_WRITE_KEY] = time.time()
+
+    @event.listens_for(db.session, 'after_rollback')
+    def forget_write(session):
+        session.info.pop('wrote', None)
+
+
+def sync_sqlite_replica(primary_engine, replica_engine):
+    """Copy a SQLite primary into a SQLite replica file (local testing)"""
+    primary_path = primary_engine.url.database
+    replica_path = replica_engine.url.database
+    replica_engine.dispose()
+    with sqlite3.connect(primary_path) as source, sqlite3.connect(replica_path) as target:
+        source.backup(target)
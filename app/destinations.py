@@ -0,0 +1,184 @@
+"""Destination Normalization Module
+
+Travel plans store the destination exactly as the user typed it ("Paris",
+"Paris, France", "paris,france"...). To make statistics group these together,
+each plan is linked to a normalized ``Destination`` row when it is written:
+
+1. The free text is split on commas; the last part is matched against the
+   bundled country list (``app/data/countries.json``) including aliases such
+   as "USA" or "England"
+2. If the destination is just a city, it is looked up in a small bundled
+   gazetteer (``app/data/cities.json``) and then among destinations that
+   already exist in the database. A city qualified by something that is not
+   a country ("Paris, Texas", "London, Ontario") is never matched to a
+   country; the whole qualified name is kept so it stays a place of its own
+3. The resulting (city, country code) pair is the unique key of the
+   ``Destination`` row, which is created on first use
+
+Statistics can then group and join on ``travel_plan.destination_id`` instead
+of re-parsing destination strings on every request.
+"""
+import json
+import os
+import string
+from collections import namedtuple
+from functools import lru_cache
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+ParsedDestination = namedtuple(
+    'ParsedDestination',
+    ['key', 'name', 'city', 'country', 'country_code', 'lat', 'lng']
+)
+
+
+def _clean(text):
+    """Collapse whitespace and strip stray punctuation"""
+    return ' '.join((text or '').split()).strip(' ,.')
+
+
+@lru_cache(maxsize=1)
+def load_countries():
+    """Load the bundled country list once
+
+    Returns:
+        tuple: (code -> country name, lower-cased name or alias -> code)
+    """
+    with open(os.path.join(DATA_DIR, 'countries.json'), encoding='utf-8') as f:
+        data = json.load(f)
+
+    names = {}
+    aliases = {}
+    for code, info in data.items():
+        names[code] = info['name']
+        aliases[info['name'].lower()] = code
+        for alias in info.get('aliases', []):
+            aliases[alias.lower()] = code
+    return names, aliases
+
+
+@lru_cache(maxsize=1)
+def load_cities():
+    """Load the bundled city gazetteer once (lower-cased name -> [code, lat, lng])"""
+    with open(os.path.join(DATA_DIR, 'cities.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def country_code_for(name):
+    """Return the ISO 3166-1 alpha-2 code for a country name or alias"""
+    if not name:
+        return None
+    _, aliases = load_countries()
+    return aliases.get(_clean(name).lower())
+
+
+def country_name_for(code):
+    """Return the canonical country name for an ISO code"""
+    names, _ = load_countries()
+    return names.get(code)
+
+
+def make_key(city, country_code):
+    """Unique key of a normalized destination"""
+    return f"{(city or '').lower()}|{country_code or ''}"
+
+
+def parse_destination(text):
+    """Parse free text into a normalized destination without touching the database
+
+    Returns:
+        ParsedDestination or None if the text is empty
+    """
+    parts = [_clean(part) for part in (text or '').split(',')]
+    parts = [part for part in parts if part]
+    if not parts:
+        return None
+
+    city = parts[0]
+    if city.islower():
+        city = string.capwords(city)
+    country_code = country_code_for(parts[-1])
+    if country_code and len(parts) == 1:
+        # The whole destination is a country ("Japan")
+        city = None
+    # A region or state instead of a country ("Paris, Texas"): keep it, and do
+    # not guess the country from the gazetteer
+    region = ', '.join(parts[1:]) if country_code is None and len(parts) > 1 else None
+    if region and region.islower():
+        region = string.capwords(region)
+
+    lat = lng = None
+    if city and region is None:
+        entry = load_cities().get(city.lower())
+        if entry:
+            if country_code is None:
+                country_code = entry[0]
+            if entry[0] == country_code:
+                lat, lng = entry[1], entry[2]
+
+    country = country_name_for(country_code) if country_code else None
+    name = ', '.join(part for part in (city, region or country) if part)
+    return ParsedDestination(
+        key=make_key(name if region else city, country_code),
+        name=name,
+        city=city,
+        country=country,
+        country_code=country_code,
+        lat=lat,
+        lng=lng
+    )
+
+
+def resolve_destination(session, text, lat=None, lng=None):
+    """Find or create the Destination row for a free text destination
+
+    Args:
+        session: SQLAlchemy session to query and add to
+        text: Destination as typed by the user
+        lat, lng: Optional coordinates to store if the destination has none
+
+    Returns:
+        Destination or None if the text is empty
+    """
+    from app.models.destination import Destination
+
+    parsed = parse_destination(text)
+    if parsed is None:
+        return None
+
+    with session.no_autoflush:
+        if parsed.country_code is None and parsed.city and parsed.name == parsed.city:
+            # "Paris" on its own: reuse an existing destination with that city
+            # name if it is unambiguous
+            matches = session.query(Destination).filter(
+                Destination.city_key == parsed.city.lower(),
+                Destination.country_code.isnot(None)
+            ).limit(2).all()
+            if len(matches) == 1:
+                return matches[0]
+
+        destination = session.query(Destination).filter_by(key=parsed.key).first()
+        if destination is None:
+            # The row may have been added earlier in this flush
+            for pending in session.new:
+                if isinstance(pending, Destination) and pending.key == parsed.key:
+                    destination = pending
+                    break
+
+    if destination is None:
+        destination = Destination(
+            key=parsed.key,
+            name=parsed.name,
+            city=parsed.city,
+            city_key=parsed.city.lower() if parsed.city else None,
+            country=parsed.country,
+            country_code=parsed.country_code,
+            lat=parsed.lat if parsed.lat is not None else lat,
+            lng=parsed.lng if parsed.lng is not None else lng
+        )
+        session.add(destination)
+    elif destination.lat is None and lat is not None and lng is not None:
+        destination.lat = lat
+        destination.lng = lng
+
+    return destination
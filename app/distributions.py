@@ -0,0 +1,337 @@
+"""Spending Distribution Module
+
+Percentile statistics (p50/p90/p99 of daily spend, trip duration and
+per-activity cost) are answered from t-digests instead of scanning every
+itinerary item. A t-digest summarizes a distribution as a short list of
+weighted centroids: it is small, accurate at the tails, and two digests can
+be merged into one.
+
+Digests are stored in the ``stat_digest`` table for three scopes:
+
+1. ``plan`` - rebuilt from a single plan's items whenever that plan or one of
+   its items is written (only that plan's rows are read)
+2. ``user`` - all plans of a user
+3. ``destination`` - all plans to a normalized destination, across users
+
+User and destination digests are merges of their plans' digests. Writes only
+mark them stale; the next read re-merges the plan digests (never the item
+rows) and stores the result in a short transaction of its own, so the read
+routes (which never commit) pay for a re-merge once rather than on every
+request, and the request's session is not committed behind its back.
+"""
+import json
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+METRICS = ('daily_spend', 'trip_duration', 'activity_cost')
+SCOPES = ('plan', 'user', 'destination')
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_COMPRESSION = 100
+
+
+class TDigest:
+    """Merging t-digest (Dunning & Ertl) with the arcsine scale function"""
+
+    def __init__(self, compression=DEFAULT_COMPRESSION, centroids=None, min_value=None, max_value=None):
+        self.compression = compression
+        self.centroids = [list(c) for c in centroids or []]  # [mean, weight], sorted by mean
+        self.min = min_value
+        self.max = max_value
+        self._buffer = []
+
+    @property
+    def count(self):
+        return sum(c[1] for c in self.centroids) + sum(c[1] for c in self._buffer)
+
+    def add(self, value, weight=1):
+        """Add one observation"""
+        value = float(value)
+        self._buffer.append([value, weight])
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        """Fold another digest into this one"""
+        other._compress()
+        if not other.centroids:
+            return self
+        self._buffer.extend([list(c) for c in other.centroids])
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q_limit(self, q):
+        k = self._k(q) + 1
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = sum(weight for _, weight in points)
+
+        merged = []
+        cumulative = 0
+        mean, weight = points[0]
+        q_limit = self._q_limit(0)
+        for next_mean, next_weight in points[1:]:
+            if (cumulative + weight + next_weight) / total <= q_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                merged.append([mean, weight])
+                cumulative += weight
+                q_limit = self._q_limit(cumulative / total)
+                mean, weight = next_mean, next_weight
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        """Estimated value at quantile ``q`` (0..1), or None if empty"""
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        total = self.count
+        target = q * total
+        first_mean, first_weight = self.centroids[0]
+        if target < first_weight / 2:
+            # Between the minimum and the first centroid's centre
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+
+        cumulative = 0
+        for (mean, weight), (next_mean, next_weight) in zip(self.centroids, self.centroids[1:]):
+            left = cumulative + weight / 2
+            right = cumulative + weight + next_weight / 2
+            if target <= right:
+                return mean + (next_mean - mean) * (target - left) / (right - left)
+            cumulative += weight
+
+        last_mean, last_weight = self.centroids[-1]
+        remaining = total - target
+        return self.max - (self.max - last_mean) * remaining / (last_weight / 2)
+
+    def to_dict(self):
+        self._compress()
+        return {
+            'compression': self.compression,
+            'centroids': self.centroids,
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            compression=data.get('compression', DEFAULT_COMPRESSION),
+            centroids=data.get('centroids'),
+            min_value=data.get('min'),
+            max_value=data.get('max')
+        )
+
+
+def plan_metric_values(start_date, end_date, items):
+    """Raw observations one plan contributes to each metric
+
+    Args:
+        start_date, end_date: Trip dates
+        items: (day, cost) pairs of the plan's itinerary items
+
+    Returns:
+        dict: metric -> list of values
+    """
+    values = {metric: [] for metric in METRICS}
+    if start_date and end_date:
+        values['trip_duration'].append((end_date - start_date).days + 1)
+
+    spend_by_day = defaultdict(float)
+    for day, cost in items:
+        if cost is None:
+            continue
+        values['activity_cost'].append(cost)
+        spend_by_day[day] += cost
+    values['daily_spend'] = list(spend_by_day.values())
+    return values
+
+
+def _digest_table():
+    from app.models.stat_digest import StatDigest
+    return StatDigest.__table__
+
+
+_UPSERTS = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert,
+}
+
+
+def _store(connection, scope, scope_id, metric, digest):
+    """Insert or replace one stored digest
+
+    Concurrent requests may store the same digest, so this is a single upsert
+    on uq_stat_digest_scope_metric (or an insert retried as an update inside a
+    savepoint on other databases).
+    """
+    table = _digest_table()
+    data = json.dumps(digest.to_dict())
+    values = dict(data=data, count=digest.count, stale=False, updated_at=datetime.utcnow())
+    key = dict(scope=scope, scope_id=scope_id, metric=metric)
+
+    upsert = _UPSERTS.get(connection.dialect.name)
+    if upsert is not None:
+        connection.execute(upsert(table).values(**key, **values).on_conflict_do_update(
+            index_elements=[table.c.scope, table.c.scope_id, table.c.metric], set_=values
+        ))
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(**key, **values))
+    except IntegrityError:
+        connection.execute(table.update().where(
+            table.c.scope == scope, table.c.scope_id == scope_id, table.c.metric == metric
+        ).values(**values))
+
+
+def refresh_plan_digests(connection, plan_ids):
+    """Rebuild the plan digests of ``plan_ids`` from their own items
+
+    Plans that no longer exist have their digests removed. Returns the user
+    and destination ids whose digests are now out of date.
+    """
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+
+    plan_ids = set(plan_ids)
+    table = _digest_table()
+    plans_table = TravelPlan.__table__
+    items_table = ItineraryItem.__table__
+
+    plans = connection.execute(select(
+        plans_table.c.id, plans_table.c.user_id, plans_table.c.destination_id,
+        plans_table.c.start_date, plans_table.c.end_date
+    ).where(plans_table.c.id.in_(plan_ids))).fetchall()
+
+    items_by_plan = defaultdict(list)
+    for plan_id, day, cost in connection.execute(select(
+        items_table.c.travel_plan_id, items_table.c.day, items_table.c.cost
+    ).where(items_table.c.travel_plan_id.in_(plan_ids))):
+        items_by_plan[plan_id].append((day, cost))
+
+    user_ids, destination_ids = set(), set()
+    for plan in plans:
+        values = plan_metric_values(plan.start_date, plan.end_date, items_by_plan[plan.id])
+        for metric in METRICS:
+            digest = TDigest()
+            for value in values[metric]:
+                digest.add(value)
+            _store(connection, 'plan', plan.id, metric, digest)
+        user_ids.add(plan.user_id)
+        if plan.destination_id:
+            destination_ids.add(plan.destination_id)
+
+    missing = plan_ids - {plan.id for plan in plans}
+    if missing:
+        connection.execute(table.delete().where(
+            table.c.scope == 'plan', table.c.scope_id.in_(missing)
+        ))
+    return user_ids, destination_ids
+
+
+def mark_stale(connection, user_ids=(), destination_ids=()):
+    """Flag user/destination digests for re-merging on the next read"""
+    table = _digest_table()
+    for scope, ids in (('user', user_ids), ('destination', destination_ids)):
+        ids = [i for i in ids if i is not None]
+        if ids:
+            connection.execute(table.update().where(
+                table.c.scope == scope, table.c.scope_id.in_(ids)
+            ).values(stale=True))
+
+
+def get_digests(scope, scope_id):
+    """Stored digests of a user or destination, re-merged if stale
+
+    Re-merged digests (and digests of plans written before digests existed)
+    are written and committed on a connection of their own, leaving the
+    current transaction alone. If the session has already written in its
+    transaction they go into that transaction instead: it holds the write
+    lock (SQLite) or row locks a second connection would wait on.
+
+    Returns:
+        dict: metric -> TDigest
+    """
+    from app import db
+
+    if scope not in ('user', 'destination'):
+        raise ValueError(f'Unknown digest scope: {scope}')
+
+    table = _digest_table()
+    rows = db.session.connection().execute(table.select().where(
+        table.c.scope == scope, table.c.scope_id == scope_id
+    )).fetchall()
+    if len(rows) == len(METRICS) and not any(row.stale for row in rows):
+        return {row.metric: TDigest.from_dict(json.loads(row.data)) for row in rows}
+
+    if db.session.info.get('wrote'):
+        return _remerge(db.session.connection(), scope, scope_id)
+    with db.engine.begin() as connection:
+        return _remerge(connection, scope, scope_id)
+
+
+def _remerge(connection, scope, scope_id):
+    """Merge the plan digests of a user or destination and store the result"""
+    from app.models.travel_plan import TravelPlan
+
+    table = _digest_table()
+    owner = TravelPlan.user_id if scope == 'user' else TravelPlan.destination_id
+    plan_ids = [plan_id for (plan_id,) in connection.execute(
+        select(TravelPlan.id).where(owner == scope_id)
+    )]
+    plan_rows = connection.execute(table.select().where(
+        table.c.scope == 'plan', table.c.scope_id.in_(plan_ids)
+    )).fetchall() if plan_ids else []
+
+    # Plans written before digests existed are summarized once here
+    missing = set(plan_ids) - {row.scope_id for row in plan_rows}
+    if missing:
+        refresh_plan_digests(connection, missing)
+        plan_rows = connection.execute(table.select().where(
+            table.c.scope == 'plan', table.c.scope_id.in_(plan_ids)
+        )).fetchall()
+
+    digests = {metric: TDigest() for metric in METRICS}
+    for row in plan_rows:
+        digests[row.metric].merge(TDigest.from_dict(json.loads(row.data)))
+    for metric, digest in digests.items():
+        _store(connection, scope, scope_id, metric, digest)
+    return digests
+
+
+def percentile_summary(scope, scope_id, quantiles=DEFAULT_QUANTILES):
+    """p50/p90/p99 (by default) of every metric for a user or destination
+
+    Returns:
+        dict: metric -> {'count': n, 'p50': value, ...}
+    """
+    summary = {}
+    for metric, digest in get_digests(scope, scope_id).items():
+        entry = {'count': int(digest.count)}
+        for q in quantiles:
+            value = digest.quantile(q)
+            entry[f'p{int(round(q * 100))}'] = round(value, 2) if value is not None else None
+        summary[metric] = entry
+    return summary
@@ -0,0 +1,197 @@
+"""Expense Category Classification Module
+
+Itinerary items carry a persisted ``category`` column so that cost breakdowns
+can be answered with a single ``GROUP BY`` instead of re-parsing every
+activity string on every request. The category is assigned once, when the
+item is written, by the configured classifier:
+
+1. If the user picked a category explicitly, that value is stored and the
+   item is flagged as overridden so later edits never reclassify it
+2. Otherwise the classifier inspects the activity text and assigns one of
+   the built-in categories based on keyword rules
+
+A different classifier can be plugged in through the
+``EXPENSE_CATEGORY_CLASSIFIER`` config key. It only needs a
+``classify(activity)`` method (or can be a plain callable) returning a
+category name.
+"""
+import re
+
+from flask import current_app, has_app_context
+from sqlalchemy import func
+
+DEFAULT_CATEGORY = 'Other'
+
+# Rules are checked in order, so more specific categories come first
+# (e.g. "Lunch at the museum cafe" is Food, not Sightseeing)
+DEFAULT_CATEGORY_RULES = [
+    ('Accommodation', (
+        'hotel', 'hostel', 'airbnb', 'accommodation', 'resort', 'motel', 'lodge',
+        'inn', 'guesthouse', 'ryokan', 'checkin', 'checkout', 'stay', 'camping',
+    )),
+    ('Transport', (
+        'flight', 'fly', 'airport', 'train', 'bus', 'taxi', 'uber', 'lyft', 'ferry',
+        'metro', 'subway', 'tram', 'shuttle', 'transfer', 'rental', 'car', 'drive',
+        'parking', 'fuel', 'petrol', 'transit',
+    )),
+    ('Food', (
+        'breakfast', 'brunch', 'lunch', 'dinner', 'supper', 'meal', 'food', 'eat',
+        'restaurant', 'cafe', 'coffee', 'bakery', 'bar', 'pub', 'drinks', 'snack',
+        'tasting', 'wine', 'beer', 'dining', 'picnic', 'street-food', 'dessert',
+    )),
+    ('Shopping', (
+        'shopping', 'shop', 'mall', 'souvenir', 'souvenirs', 'boutique', 'market',
+        'bazaar', 'outlet', 'gift', 'gifts',
+    )),
+    ('Entertainment', (
+        'show', 'concert', 'theatre', 'theater', 'cinema', 'movie', 'festival',
+        'club', 'nightlife', 'game', 'match', 'spa', 'massage', 'class', 'workshop',
+        'hike', 'hiking', 'dive', 'diving', 'snorkel', 'snorkeling', 'ski', 'skiing',
+        'surf', 'surfing', 'kayak', 'kayaking', 'cruise', 'safari', 'bike', 'cycling',
+    )),
+    ('Sightseeing', (
+        'visit', 'tour', 'museum', 'gallery', 'temple', 'shrine', 'church',
+        'cathedral', 'castle', 'palace', 'monument', 'landmark', 'park', 'garden',
+        'zoo', 'aquarium', 'tower', 'bridge', 'beach', 'view', 'viewpoint',
+        'sightseeing', 'walk', 'explore', 'square', 'ruins',
+    )),
+]
+
+MAX_CATEGORY_LENGTH = 30
+
+_WORD_RE = re.compile(r"[a-z]+(?:-[a-z]+)*")
+
+
+class KeywordCategoryClassifier:
+    """Assign a category by matching words in the activity against keyword rules"""
+
+    def __init__(self, rules=None, default=DEFAULT_CATEGORY):
+        self.rules = [(name, frozenset(keywords))
+                      for name, keywords in (rules or DEFAULT_CATEGORY_RULES)]
+        self.default = default
+
+    def classify(self, activity):
+        if not activity:
+            return self.default
+
+        words = set()
+        for word in _WORD_RE.findall(activity.lower()):
+            words.add(word)
+            # "check-in" should match "checkin", "street-food" both parts, etc.
+            if '-' in word:
+                words.add(word.replace('-', ''))
+                words.update(word.split('-'))
+
+        for name, keywords in self.rules:
+            if words & keywords:
+                return name
+        return self.default
+
+    def __call__(self, activity):
+        return self.classify(activity)
+
+
+default_classifier = KeywordCategoryClassifier()
+
+
+def get_category_classifier():
+    """Return the classifier configured for the app, or the keyword default"""
+    if has_app_context():
+        classifier = current_app.config.get('EXPENSE_CATEGORY_CLASSIFIER')
+        if classifier is not None:
+            return classifier
+    return default_classifier
+
+
+def classify_activity(activity):
+    """Classify an activity description into an expense category"""
+    classifier = get_category_classifier()
+    classify = getattr(classifier, 'classify', classifier)
+    category = classify(activity) or DEFAULT_CATEGORY
+    return category[:MAX_CATEGORY_LENGTH]
+
+
+def normalize_category(value):
+    """Clean up a user supplied category, returning None if it is empty"""
+    if value is None:
+        return None
+    value = ' '.join(str(value).split())
+    if not value:
+        return None
+
+    # Reuse the canonical spelling for built-in categories
+    for name, _ in DEFAULT_CATEGORY_RULES:
+        if value.lower() == name.lower():
+            return name
+    if value.lower() == DEFAULT_CATEGORY.lower():
+        return DEFAULT_CATEGORY
+    return value[:MAX_CATEGORY_LENGTH]
+
+
+def apply_category(item, category=None):
+    """Set an item's category, treating an explicit value as a user override"""
+    category = normalize_category(category)
+    if category:
+        item.category = category
+        item.category_overridden = True
+    else:
+        item.category_overridden = False
+        item.category = classify_activity(item.activity)
+
+
+def category_totals(plan_id=None, user_id=None):
+    """Sum item costs per category using a single GROUP BY query
+
+    Args:
+        plan_id: Restrict the totals to one travel plan
+        user_id: Restrict the totals to all plans owned by a user
+
+    Returns:
+        dict: category name -> total cost
+    """
+    from app import db
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+
+    query = db.session.query(
+        ItineraryItem.category,
+        func.sum(ItineraryItem.cost)
+    ).filter(ItineraryItem.cost > 0)
+
+    if plan_id is not None:
+        query = query.filter(ItineraryItem.travel_plan_id == plan_id)
+    if user_id is not None:
+        query = query.join(TravelPlan, TravelPlan.id == ItineraryItem.travel_plan_id).filter(
+            TravelPlan.user_id == user_id
+        )
+
+    totals = {}
+    for category, total in query.group_by(ItineraryItem.category).all():
+        category = category or DEFAULT_CATEGORY
+        totals[category] = totals.get(category, 0) + float(total or 0)
+    return totals
+
+
+def category_totals_by_plan(user_id):
+    """Sum item costs per (plan, category) for every plan owned by a user
+
+    Returns:
+        dict: plan id -> {category name -> total cost}
+    """
+    from app import db
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+
+    rows = db.session.query(
+        ItineraryItem.travel_plan_id,
+        ItineraryItem.category,
+        func.sum(ItineraryItem.cost)
+    ).join(TravelPlan, TravelPlan.id == ItineraryItem.travel_plan_id).filter(
+        TravelPlan.user_id == user_id,
+        ItineraryItem.cost > 0
+    ).group_by(ItineraryItem.travel_plan_id, ItineraryItem.category).all()
+
+    totals = {}
+    for plan_id, category, total in rows:
+        plan_totals = totals.setdefault(plan_id, {})
+        category = category or DEFAULT_CATEGORY
+        plan_totals[category] = plan_totals.get(category, 0) + float(total or 0)
+    return totals
@@ -0,0 +1,186 @@
+"""Data Export Module
+
+Streams a user's travel plans, itinerary items, memories, tags and photos
+out of the application, for downloads and per-account backups, without
+holding the account in memory:
+
+1. Each dataset is one SELECT ordered by id, read with ``yield_per`` so rows
+   arrive ``CHUNK_ROWS`` at a time (through a server-side cursor on
+   PostgreSQL) and are written out as NDJSON or CSV as they arrive
+2. The account archive is a ZIP written to a non-seekable stream: every
+   dataset as NDJSON, the photo files from static/uploads copied in
+   ``FILE_CHUNK_SIZE`` pieces, and an ``export.json`` summary. Finished
+   pieces of the archive are handed on as soon as they are written
+3. Only what the user owns is exported: plans shared with them are not
+"""
+import csv
+import io
+import json
+import os
+import zipfile
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+from app import db
+from app.models.memory import Memory, Photo, Tag, memory_tags, photo_path
+from app.models.travel_plan import TravelPlan, ItineraryItem
+
+CHUNK_ROWS = 500
+FILE_CHUNK_SIZE = 64 * 1024
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# Already compressed; stored in the archive as they are
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic'}
+
+
+class Dataset:
+    """One exported table: a SELECT of labelled columns for a user"""
+
+    def __init__(self, name, statement):
+        self.name = name
+        self.statement = statement
+
+    def columns(self):
+        return list(self.statement(0).selected_columns.keys())
+
+    def rows(self, user_id):
+        """Rows as lists of JSON-ready values, fetched CHUNK_ROWS at a time"""
+        result = db.session.execute(self.statement(user_id), execution_options={'yield_per': CHUNK_ROWS})
+        for row in result:
+            yield [_value(value) for value in row]
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+DATASETS = {dataset.name: dataset for dataset in (
+    Dataset('plans', lambda user_id: select(
+        TravelPlan.id, TravelPlan.title, TravelPlan.destination, TravelPlan.dest_lat, TravelPlan.dest_lng,
+        TravelPlan.start_date, TravelPlan.end_date, TravelPlan.budget, TravelPlan.interests,
+        TravelPlan.is_public, TravelPlan.total_cost, TravelPlan.item_count, TravelPlan.created_at,
+    ).where(TravelPlan.user_id == user_id).order_by(TravelPlan.id)),
+
+    Dataset('items', lambda user_id: select(
+        ItineraryItem.id, ItineraryItem.travel_plan_id.label('plan_id'), ItineraryItem.day,
+        ItineraryItem.time, ItineraryItem.activity, ItineraryItem.location, ItineraryItem.lat,
+        ItineraryItem.lng, ItineraryItem.cost, ItineraryItem.category, ItineraryItem.notes,
+    ).join(TravelPlan, TravelPlan.id == ItineraryItem.travel_plan_id)
+     .where(TravelPlan.user_id == user_id).order_by(ItineraryItem.id)),
+
+    Dataset('memories', lambda user_id: select(
+        Memory.id, Memory.title, Memory.location, Memory.lat, Memory.lng, Memory.visit_date,
+        Memory.description, Memory.emotional_rating, Memory.is_public, Memory.created_at,
+    ).where(Memory.user_id == user_id).order_by(Memory.id)),
+
+    Dataset('tags', lambda user_id: select(
+        memory_tags.c.memory_id, Tag.normalized_name.label('tag'),
+    ).join(Tag, Tag.id == memory_tags.c.tag_id)
+     .join(Memory, Memory.id == memory_tags.c.memory_id)
+     .where(Memory.user_id == user_id).order_by(memory_tags.c.memory_id, Tag.normalized_name)),
+
+    Dataset('photos', lambda user_id: select(
+        Photo.id, Photo.memory_id, Photo.filename, Photo.caption, Photo.upload_date,
+    ).join(Memory, Memory.id == Photo.memory_id)
+     .where(Memory.user_id == user_id).order_by(Photo.id)),
+)}
+
+
+def ndjson_lines(dataset, user_id):
+    """One JSON object per row, as text lines"""
+    columns = dataset.columns()
+    for row in dataset.rows(user_id):
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def csv_chunks(dataset, user_id):
+    """A header line and the rows as CSV text, CHUNK_ROWS rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(dataset.columns())
+    for count, row in enumerate(dataset.rows(user_id), 1):
+        writer.writerow(row)
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_chunks(dataset, user_id, file_format):
+    """Text chunks of one dataset in 'ndjson' or 'csv'"""
+    if file_format == 'csv':
+        return csv_chunks(dataset, user_id)
+    return ndjson_lines(dataset, user_id)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable stream that keeps what was written until taken"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks, self.size = [], 0
+        return data
+
+
+def archive_chunks(user_id):
+    """Bytes of a ZIP archive of the user's data and photos, produced as it is written"""
+    sink = _ChunkSink()
+    counts, missing_photos = {}, []
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for dataset in DATASETS.values():
+            counts[dataset.name] = 0
+            with archive.open(f'{dataset.name}.ndjson', 'w', force_zip64=True) as entry:
+                for line in ndjson_lines(dataset, user_id):
+                    entry.write(line.encode('utf-8'))
+                    counts[dataset.name] += 1
+                    if sink.size >= FILE_CHUNK_SIZE:
+                        yield sink.take()
+
+        photos = db.session.execute(
+            select(Photo.memory_id, Photo.filename).join(Memory, Memory.id == Photo.memory_id)
+            .where(Memory.user_id == user_id).order_by(Photo.id),
+            execution_options={'yield_per': CHUNK_ROWS}
+        )
+        for memory_id, filename in photos:
+            filename = os.path.basename(filename)
+            path = photo_path(filename)
+            if not os.path.isfile(path):
+                missing_photos.append(filename)
+                continue
+            info = zipfile.ZipInfo.from_file(path, f'photos/{memory_id}/{filename}')
+            stored = os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as source, archive.open(info, 'w') as entry:
+                while True:
+                    data = source.read(FILE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    entry.write(data)
+                    if sink.size >= FILE_CHUNK_SIZE:
+                        yield sink.take()
+
+        archive.writestr('export.json', json.dumps({
+            'exported_at': datetime.utcnow().isoformat(),
+            'counts': counts,
+            'missing_photos': missing_photos,
+        }, indent=2))
+    yield sink.take()
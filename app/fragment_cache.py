@@ -0,0 +1,191 @@
+"""Fragment Cache Module
+
+Caches rendered HTML for expensive template blocks (dashboard trip and memory
+cards, per-day itinerary blocks on the plan page). A block is wrapped in a
+``{% call cache_fragment(...) %}`` tag and is only rendered, and only runs
+the queries it contains, when its cache entry is missing.
+
+Cache keys never need explicit deletes. Each key is built from the fragment
+name plus the current revision of the data it depends on:
+
+- ``('user_plans', user_id)``: a user's travel plan rows
+- ``('user_memories', user_id)``: a user's memories, photos and tags
+- ``('plan', plan_id)``: a travel plan row
+- ``('plan_day', plan_id, day)``: the itinerary items of one day of a plan
+
+Every write to those rows bumps the matching revisions in the same
+transaction (see the session hook at the bottom of this module), so once it
+commits later renders miss the old entries, which then age out of the LRU.
+
+Revisions are stored in the ``fragment_revision`` table, so a write made
+through one worker process invalidates the fragments cached by all of them.
+The rendered fragments themselves are kept in each process's memory.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_TTL = 600  # seconds; also bounds staleness of time-based blocks
+
+_fragments = OrderedDict()  # key -> (expires at, html)
+_lock = threading.Lock()
+
+_UPSERTS = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert,
+}
+
+
+def _revision_table():
+    from app.models.fragment_revision import FragmentRevision
+    return FragmentRevision.__table__
+
+
+def _key_text(key):
+    return ':'.join(str(part) for part in key)
+
+
+def revisions(keys):
+    """Current revisions of data keys such as ('plan', 3), in one query"""
+    keys = [tuple(key) for key in keys]
+    table = _revision_table()
+    stored = dict(db.session.execute(
+        select(table.c.key, table.c.revision).where(table.c.key.in_([_key_text(key) for key in keys]))
+    ).all()) if keys else {}
+    return {key: stored.get(_key_text(key), 0) for key in keys}
+
+
+def revision(key):
+    """Current revision of a data key such as ('plan', 3)"""
+    return revisions([key])[tuple(key)]
+
+
+def bump(*keys, connection=None):
+    """Invalidate every fragment that depends on ``keys`` once the transaction commits
+
+    Args:
+        keys: Data keys such as ('plan', 3)
+        connection: Connection of the transaction (default: the session's)
+    """
+    if not keys:
+        return
+    connection = connection if connection is not None else db.session.connection()
+    table = _revision_table()
+    upsert = _UPSERTS.get(connection.dialect.name)
+    for text in sorted({_key_text(key) for key in keys}):
+        if upsert is not None:
+            connection.execute(upsert(table).values(key=text, revision=1).on_conflict_do_update(
+                index_elements=[table.c.key], set_={'revision': table.c.revision + 1}
+            ))
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(key=text, revision=1))
+        except IntegrityError:
+            connection.execute(table.update().where(table.c.key == text)
+                               .values(revision=table.c.revision + 1))
+
+
+def clear():
+    """Drop all fragments cached by this process"""
+    with _lock:
+        _fragments.clear()
+
+
+def cache_fragment(name, *keys, ttl=DEFAULT_TTL, caller=None):
+    """Jinja call block that renders its body once per data revision
+
+    Usage::
+
+        {% call cache_fragment('upcoming_trips', ('user_plans', current_user.id)) %}
+            ...
+        {% endcall %}
+    """
+    if not app.config.get('FRAGMENT_CACHE_ENABLED', True):
+        return caller()
+
+    current = revisions(keys)
+    cache_key = (name,) + tuple((tuple(key), current[tuple(key)]) for key in keys)
+    now = time.monotonic()
+    with _lock:
+        entry = _fragments.get(cache_key)
+        if entry and entry[0] > now:
+            _fragments.move_to_end(cache_key)
+            return entry[1]
+
+    html = Markup(caller())
+    with _lock:
+        _fragments[cache_key] = (now + ttl, html)
+        _fragments.move_to_end(cache_key)
+        max_entries = app.config.get('FRAGMENT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        while len(_fragments) > max_entries:
+            _fragments.popitem(last=False)
+    return html
+
+
+def _track_previous_values():
+    """Load the old value when these attributes are set on an expired object,
+    so a moved item also invalidates the day (or plan) it moved away from"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+    from app.models.memory import Memory, Photo
+
+    for attribute in (TravelPlan.user_id, ItineraryItem.day, ItineraryItem.travel_plan_id,
+                      Memory.user_id, Photo.memory_id):
+        event.listen(attribute, 'set', lambda target, value, old, initiator: value,
+                     active_history=True, retval=True)
+
+
+_track_previous_values()
+
+
+def _history_values(obj, attr):
+    """Current and previous values of an attribute inside a flush"""
+    history = inspect(obj).attrs[attr].history
+    values = set(history.added or ()) | set(history.deleted or ()) | set(history.unchanged or ())
+    values.add(getattr(obj, attr))
+    values.discard(None)
+    return values
+
+
+def revision_keys_for_flush(session):
+    """Data keys touched by the objects of the current flush"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+    from app.models.memory import Memory, Photo
+
+    keys = set()
+    memory_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, TravelPlan):
+            keys.add(('plan', obj.id))
+            keys.update(('user_plans', user_id) for user_id in _history_values(obj, 'user_id'))
+        elif isinstance(obj, ItineraryItem):
+            for plan_id in _history_values(obj, 'travel_plan_id'):
+                keys.update(('plan_day', plan_id, day) for day in _history_values(obj, 'day'))
+        elif isinstance(obj, Memory):
+            keys.update(('user_memories', user_id) for user_id in _history_values(obj, 'user_id'))
+        elif isinstance(obj, Photo):
+            memory_ids.update(_history_values(obj, 'memory_id'))
+
+    if memory_ids:
+        rows = session.connection().execute(
+            select(Memory.user_id).where(Memory.id.in_(memory_ids))
+        )
+        keys.update(('user_memories', user_id) for (user_id,) in rows)
+    return keys
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_fragment_revisions(session, flush_context):
+    """Bump the revisions of the flushed rows in the same transaction"""
+    keys = revision_keys_for_flush(session)
+    if keys:
+        bump(*keys, connection=session.connection())
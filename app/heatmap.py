@@ -0,0 +1,244 @@
+"""Heatmap Tile Module
+
+Renders the density of a user's memories and itinerary items as 256px PNG
+map tiles, for histories too large to send to the browser even as clusters:
+
+1. A tile is drawn from the user's cluster hierarchy (see app.clustering)
+   ``DETAIL_LEVELS`` levels below the tile zoom, so it never has more than
+   16 x 16 cells plus a margin for blobs spilling over its edges, however
+   many points the user has
+2. Every cell is a blob at its centroid, stronger for more points. The
+   summed intensity is coloured from transparent blue to red
+3. Rendered tiles are kept on disk under ``HEATMAP_TILE_DIR``, per user and
+   layer, named after a fingerprint of the cells they were drawn from. A
+   write only changes the fingerprint of the tiles around the points it
+   added, moved or removed, so only those tiles are rendered again, and the
+   fingerprints stay valid across restarts. The cells come from the cluster
+   hierarchy checked against the user's stored point revision, so a write
+   made through any worker process changes the fingerprints in all of them. The outdated file of a tile is
+   removed when its new version is written, or when the tile has no points
+   left
+4. Serving a tile refreshes its file's modification time. ``prune_tiles``
+   (``flask prune-heatmap-tiles``) removes files not served for
+   ``HEATMAP_TILE_MAX_AGE_DAYS`` and then the least recently served ones
+   until the directory fits in ``HEATMAP_TILE_MAX_MB``
+"""
+import hashlib
+import os
+import tempfile
+import time
+from io import BytesIO
+from math import ceil, log
+
+from PIL import Image, ImageChops
+
+from app import app
+from app.clustering import GRID_BASE, MAX_CLUSTER_ZOOM, TILE_SIZE, hierarchy_for, project
+
+DETAIL_LEVELS = 2  # 16px cells
+MAX_HEATMAP_ZOOM = MAX_CLUSTER_ZOOM + DETAIL_LEVELS
+BLOB_RADIUS = 24  # pixels
+SATURATION_COUNT = 64  # Points in one cell drawn at full strength
+WEIGHT_STEPS = 32
+RENDER_VERSION = 1  # Part of every fingerprint; bump when the drawing changes
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_MB = 512
+
+# Intensity -> (red, green, blue, alpha)
+PALETTE_STOPS = (
+    (0, (0, 0, 255, 0)),
+    (48, (0, 0, 255, 110)),
+    (112, (0, 255, 255, 160)),
+    (160, (0, 255, 0, 185)),
+    (208, (255, 255, 0, 210)),
+    (255, (255, 0, 0, 230)),
+)
+
+
+def _blob(radius):
+    size = 2 * radius + 1
+    blob = Image.new('L', (size, size))
+    blob.putdata([
+        int(255 * max(0.0, 1 - ((x - radius) ** 2 + (y - radius) ** 2) ** 0.5 / radius) ** 2)
+        for y in range(size) for x in range(size)
+    ])
+    return blob
+
+
+def _palette():
+    """One 256-entry lookup table per RGBA channel"""
+    tables = [[], [], [], []]
+    for (start, low), (end, high) in zip(PALETTE_STOPS, PALETTE_STOPS[1:]):
+        for value in range(start, end + (end == 255)):
+            t = (value - start) / (end - start)
+            for channel, table in enumerate(tables):
+                table.append(round(low[channel] + (high[channel] - low[channel]) * t))
+    return tables
+
+
+_BLOBS = [_blob(BLOB_RADIUS).point(lambda v, step=step: v * step // WEIGHT_STEPS)
+          for step in range(WEIGHT_STEPS + 1)]
+_PALETTE = _palette()
+_empty_tile = None
+
+
+def tile_dir():
+    return (app.config.get('HEATMAP_TILE_DIR') or os.environ.get('HEATMAP_TILE_DIR')
+            or os.path.join(app.instance_path, 'heatmap_tiles'))
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_HEATMAP_ZOOM and 0 <= x < 1 << z and 0 <= y < 1 << z
+
+
+def tile_cells(hierarchy, z, x, y):
+    """(cell, cluster) pairs that can draw on tile z/x/y"""
+    level = min(z + DETAIL_LEVELS, MAX_CLUSTER_ZOOM)
+    side = GRID_BASE << level
+    per_tile = side >> z
+    margin = ceil(BLOB_RADIUS * per_tile / TILE_SIZE)
+    return hierarchy.cells(
+        level,
+        max(x * per_tile - margin, 0), max(y * per_tile - margin, 0),
+        min((x + 1) * per_tile - 1 + margin, side - 1), min((y + 1) * per_tile - 1 + margin, side - 1),
+    )
+
+
+def fingerprint(cells):
+    """Hash of the cells of a tile; it changes when any of their points change"""
+    digest = hashlib.sha1(str(RENDER_VERSION).encode())
+    for (cell_x, cell_y), cluster in sorted(cells, key=lambda pair: pair[0]):
+        digest.update(f'{cell_x},{cell_y}:{cluster.count}:{cluster.lat_sum!r}:{cluster.lng_sum!r};'.encode())
+    return digest.hexdigest()[:20]
+
+
+def render(z, x, y, cells):
+    """PNG bytes of tile z/x/y"""
+    pad = 2 * BLOB_RADIUS
+    canvas = Image.new('L', (TILE_SIZE + 2 * pad, TILE_SIZE + 2 * pad))
+    world_size = TILE_SIZE << z
+    for _, cluster in cells:
+        world_x, world_y = project(cluster.lat, cluster.lng)
+        center_x = round(world_x * world_size) - x * TILE_SIZE + pad
+        center_y = round(world_y * world_size) - y * TILE_SIZE + pad
+        if not (pad - BLOB_RADIUS <= center_x < pad + TILE_SIZE + BLOB_RADIUS
+                and pad - BLOB_RADIUS <= center_y < pad + TILE_SIZE + BLOB_RADIUS):
+            continue
+
+        weight = 0.25 + 0.75 * min(1.0, log(cluster.count) / log(SATURATION_COUNT))
+        blob = _BLOBS[round(weight * WEIGHT_STEPS)]
+        box = (center_x - BLOB_RADIUS, center_y - BLOB_RADIUS,
+               center_x + BLOB_RADIUS + 1, center_y + BLOB_RADIUS + 1)
+        canvas.paste(ImageChops.add(canvas.crop(box), blob), box)
+
+    density = canvas.crop((pad, pad, pad + TILE_SIZE, pad + TILE_SIZE))
+    image = Image.merge('RGBA', [density.point(table) for table in _PALETTE])
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def empty_tile():
+    """PNG bytes of a transparent tile"""
+    global _empty_tile
+    if _empty_tile is None:
+        buffer = BytesIO()
+        Image.new('RGBA', (TILE_SIZE, TILE_SIZE)).save(buffer, 'PNG')
+        _empty_tile = buffer.getvalue()
+    return _empty_tile
+
+
+def _remove_versions(directory, y, keep=None):
+    """Remove the stored files of tile ``y`` in a tile column, except ``keep``"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(f'{y}-') and name.endswith('.png') and name != keep:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def tile(user_id, layers, z, x, y):
+    """The heatmap tile z/x/y of a user's points in ``layers``, rendered if its data changed
+
+    Returns:
+        (path of the PNG file, fingerprint), or None if no point is near the tile
+    """
+    layers = tuple(sorted(layers))
+    # hierarchy_for rebuilds when another worker has written the user's points
+    cells = tile_cells(hierarchy_for(user_id, layers), z, x, y)
+    directory = os.path.join(tile_dir(), str(user_id), '-'.join(layers), str(z), str(x))
+    if not cells:
+        _remove_versions(directory, y)  # The last points near it were removed
+        return None
+
+    key = fingerprint(cells)
+    path = os.path.join(directory, f'{y}-{key}.png')
+    try:
+        os.utime(path)  # Recently served tiles are pruned last
+        return path, key
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(render(z, x, y, cells))
+    os.replace(temp_path, path)
+    _remove_versions(directory, y, keep=os.path.basename(path))
+    return path, key
+
+
+def prune_tiles(max_age_days=None, max_mb=None):
+    """Remove stored tiles not served recently, then the oldest ones above the size cap
+
+    Args:
+        max_age_days: Default HEATMAP_TILE_MAX_AGE_DAYS (30)
+        max_mb: Default HEATMAP_TILE_MAX_MB (512)
+
+    Returns:
+        (files removed, bytes left)
+    """
+    if max_age_days is None:
+        max_age_days = float(app.config.get('HEATMAP_TILE_MAX_AGE_DAYS')
+                             or os.environ.get('HEATMAP_TILE_MAX_AGE_DAYS') or DEFAULT_MAX_AGE_DAYS)
+    if max_mb is None:
+        max_mb = float(app.config.get('HEATMAP_TILE_MAX_MB')
+                       or os.environ.get('HEATMAP_TILE_MAX_MB') or DEFAULT_MAX_MB)
+    cutoff = time.time() - max_age_days * 86400
+    removed, files = 0, []
+    root = tile_dir()
+    for directory, _, names in os.walk(root, topdown=False):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime < cutoff:
+                    os.remove(path)  # Also leftovers of interrupted writes
+                    removed += 1
+                elif name.endswith('.png'):
+                    files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        if directory != root:
+            try:
+                os.rmdir(directory)  # Only if empty
+            except OSError:
+                pass
+
+    size = sum(file_size for _, file_size, _ in files)
+    files.sort()
+    for _, file_size, path in files:
+        if size <= max_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+            size -= file_size
+        except OSError:
+            pass
+    return removed, size
@@ -0,0 +1,215 @@
+"""Itinerary Batch Module
+
+Applies several itinerary changes for one plan at once, as sent by the
+itinerary UI after a drag-and-drop reorder, instead of one request (with its
+own permission checks and commit) per moved item:
+
+1. Operations are applied in order to the current rows, loaded with one
+   SELECT, and each result is validated like an imported row (see
+   app.itinerary_import.parse_row). If any operation is invalid nothing is
+   written and every problem is reported
+2. The net changes are written in one transaction: one DELETE, one
+   executemany UPDATE for the changed rows and one executemany INSERT for
+   the new ones
+3. Core writes skip the session hooks, so the derived data (plan totals, geo
+   summary, digests, search and spatial entries) is refreshed and the changes
+   are logged for delta sync explicitly, and the fragment cache and map
+   cluster revisions are bumped, in the same transaction
+
+Operations (``id`` is an item of the plan; ``ref`` is echoed for new items):
+
+- ``{"op": "move", "id": 5, "day": 2, "time": "10:00"}`` (time is optional)
+- ``{"op": "retime", "id": 5, "time": "14:30"}`` (empty time clears it)
+- ``{"op": "update", "id": 5, "activity": "...", "cost": 12}`` (any item field)
+- ``{"op": "delete", "id": 5}``
+- ``{"op": "add", "ref": "new-1", "day": 1, "activity": "..."}``
+"""
+from sqlalchemy import bindparam, select
+
+from app import db, fragment_cache
+from app.clustering import invalidate, plan_users
+from app.itinerary_import import parse_row, refresh_item_data
+from app.itinerary_sync import item_data, record_changes
+from app.models.travel_plan import ItineraryItem
+
+MAX_OPERATIONS = 500
+
+FIELDS = ('day', 'time', 'activity', 'location', 'lat', 'lng', 'cost', 'notes', 'category')
+COLUMNS = ('day', 'time', 'minutes', 'activity', 'location', 'lat', 'lng', 'cost', 'notes',
+           'category', 'category_overridden')
+OPERATION_FIELDS = {
+    'move': ('day', 'time'),
+    'retime': ('time',),
+    'update': FIELDS,
+    'delete': (),
+    'add': FIELDS,
+}
+REQUIRED_FIELDS = {
+    'move': ('day',),
+    'retime': ('time',),
+}
+
+
+class BatchError(ValueError):
+    """The operations can not be applied; nothing was written"""
+
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+
+class BatchResult:
+    """Net effect of a batch: changed and added rows, deleted ids"""
+
+    def __init__(self):
+        self.items = []
+        self.added = {}  # ref -> id of the new item
+        self.deleted = []
+
+    def to_dict(self):
+        return {
+            'items': self.items,
+            'added': self.added,
+            'deleted': self.deleted,
+        }
+
+
+def _as_row(values):
+    """Field values of an item as parse_row expects them; unforced categories are reclassified"""
+    row = {name: values[name] for name in FIELDS if name != 'category'}
+    if values['category_overridden']:
+        row['category'] = values['category']
+    return row
+
+
+def _check_shape(operation):
+    """Problems with the form of one operation (not its values)"""
+    if not isinstance(operation, dict):
+        return ['Each operation must be an object']
+    kind = operation.get('op')
+    if kind not in OPERATION_FIELDS:
+        return [f'op must be one of {", ".join(OPERATION_FIELDS)}']
+    errors = []
+    if kind != 'add':
+        item_id = operation.get('id')
+        if not isinstance(item_id, int) or isinstance(item_id, bool):
+            errors.append('id must be an item id')
+    ref = operation.get('ref')
+    if ref is not None and (not isinstance(ref, (str, int)) or isinstance(ref, bool)):
+        errors.append('ref must be a string or number')
+    allowed = set(OPERATION_FIELDS[kind]) | {'op', 'id', 'ref'}
+    unknown = sorted(str(key) for key in operation if key not in allowed)
+    if unknown:
+        errors.append(f'{kind} can not change {", ".join(unknown)}')
+    missing = [name for name in REQUIRED_FIELDS.get(kind, ()) if name not in operation]
+    if missing:
+        errors.append(f'{kind} needs {", ".join(missing)}')
+    return errors
+
+
+def apply_operations(plan, operations):
+    """Apply a list of operations to a plan's itinerary in one transaction and commit
+
+    Args:
+        plan: TravelPlan whose items are changed; the caller checks permissions
+        operations: List of operation dicts (see the module docstring)
+
+    Returns:
+        BatchResult with the changed and new rows in display order
+
+    Raises:
+        BatchError: If any operation is invalid; nothing is written
+    """
+    if not isinstance(operations, list) or not operations:
+        raise BatchError('operations must be a non-empty list')
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError(f'At most {MAX_OPERATIONS} operations can be sent at once')
+
+    errors = []
+    for index, operation in enumerate(operations):
+        problems = _check_shape(operation)
+        if problems:
+            errors.append({'operation': index, 'errors': problems})
+    if errors:
+        raise BatchError('Invalid operations', errors)
+
+    table = ItineraryItem.__table__
+    connection = db.session.connection()
+    item_ids = {operation['id'] for operation in operations if operation['op'] != 'add'}
+    original = {}
+    if item_ids:
+        rows = connection.execute(
+            select(table.c.id, *(table.c[name] for name in COLUMNS))
+            .where(table.c.id.in_(item_ids), table.c.travel_plan_id == plan.id)
+        ).mappings()
+        original = {row['id']: dict(row) for row in rows}
+
+    max_day = (plan.end_date - plan.start_date).days + 1 if plan.start_date and plan.end_date else None
+    current = dict(original)
+    deleted, added = set(), []
+    for index, operation in enumerate(operations):
+        kind = operation['op']
+        if kind == 'add':
+            values, problems = parse_row({name: operation[name] for name in FIELDS if name in operation}, max_day)
+            if not problems:
+                added.append((operation.get('ref'), values))
+        elif operation['id'] not in current or operation['id'] in deleted:
+            problems = [f'Item {operation["id"]} is not in this plan']
+        elif kind == 'delete':
+            deleted.add(operation['id'])
+            problems = []
+        else:
+            row = _as_row(current[operation['id']])
+            row.update((name, operation[name]) for name in OPERATION_FIELDS[kind] if name in operation)
+            values, problems = parse_row(row, max_day)
+            if not problems:
+                current[operation['id']] = values
+        if problems:
+            errors.append({'operation': index, 'errors': problems})
+    if errors:
+        raise BatchError('Invalid operations', errors)
+
+    changed = [
+        dict(values, item_id=item_id) for item_id, values in current.items()
+        if item_id not in deleted and any(values[name] != original[item_id][name] for name in COLUMNS)
+    ]
+    if not (changed or deleted or added):
+        return BatchResult()
+
+    if deleted:
+        connection.execute(table.delete().where(table.c.id.in_(deleted)))
+    if changed:
+        connection.execute(table.update().where(table.c.id == bindparam('item_id')), changed)
+    new_ids = []
+    if added:
+        insert = table.insert().returning(table.c.id, sort_by_parameter_order=True)
+        new_ids = list(connection.execute(
+            insert, [dict(values, travel_plan_id=plan.id) for _, values in added]
+        ).scalars())
+
+    written_ids = [values['item_id'] for values in changed] + new_ids
+    refresh_item_data(connection, plan.id, written_ids + list(deleted))
+    record_changes(connection, plan.id, inserted=new_ids, updated=[values['item_id'] for values in changed],
+                   deleted=deleted)
+    days = {original[item_id]['day'] for item_id in deleted}
+    days.update(original[values['item_id']]['day'] for values in changed)
+    days.update(values['day'] for values in changed)
+    days.update(values['day'] for _, values in added)
+    viewers = plan_users(connection, [plan.id])
+
+    result = BatchResult()
+    if written_ids:
+        rows = connection.execute(
+            select(table.c.id, *(table.c[name] for name in COLUMNS))
+            .where(table.c.id.in_(written_ids))
+            .order_by(table.c.day, table.c.minutes, table.c.id)
+        )
+        result.items = [item_data(row) for row in rows]
+    result.added = {ref: item_id for (ref, _), item_id in zip(added, new_ids) if ref is not None}
+    result.deleted = sorted(deleted)
+    keys = [('plan', plan.id), ('user_plans', plan.user_id)] + [('plan_day', plan.id, day) for day in days]
+    fragment_cache.bump(*keys, connection=connection)
+    invalidate(*viewers, connection=connection)
+    db.session.commit()
+
+    return result
@@ -0,0 +1,349 @@
+"""Itinerary Import Module
+
+Adds many itinerary items to a plan at once from a CSV or JSON file (for
+example an itinerary kept in a spreadsheet), instead of one request and one
+commit per item:
+
+1. Rows are read one at a time. CSV files need a header row; JSON files hold
+   an array of objects or one object per line (JSON Lines), decoded as the
+   text is read. Columns: day, activity (both required), time, location,
+   lat, lng, cost, notes and category
+2. Each row is validated and normalized the way the model hooks would do it:
+   times are parsed into minutes and the category is classified unless the
+   row names one. Problems are reported per row
+3. Valid rows are inserted in batches of ``BATCH_SIZE`` with executemany, all
+   in one transaction. By default a file with any invalid row imports
+   nothing; ``skip_invalid`` imports the valid rows anyway
+
+Core inserts skip the session hooks, so ``import_items`` refreshes the
+derived data itself (see ``refresh_item_data``): plan totals and geo
+summary, spending digests, the plan's search document and the items'
+spatial entries, logs the new items for delta sync, and bumps the fragment
+cache revisions of the plan and the map cluster revisions of everyone who
+can see it, all in the import's transaction.
+"""
+import codecs
+import csv
+import json
+import math
+import os
+
+from app import db, fragment_cache
+from app.clustering import invalidate, plan_users
+from app.distributions import mark_stale, refresh_plan_digests
+from app.expense_categories import classify_activity, normalize_category
+from app.itinerary_sync import record_changes
+from app.itinerary_time import parse_time, time_value
+from app.models.travel_plan import ItineraryItem, recompute_plan_geo, recompute_plan_totals
+from app.search import reindex_plans
+from app.spatial import reindex_item_points
+
+FORMATS = ('csv', 'json')
+BATCH_SIZE = 1000
+MAX_IMPORT_ROWS = 100000
+MAX_REPORTED_ERRORS = 100
+CHUNK_SIZE = 64 * 1024
+
+REQUIRED_COLUMNS = ('day', 'activity')
+COLUMN_ALIASES = {
+    'latitude': 'lat',
+    'longitude': 'lng',
+    'lon': 'lng',
+    'description': 'notes',
+}
+
+_EXTENSIONS = {'.csv': 'csv', '.json': 'json', '.jsonl': 'json', '.ndjson': 'json'}
+_CONTENT_TYPES = {'text/csv': 'csv', 'application/json': 'json', 'application/x-ndjson': 'json',
+                  'application/jsonl': 'json'}
+
+
+class ImportFileError(ValueError):
+    """The file as a whole can not be imported"""
+
+
+class ImportResult:
+    """Outcome of an import: rows read, items imported and per-row errors"""
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.errors = []  # The first MAX_REPORTED_ERRORS
+        self.error_count = 0
+
+    def add_error(self, row, messages):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'errors': messages})
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+def detect_format(filename=None, content_type=None, requested=None):
+    """'csv' or 'json', from an explicit choice, the file name or the content type
+
+    Raises:
+        ImportFileError: If none of them names a supported format
+    """
+    if requested:
+        if requested not in FORMATS:
+            raise ImportFileError(f'Unknown format "{requested}"; use csv or json')
+        return requested
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in _EXTENSIONS:
+        return _EXTENSIONS[extension]
+    if content_type in _CONTENT_TYPES:
+        return _CONTENT_TYPES[content_type]
+    raise ImportFileError('Unknown file format; upload a .csv or .json file')
+
+
+def _column_name(key):
+    name = str(key).strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(name, name)
+
+
+def _csv_rows(text):
+    reader = csv.DictReader(text)
+    columns = {_column_name(name) for name in reader.fieldnames or ()}
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise ImportFileError(f'Missing column(s): {", ".join(missing)}')
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _json_rows(text):
+    """Values of a JSON array, or of JSON Lines, decoded as the text is read"""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = text.read(CHUNK_SIZE)
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+
+    def next_char(separators=''):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in separators):
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                return ''
+            read_more()
+
+    in_array = next_char() == '['
+    if in_array:
+        pos += 1
+    number = 0
+    while True:
+        char = next_char(',' if in_array else '')
+        if not char:
+            if in_array:
+                raise ImportFileError('The JSON array is not closed')
+            return
+        if in_array and char == ']':
+            return
+        while True:
+            try:
+                value, pos = decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ImportFileError(f'Invalid JSON in row {number + 1}: {e.msg}')
+                read_more()
+        number += 1
+        yield number, value
+
+
+def read_rows(stream, file_format):
+    """(row number, row) pairs of a binary file; CSV rows are numbered by line"""
+    text = codecs.getreader('utf-8-sig')(stream)
+    rows = _csv_rows(text) if file_format == 'csv' else _json_rows(text)
+    try:
+        yield from rows
+    except UnicodeDecodeError:
+        raise ImportFileError('The file is not UTF-8 text')
+    except csv.Error as e:
+        raise ImportFileError(f'Invalid CSV: {e}')
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _number(value):
+    if isinstance(value, bool):
+        raise ValueError
+    if not isinstance(value, (int, float)):
+        value = _text(value)
+        if value is None:
+            return None
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+
+def parse_row(row, max_day=None):
+    """Column values of a new itinerary_item row
+
+    Args:
+        row: dict of column name -> value as read from the file
+        max_day: Last day of the plan, if the days are limited
+
+    Returns:
+        (values, errors): errors is a list of messages, empty if the row is valid
+    """
+    if not isinstance(row, dict):
+        return None, ['Each row must be an object']
+    row = {_column_name(key): value for key, value in row.items() if key is not None}
+    errors = []
+
+    activity = _text(row.get('activity'))
+    if activity is None:
+        errors.append('activity is required')
+    elif len(activity) > 200:
+        errors.append('activity is longer than 200 characters')
+
+    day = None
+    try:
+        day = row.get('day')
+        day = int(day) if isinstance(day, int) and not isinstance(day, bool) else int(_text(day))
+        if day < 1 or (max_day is not None and day > max_day):
+            errors.append(f'day must be between 1 and {max_day}' if max_day else 'day must be 1 or more')
+    except (TypeError, ValueError):
+        errors.append('day must be a whole number')
+
+    time = _text(row.get('time'))
+    minutes = parse_time(time)
+    if minutes is not None:
+        time = time_value(minutes)
+    elif time is not None and len(time) > 10:
+        errors.append(f'time "{time[:20]}" is not a time of day')
+
+    location = _text(row.get('location'))
+    if location is not None and len(location) > 100:
+        errors.append('location is longer than 100 characters')
+
+    coordinates = {}
+    for name, limit in (('lat', 90), ('lng', 180)):
+        try:
+            coordinates[name] = _number(row.get(name))
+            if coordinates[name] is not None and not -limit <= coordinates[name] <= limit:
+                errors.append(f'{name} must be between -{limit} and {limit}')
+        except ValueError:
+            errors.append(f'{name} must be a number')
+    if len([value for value in coordinates.values() if value is not None]) == 1:
+        errors.append('lat and lng must be given together')
+
+    try:
+        cost = _number(row.get('cost'))  # None when not given, like items saved without one
+        if cost is not None and cost < 0:
+            errors.append('cost can not be negative')
+    except ValueError:
+        errors.append('cost must be a number')
+        cost = None
+
+    if errors:
+        return None, errors
+
+    # The same normalization as the ItineraryItem insert hooks
+    category = normalize_category(row.get('category'))
+    return {
+        'day': day,
+        'time': time,
+        'minutes': minutes,
+        'activity': activity,
+        'location': location,
+        'lat': coordinates.get('lat'),
+        'lng': coordinates.get('lng'),
+        'cost': cost,
+        'notes': _text(row.get('notes')),
+        'category': category or classify_activity(activity),
+        'category_overridden': category is not None,
+    }, []
+
+
+def refresh_item_data(connection, plan_id, item_ids):
+    """Bring the data derived from itinerary items up to date after Core writes
+
+    ``item_ids`` may include deleted items; their spatial entries are removed.
+    """
+    recompute_plan_totals(connection, [plan_id])
+    recompute_plan_geo(connection, [plan_id])
+    user_ids, destination_ids = refresh_plan_digests(connection, [plan_id])
+    mark_stale(connection, user_ids, destination_ids)
+    reindex_plans(connection, [plan_id])
+    reindex_item_points(connection, item_ids)
+
+
+def import_items(plan, stream, file_format, skip_invalid=False):
+    """Add the rows of a CSV or JSON file to a plan's itinerary and commit
+
+    Args:
+        plan: TravelPlan to add the items to
+        stream: Binary file object
+        file_format: 'csv' or 'json'
+        skip_invalid: Import the valid rows even if other rows have errors
+
+    Returns:
+        ImportResult (nothing is imported if it has errors, unless skip_invalid)
+
+    Raises:
+        ImportFileError: If the file can not be read; nothing is imported
+    """
+    result = ImportResult()
+    max_day = (plan.end_date - plan.start_date).days + 1 if plan.start_date and plan.end_date else None
+    connection = db.session.connection()
+    table = ItineraryItem.__table__
+    insert = table.insert().returning(table.c.id)
+    batch, item_ids, days = [], [], set()
+
+    try:
+        for row_number, row in read_rows(stream, file_format):
+            result.rows += 1
+            if result.rows > MAX_IMPORT_ROWS:
+                raise ImportFileError(f'Files can have at most {MAX_IMPORT_ROWS} rows')
+            values, errors = parse_row(row, max_day)
+            if errors:
+                result.add_error(row_number, errors)
+                continue
+            if result.error_count and not skip_invalid:
+                continue  # Nothing will be imported; only look for more errors
+
+            values['travel_plan_id'] = plan.id
+            batch.append(values)
+            days.add(values['day'])
+            if len(batch) >= BATCH_SIZE:
+                item_ids.extend(connection.execute(insert, batch).scalars())
+                batch = []
+        if batch and (skip_invalid or not result.error_count):
+            item_ids.extend(connection.execute(insert, batch).scalars())
+    except ImportFileError:
+        db.session.rollback()
+        raise
+
+    if not item_ids or (result.error_count and not skip_invalid):
+        db.session.rollback()
+        return result
+
+    refresh_item_data(connection, plan.id, item_ids)
+    record_changes(connection, plan.id, inserted=item_ids)
+    viewers = plan_users(connection, [plan.id])
+    keys = [('plan', plan.id), ('user_plans', plan.user_id)] + [('plan_day', plan.id, day) for day in days]
+    fragment_cache.bump(*keys, connection=connection)
+    invalidate(*viewers, connection=connection)
+    db.session.commit()
+
+    result.imported = len(item_ids)
+    return result
@@ -0,0 +1,202 @@
+"""Itinerary Sync Module
+
+Lets clients that already hold a plan's itinerary fetch only what changed
+since they last saw it, instead of the whole itinerary after every edit:
+
+1. Every plan has a ``revision`` that goes up by one with each flush (or Core
+   write) that adds, changes or deletes any of its itinerary items
+2. ``itinerary_change`` keeps one row per item: the revision of its latest
+   change, the revision it was added at and whether it was deleted, so the
+   log never holds more than one row per item. Only the rows of deleted
+   items accumulate; when a plan has more than ``MAX_DELETED`` of them, all
+   but the newest ``KEEP_DELETED`` are removed and the plan's
+   ``change_floor`` is raised to the revision of the last one removed
+3. ``changes_since(plan, since)`` returns the items inserted, updated and
+   deleted after revision ``since``, or None when ``since`` is below the
+   floor (or ahead of the plan, e.g. read from a lagging replica) and the
+   client needs a full snapshot instead
+
+ORM writes are logged by the session hook at the bottom of this module; Core
+writers (bulk imports, batch changes) call ``record_changes`` themselves.
+"""
+from sqlalchemy import event, func, inspect, select
+
+from app import db
+from app.itinerary_time import display_time
+from app.models.travel_plan import ItineraryChange, ItineraryItem, TravelPlan
+
+MAX_DELETED = 200
+KEEP_DELETED = 100
+
+# Item attributes that clients display; other writes are not logged
+SYNCED_ATTRS = ('day', 'time', 'activity', 'location', 'lat', 'lng', 'cost', 'notes', 'category',
+                'travel_plan_id')
+
+
+def item_data(item):
+    """JSON of an itinerary item (an ItineraryItem or a row of its columns)"""
+    return {
+        'id': item.id,
+        'day': item.day,
+        'time': item.time,
+        'minutes': item.minutes,
+        'time_display': display_time(item),
+        'activity': item.activity,
+        'location': item.location,
+        'lat': item.lat,
+        'lng': item.lng,
+        'cost': float(item.cost) if item.cost else 0,
+        'notes': item.notes,
+        'category': item.category,
+    }
+
+
+def record_changes(connection, plan_id, inserted=(), updated=(), deleted=()):
+    """Log changes to the items of one plan under a new plan revision
+
+    Args:
+        connection: Connection of the current transaction
+        plan_id: Plan whose items were written
+        inserted, updated, deleted: Item ids
+
+    Returns:
+        int: The new revision, or None if nothing was logged
+    """
+    # An id both deleted and inserted was reused by the database for a new item
+    inserted = set(inserted)
+    deleted = set(deleted) - inserted
+    updated = set(updated) - inserted - deleted
+    if not (inserted or updated or deleted):
+        return None
+
+    plans = TravelPlan.__table__
+    log = ItineraryChange.__table__
+    revision = connection.execute(
+        plans.update().where(plans.c.id == plan_id)
+        .values(revision=plans.c.revision + 1).returning(plans.c.revision)
+    ).scalar()
+    if revision is None:
+        return None  # The plan is gone
+
+    # New ids only clash with logged ones if the database reuses ids of deleted rows
+    logged_max = connection.execute(
+        select(func.max(log.c.item_id)).where(log.c.travel_plan_id == plan_id)
+    ).scalar()
+    candidates = updated | deleted
+    if logged_max is not None:
+        candidates |= {item_id for item_id in inserted if item_id <= logged_max}
+    logged = set()
+    if candidates:
+        logged = set(connection.execute(
+            select(log.c.item_id).where(log.c.travel_plan_id == plan_id, log.c.item_id.in_(candidates))
+        ).scalars())
+
+    rows = []
+    for item_ids, values in ((inserted, {'inserted_revision': revision, 'deleted': False}),
+                             (updated, {'deleted': False}),
+                             (deleted, {'deleted': True})):
+        if item_ids & logged:
+            connection.execute(
+                log.update().where(log.c.travel_plan_id == plan_id, log.c.item_id.in_(item_ids & logged))
+                .values(revision=revision, **values)
+            )
+        for item_id in item_ids - logged:
+            row = {'travel_plan_id': plan_id, 'item_id': item_id, 'revision': revision, 'inserted_revision': 0}
+            rows.append(dict(row, **values))
+    if rows:
+        connection.execute(log.insert(), rows)
+
+    if deleted:
+        _compact(connection, plan_id)
+    # Announced to live subscribers once the transaction commits (see app.plan_events)
+    db.session.info.setdefault('plan_revisions', {})[plan_id] = revision
+    return revision
+
+
+def _compact(connection, plan_id):
+    """Drop the oldest deletions of a plan once there are more than MAX_DELETED"""
+    log = ItineraryChange.__table__
+    plans = TravelPlan.__table__
+    deletions = (log.c.travel_plan_id == plan_id, log.c.deleted.is_(True))
+    if connection.execute(select(func.count()).where(*deletions)).scalar() <= MAX_DELETED:
+        return
+    floor = connection.execute(
+        select(log.c.revision).where(*deletions)
+        .order_by(log.c.revision.desc()).offset(KEEP_DELETED).limit(1)
+    ).scalar()
+    connection.execute(log.delete().where(*deletions, log.c.revision <= floor))
+    connection.execute(plans.update().where(plans.c.id == plan_id).values(change_floor=floor))
+
+
+def changes_since(plan, since):
+    """Items of a plan inserted, updated and deleted after revision ``since``
+
+    Returns:
+        dict with the current revision, ``full`` False, inserted and updated
+        (item JSON in display order) and deleted (ids); or None if the log can
+        not answer and the client needs a full snapshot
+    """
+    revision = plan.revision
+    if since is None or not plan.change_floor <= since <= revision:
+        return None
+
+    log = ItineraryChange.__table__
+    live, deleted = {}, []
+    for item_id, inserted_revision, is_deleted in db.session.execute(
+            select(log.c.item_id, log.c.inserted_revision, log.c.deleted)
+            .where(log.c.travel_plan_id == plan.id, log.c.revision > since)):
+        if not is_deleted:
+            live[item_id] = inserted_revision > since
+        elif inserted_revision <= since:  # Items added and deleted since then were never seen
+            deleted.append(item_id)
+
+    items = []
+    if live:
+        items = ItineraryItem.query.filter(
+            ItineraryItem.travel_plan_id == plan.id, ItineraryItem.id.in_(live)
+        ).order_by(ItineraryItem.day, ItineraryItem.minutes).all()
+    return {
+        'revision': revision,
+        'full': False,
+        'inserted': [item_data(item) for item in items if live[item.id]],
+        'updated': [item_data(item) for item in items if not live[item.id]],
+        'deleted': sorted(deleted),
+    }
+
+
+def _synced_changes(item):
+    state = inspect(item)
+    return any(state.attrs[attr].history.has_changes() for attr in SYNCED_ATTRS)
+
+
+@event.listens_for(db.session, 'after_flush')
+def log_item_changes(session, flush_context):
+    """Log the itinerary items written by the flush, one new revision per plan"""
+    changes = {}  # plan id -> (inserted, updated, deleted)
+
+    def add(plan_id, kind, item_id):
+        changes.setdefault(plan_id, (set(), set(), set()))[kind].add(item_id)
+
+    for obj in session.new:
+        if isinstance(obj, ItineraryItem):
+            add(obj.travel_plan_id, 0, obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, ItineraryItem) and _synced_changes(obj):
+            old_plan_ids = set(inspect(obj).attrs.travel_plan_id.history.deleted or ()) - {obj.travel_plan_id}
+            for old_plan_id in old_plan_ids:
+                add(old_plan_id, 2, obj.id)
+            add(obj.travel_plan_id, 0 if old_plan_ids else 1, obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, ItineraryItem):
+            add(obj.travel_plan_id, 2, obj.id)
+    if not changes:
+        return
+
+    deleted_plans = {obj.id for obj in session.deleted if isinstance(obj, TravelPlan)}
+    refreshed = session.info.setdefault('refreshed_plan_attrs', {})
+    connection = session.connection()
+    for plan_id, (inserted, updated, deleted) in changes.items():
+        if plan_id is None or plan_id in deleted_plans:
+            continue
+        if record_changes(connection, plan_id, inserted, updated, deleted) is not None:
+            refreshed.setdefault(plan_id, set()).update(('revision', 'change_floor'))
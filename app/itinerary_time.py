@@ -0,0 +1,82 @@
+"""Itinerary Time Module
+
+Itinerary times arrive in several shapes: "14:30" from ``<input type="time">``,
+"9:30 AM" from older rows, sometimes "9am" or "0930". Sorting those strings
+lexically puts "10:00" before "9:30" and "2:00 PM" before "9:00 AM".
+
+Each item therefore stores ``minutes`` (minutes since midnight, 0-1439),
+parsed once when the item is written, and the ``time`` text is rewritten to
+the canonical "HH:MM" form. Queries sort on ``(day, minutes)``, which the
+``ix_itinerary_item_plan_day_minutes`` index covers, and templates format
+the minutes for display. Text that cannot be parsed is kept as typed with
+no minutes.
+"""
+import re
+
+_TIME_PATTERN = re.compile(
+    r'^(?P<hour>\d{1,2})(?:[:.h]?(?P<minute>\d{2}))?(?::\d{2})?\s*(?P<period>[ap])?\.?\s*m?\.?$',
+    re.IGNORECASE
+)
+
+
+def parse_time(value):
+    """Parse a time of day into minutes since midnight
+
+    Returns:
+        int or None if the value is empty or not a recognizable time
+    """
+    if value is None:
+        return None
+    match = _TIME_PATTERN.match(str(value).strip())
+    if not match:
+        return None
+
+    hour = int(match.group('hour'))
+    minute = int(match.group('minute') or 0)
+    period = (match.group('period') or '').lower()
+
+    if period:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if period == 'p' else 0)
+    elif match.group('minute') is None:
+        # A bare number is only a time with a period ("9am"), not "9"
+        return None
+
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+
+def time_value(minutes):
+    """Canonical "HH:MM" text, as used by <input type="time">"""
+    if minutes is None:
+        return None
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def format_minutes(minutes, clock='12h'):
+    """Display text for minutes since midnight ("2:30 PM", or "14:30" for 24h)"""
+    if minutes is None:
+        return ''
+    if clock == '24h':
+        return time_value(minutes)
+    hour, minute = divmod(minutes, 60)
+    period = 'AM' if hour < 12 else 'PM'
+    return f'{hour % 12 or 12}:{minute:02d} {period}'
+
+
+def display_time(item):
+    """Display text for an itinerary item's time (falls back to the raw text)"""
+    if item.minutes is not None:
+        return format_minutes(item.minutes)
+    return item.time or ''
+
+
+def normalize_item_time(item):
+    """Set ``minutes`` from ``time`` and rewrite parsable text to "HH:MM" """
+    item.minutes = parse_time(item.time)
+    if item.minutes is not None:
+        item.time = time_value(item.minutes)
+    elif item.time is not None and not str(item.time).strip():
+        item.time = None
@@ -0,0 +1,21 @@
+from app import db
+from datetime import datetime
+
+class Destination(db.Model):
+    """Normalized destination shared by every plan that goes to the same place"""
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(160), unique=True, nullable=False)  # "city|country code"
+    name = db.Column(db.String(160), nullable=False)  # Canonical display name
+    city = db.Column(db.String(100))
+    city_key = db.Column(db.String(100), index=True)  # Lower-cased city for lookups
+    country = db.Column(db.String(100))
+    country_code = db.Column(db.String(2), index=True)  # ISO 3166-1 alpha-2
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Relationships
+    travel_plans = db.relationship('TravelPlan', backref='resolved_destination', lazy='dynamic')
+
+    def __repr__(self):
+        return f'<Destination {self.name}>'
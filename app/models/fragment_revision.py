@@ -0,0 +1,13 @@
+from app import db
+
+
+class FragmentRevision(db.Model):
+    """Revision of one data key of the fragment cache, shared by every worker
+
+    See app/fragment_cache.py for how these are maintained.
+    """
+    key = db.Column(db.String(100), primary_key=True)  # e.g. "plan_day:3:2"
+    revision = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<FragmentRevision {self.key}={self.revision}>'
@@ -1,7 +1,27 @@
-from app import db
+import os
+from app import app, db
 from datetime import datetime
+from sqlalchemy import delete, event, exists, func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+# Links between memories and tags; both sides go away with ON DELETE CASCADE
+memory_tags = db.Table(
+    'memory_tags',
+    db.Column('memory_id', db.Integer, db.ForeignKey('memory.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    # Memories with a given tag
+    db.Index('ix_memory_tags_tag_id_memory_id', 'tag_id', 'memory_id'),
+)
 
 class Memory(db.Model):
+    __table_args__ = (
+        # A user's memories ordered by visit date (index, timeline) or creation (dashboard)
+        db.Index('ix_memory_user_id_visit_date', 'user_id', 'visit_date'),
+        db.Index('ix_memory_user_id_created_at', 'user_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     location = db.Column(db.String(100))
@@ -14,9 +34,29 @@ class Memory(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
-    # Relationships
-    photos = db.relationship('Photo', backref='memory', lazy='dynamic', cascade="all, delete-orphan")
-    tags = db.relationship('MemoryTag', backref='memory', lazy='dynamic', cascade="all, delete-orphan")
+    # Relationships (children are removed by ON DELETE CASCADE, without loading them first)
+    photos = db.relationship('Photo', backref='memory', lazy='dynamic', cascade="all, delete-orphan",
+                             passive_deletes=True)
+    tags = db.relationship('Tag', secondary=memory_tags, lazy='dynamic', passive_deletes=True,
+                           order_by='Tag.normalized_name', backref=db.backref('memories', lazy='dynamic'))
+    
+    def set_tags(self, names):
+        """Make the memory's tags exactly ``names``, touching only the links that change
+        
+        Names are matched by their normalized form, so "Food" and " food" are
+        the same tag. Tags that do not exist yet are created; tags left without
+        memories are removed when the session flushes.
+        """
+        wanted = {normalize_tag(name) for name in names} - {''}
+        
+        current = {tag.normalized_name: tag for tag in self.tags} if self.id is not None else {}
+        for normalized, tag in current.items():
+            if normalized not in wanted:
+                self.tags.remove(tag)
+                db.session.info.setdefault('unlinked_tag_ids', set()).add(tag.id)
+        
+        for tag in ensure_tags(normalized for normalized in wanted if normalized not in current):
+            self.tags.append(tag)
     
     def __repr__(self):
         return f'<Memory {self.title}>'
@@ -26,15 +66,121 @@ class Photo(db.Model):
     filename = db.Column(db.String(100), nullable=False)
     caption = db.Column(db.String(200))
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
-    memory_id = db.Column(db.Integer, db.ForeignKey('memory.id'), nullable=False)
+    memory_id = db.Column(db.Integer, db.ForeignKey('memory.id', ondelete='CASCADE'), nullable=False, index=True)
     
     def __repr__(self):
         return f'<Photo {self.filename}>'
 
-class MemoryTag(db.Model):
+class Tag(db.Model):
+    """A tag shared by every memory that uses it, shown by its normalized name"""
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
-    memory_id = db.Column(db.Integer, db.ForeignKey('memory.id'), nullable=False)
+    normalized_name = db.Column(db.String(50), nullable=False, unique=True, index=True)  # See normalize_tag
     
     def __repr__(self):
-        return f'<MemoryTag {self.name}>'
+        return f'<Tag {self.normalized_name}>'
+
+_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+def normalize_tag(name):
+    """Lookup key of a tag name: trimmed, single-spaced and case-folded"""
+    return ' '.join((name or '').split()).casefold()[:50]
+
+def ensure_tags(normalized_names):
+    """Tags with the given normalized names, created if missing
+    
+    Saves running at the same time may create the same tag: the insert skips
+    names that exist by then (inside a savepoint per name on databases without
+    ON CONFLICT) and the rows are selected afterwards, whoever inserted them.
+    
+    Returns:
+        list of Tag
+    """
+    names = set(normalized_names)
+    if not names:
+        return []
+    tags = Tag.query.filter(Tag.normalized_name.in_(names)).all()
+    missing = sorted(names - {tag.normalized_name for tag in tags})
+    if missing:
+        connection = db.session.connection()
+        insert = _INSERTS.get(connection.dialect.name)
+        if insert is not None:
+            connection.execute(
+                insert(Tag.__table__).on_conflict_do_nothing(index_elements=['normalized_name']),
+                [{'normalized_name': name} for name in missing]
+            )
+        else:
+            for name in missing:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(Tag.__table__.insert().values(normalized_name=name))
+                except IntegrityError:
+                    pass  # Created by another save
+        tags += Tag.query.filter(Tag.normalized_name.in_(missing)).all()
+    return tags
+
+def tag_counts(user_id):
+    """A user's tags with the number of their memories using each, most used first
+    
+    Returns:
+        list of (Tag, count)
+    """
+    count = func.count(memory_tags.c.memory_id)
+    return (db.session.query(Tag, count)
+            .join(memory_tags, memory_tags.c.tag_id == Tag.id)
+            .join(Memory, Memory.id == memory_tags.c.memory_id)
+            .filter(Memory.user_id == user_id)
+            .group_by(Tag.id)
+            .order_by(count.desc(), Tag.normalized_name)
+            .all())
+
+def photo_path(filename):
+    """Location of an uploaded photo on disk"""
+    return os.path.join(app.static_folder, 'uploads', filename)
+
+@event.listens_for(db.session, 'before_flush')
+def collect_deleted_photo_files(session, flush_context, instances):
+    """Remember the files of photos about to be deleted, directly or by cascade"""
+    filenames = {obj.filename for obj in session.deleted if isinstance(obj, Photo)}
+    memory_ids = [obj.id for obj in session.deleted if isinstance(obj, Memory)]
+    if memory_ids:
+        # The rows go away with ON DELETE CASCADE, so read their names first
+        filenames.update(session.connection().execute(
+            select(Photo.filename).where(Photo.memory_id.in_(memory_ids))
+        ).scalars())
+    if filenames:
+        session.info.setdefault('deleted_photo_files', set()).update(filenames)
+
+@event.listens_for(db.session, 'after_commit')
+def remove_deleted_photo_files(session):
+    """Unlink photo files once their rows are gone for good"""
+    for filename in session.info.pop('deleted_photo_files', ()):
+        try:
+            os.remove(photo_path(filename))
+        except OSError:
+            pass  # File might not exist
+
+@event.listens_for(db.session, 'after_rollback')
+def keep_deleted_photo_files(session):
+    session.info.pop('deleted_photo_files', None)
+
+@event.listens_for(db.session, 'before_flush')
+def collect_unlinked_tags(session, flush_context, instances):
+    """Remember the tags of memories about to be deleted; their links go by cascade"""
+    memory_ids = [obj.id for obj in session.deleted if isinstance(obj, Memory)]
+    if memory_ids:
+        session.info.setdefault('unlinked_tag_ids', set()).update(session.connection().execute(
+            select(memory_tags.c.tag_id).where(memory_tags.c.memory_id.in_(memory_ids))
+        ).scalars())
+
+@event.listens_for(db.session, 'after_flush')
+def remove_orphaned_tags(session, flush_context):
+    """Delete tags that lost their last memory in this flush"""
+    tag_ids = session.info.pop('unlinked_tag_ids', None)
+    if tag_ids:
+        session.connection().execute(delete(Tag.__table__).where(
+            Tag.id.in_(tag_ids), ~exists().where(memory_tags.c.tag_id == Tag.id)
+        ))
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_unlinked_tags(session):
+    session.info.pop('unlinked_tag_ids', None)
@@ -0,0 +1,23 @@
+from app import db
+from datetime import datetime
+
+class StatDigest(db.Model):
+    """Serialized t-digest of one metric for a plan, user or destination
+
+    See app/distributions.py for how these are maintained.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'scope_id', 'metric', name='uq_stat_digest_scope_metric'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)  # plan, user or destination
+    scope_id = db.Column(db.Integer, nullable=False)
+    metric = db.Column(db.String(30), nullable=False)  # daily_spend, trip_duration, activity_cost
+    data = db.Column(db.Text, nullable=False)  # JSON centroids
+    count = db.Column(db.Integer, default=0)
+    stale = db.Column(db.Boolean, default=False, nullable=False)  # Needs re-merging from plan digests
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StatDigest {self.scope}:{self.scope_id} {self.metric}>'
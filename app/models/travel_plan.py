@@ -1,10 +1,24 @@
 from app import db
 from datetime import datetime
+from sqlalchemy import event, inspect, func, select
+from sqlalchemy.orm.util import identity_key
+from app.expense_categories import classify_activity
+from app.itinerary_time import normalize_item_time
+from app.destinations import resolve_destination
+from app.trending import record_destinations
+from app.distributions import refresh_plan_digests, mark_stale
 
 class TravelPlan(db.Model):
+    __table_args__ = (
+        # A user's plans ordered by date (planner index, dashboard)
+        db.Index('ix_travel_plan_user_id_start_date', 'user_id', 'start_date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     destination = db.Column(db.String(100), nullable=False)
+    # Normalized destination, resolved from the free text above on write
+    destination_id = db.Column(db.Integer, db.ForeignKey('destination.id'), index=True)
     dest_lat = db.Column(db.Float)  # 目的地纬度
     dest_lng = db.Column(db.Float)  # 目的地经度
     start_date = db.Column(db.DateTime, nullable=False)
@@ -14,32 +28,277 @@ class TravelPlan(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_public = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Denormalized from the itinerary items, kept up to date on every flush
+    # (see refresh_plan_totals below; `flask repair-plan-totals` recomputes them)
+    total_cost = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Geo summary of the items that have coordinates, refreshed the same way
+    geo_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    centroid_lat = db.Column(db.Float)
+    centroid_lng = db.Column(db.Float)
+    min_lat = db.Column(db.Float)
+    min_lng = db.Column(db.Float)
+    max_lat = db.Column(db.Float)
+    max_lng = db.Column(db.Float)
+    # Position in the itinerary change log (see app/itinerary_sync.py): the
+    # revision of the last item change, and the revision up to which deleted
+    # items were compacted out of the log
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    change_floor = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     # Relationships
-    itinerary_items = db.relationship('ItineraryItem', backref='travel_plan', lazy='dynamic', cascade="all, delete-orphan")
-    shared_with = db.relationship('PlanShare', backref='travel_plan', lazy='dynamic', cascade="all, delete-orphan")
+    # Children are removed by ON DELETE CASCADE, without loading them first
+    itinerary_items = db.relationship('ItineraryItem', backref='travel_plan', lazy='dynamic', cascade="all, delete-orphan",
+                                      passive_deletes=True, order_by='[ItineraryItem.day, ItineraryItem.minutes]')
+    shared_with = db.relationship('PlanShare', backref='travel_plan', lazy='dynamic', cascade="all, delete-orphan",
+                                  passive_deletes=True)
+    
+    @property
+    def bounds(self):
+        """Bounding box of the itinerary as [[south, west], [north, east]], or None"""
+        if not self.geo_count:
+            return None
+        return [[self.min_lat, self.min_lng], [self.max_lat, self.max_lng]]
+    
+    @property
+    def coordinates(self):
+        """Best known (lat, lng) of the trip: the destination, else the itinerary centroid"""
+        if self.dest_lat and self.dest_lng:
+            return self.dest_lat, self.dest_lng
+        if self.geo_count:
+            return self.centroid_lat, self.centroid_lng
+        return None
     
     def __repr__(self):
         return f'<TravelPlan {self.title}>'
 
+@event.listens_for(db.session, 'before_flush')
+def resolve_plan_destinations(session, flush_context, instances):
+    """Link new or edited plans to their normalized Destination"""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, TravelPlan):
+            continue
+        if obj.destination_id is not None \
+                and not inspect(obj).attrs.destination.history.has_changes():
+            continue
+        obj.resolved_destination = resolve_destination(
+            session, obj.destination, obj.dest_lat, obj.dest_lng
+        )
+
+@event.listens_for(db.session, 'after_flush')
+def collect_new_plan_destinations(session, flush_context):
+    """Remember destinations of inserted plans until the transaction commits"""
+    names = [
+        obj.resolved_destination.name for obj in session.new
+        if isinstance(obj, TravelPlan) and obj.resolved_destination is not None
+    ]
+    if names:
+        session.info.setdefault('new_plan_destinations', []).extend(names)
+
+@event.listens_for(db.session, 'after_commit')
+def feed_trending_destinations(session):
+    """Count committed plans in the trending destination sketches"""
+    names = session.info.pop('new_plan_destinations', None)
+    if names:
+        record_destinations(names)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_new_plan_destinations(session):
+    session.info.pop('new_plan_destinations', None)
+
 class ItineraryItem(db.Model):
+    __table_args__ = (
+        # A plan's itinerary in display order
+        db.Index('ix_itinerary_item_plan_day_minutes', 'travel_plan_id', 'day', 'minutes'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     day = db.Column(db.Integer, nullable=False)
-    time = db.Column(db.String(10))
+    time = db.Column(db.String(10))  # "HH:MM" when parsable, otherwise as typed
+    minutes = db.Column(db.SmallInteger)  # Minutes since midnight, used for sorting
     activity = db.Column(db.String(200), nullable=False)
     location = db.Column(db.String(100))
     lat = db.Column(db.Float)
     lng = db.Column(db.Float)
     cost = db.Column(db.Float)
     notes = db.Column(db.Text)
-    travel_plan_id = db.Column(db.Integer, db.ForeignKey('travel_plan.id'), nullable=False)
+    # Expense category, classified once at write time (see app/expense_categories.py)
+    category = db.Column(db.String(30), index=True)
+    category_overridden = db.Column(db.Boolean, default=False, nullable=False)
+    travel_plan_id = db.Column(db.Integer, db.ForeignKey('travel_plan.id', ondelete='CASCADE'), nullable=False)
     
     def __repr__(self):
         return f'<ItineraryItem {self.activity}>'
 
+@event.listens_for(ItineraryItem, 'before_insert')
+def classify_new_item(mapper, connection, item):
+    """Assign a category to new items unless the user chose one"""
+    if not item.category_overridden or not item.category:
+        item.category_overridden = False
+        item.category = classify_activity(item.activity)
+
+@event.listens_for(ItineraryItem, 'before_update')
+def reclassify_changed_item(mapper, connection, item):
+    """Reclassify when the activity text changes, keeping user overrides"""
+    if item.category_overridden and item.category:
+        return
+    if item.category is None or inspect(item).attrs.activity.history.has_changes():
+        item.category = classify_activity(item.activity)
+
+@event.listens_for(ItineraryItem, 'before_insert')
+def parse_new_item_time(mapper, connection, item):
+    """Parse the time of day once, at write time"""
+    normalize_item_time(item)
+
+@event.listens_for(ItineraryItem, 'before_update')
+def parse_changed_item_time(mapper, connection, item):
+    if inspect(item).attrs.time.history.has_changes():
+        normalize_item_time(item)
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+@event.listens_for(db.session, 'after_flush')
+def refresh_distribution_digests(session, flush_context):
+    """Rebuild the t-digests of plans whose dates or item costs were written"""
+    plan_ids = set()
+    user_ids, destination_ids = set(), set()
+    
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, ItineraryItem):
+            if obj in session.dirty and not _changed(obj, 'day', 'cost', 'travel_plan_id'):
+                continue
+            plan_ids.add(obj.travel_plan_id)
+            if obj in session.dirty:
+                plan_ids.update(inspect(obj).attrs.travel_plan_id.history.deleted or ())
+        elif isinstance(obj, TravelPlan):
+            if obj in session.dirty and not _changed(
+                    obj, 'start_date', 'end_date', 'destination_id', 'resolved_destination', 'user_id'):
+                continue
+            plan_ids.add(obj.id)
+            # The plan may have moved away from its old user or destination
+            user_ids.update(inspect(obj).attrs.user_id.history.deleted or ())
+            destination_ids.update(inspect(obj).attrs.destination_id.history.deleted or ())
+            for old in inspect(obj).attrs.resolved_destination.history.deleted or ():
+                if old is not None:
+                    destination_ids.add(old.id)
+            if obj in session.deleted:
+                user_ids.add(obj.user_id)
+                destination_ids.add(obj.destination_id)
+    
+    plan_ids.discard(None)
+    if not plan_ids:
+        return
+    
+    connection = session.connection()
+    refreshed_users, refreshed_destinations = refresh_plan_digests(connection, plan_ids)
+    mark_stale(connection, user_ids | refreshed_users, destination_ids | refreshed_destinations)
+
+def recompute_plan_totals(connection, plan_ids=None):
+    """Recompute total_cost and item_count from the itinerary items
+    
+    Args:
+        connection: Connection of the current transaction
+        plan_ids: Plans to recompute, or None for every plan
+    
+    Returns:
+        int: Number of plans updated
+    """
+    plans = TravelPlan.__table__
+    items = ItineraryItem.__table__
+    statement = plans.update().values(
+        total_cost=select(func.coalesce(func.sum(items.c.cost), 0))
+            .where(items.c.travel_plan_id == plans.c.id).scalar_subquery(),
+        item_count=select(func.count(items.c.id))
+            .where(items.c.travel_plan_id == plans.c.id).scalar_subquery()
+    )
+    if plan_ids is not None:
+        statement = statement.where(plans.c.id.in_(plan_ids))
+    return connection.execute(statement).rowcount
+
+def recompute_plan_geo(connection, plan_ids=None):
+    """Recompute the centroid and bounding box from the items with coordinates
+    
+    Args:
+        connection: Connection of the current transaction
+        plan_ids: Plans to recompute, or None for every plan
+    
+    Returns:
+        int: Number of plans updated
+    """
+    plans = TravelPlan.__table__
+    items = ItineraryItem.__table__
+    
+    def aggregate(function, column):
+        return select(function(column)).where(
+            items.c.travel_plan_id == plans.c.id,
+            items.c.lat.isnot(None), items.c.lng.isnot(None)
+        ).scalar_subquery()
+    
+    statement = plans.update().values(
+        geo_count=aggregate(func.count, items.c.id),
+        centroid_lat=aggregate(func.avg, items.c.lat),
+        centroid_lng=aggregate(func.avg, items.c.lng),
+        min_lat=aggregate(func.min, items.c.lat),
+        min_lng=aggregate(func.min, items.c.lng),
+        max_lat=aggregate(func.max, items.c.lat),
+        max_lng=aggregate(func.max, items.c.lng)
+    )
+    if plan_ids is not None:
+        statement = statement.where(plans.c.id.in_(plan_ids))
+    return connection.execute(statement).rowcount
+
+PLAN_TOTAL_ATTRS = ('total_cost', 'item_count')
+PLAN_GEO_ATTRS = ('geo_count', 'centroid_lat', 'centroid_lng', 'min_lat', 'min_lng', 'max_lat', 'max_lng')
+
+@event.listens_for(db.session, 'after_flush')
+def refresh_plan_totals(session, flush_context):
+    """Update the counters and geo summary of plans whose items were written"""
+    total_ids, geo_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, ItineraryItem):
+            continue
+        plan_ids = {obj.travel_plan_id}
+        plan_ids.update(inspect(obj).attrs.travel_plan_id.history.deleted or ())
+        if obj not in session.dirty or _changed(obj, 'cost', 'travel_plan_id'):
+            total_ids.update(plan_ids)
+        if obj not in session.dirty or _changed(obj, 'lat', 'lng', 'travel_plan_id'):
+            geo_ids.update(plan_ids)
+    
+    total_ids.discard(None)
+    geo_ids.discard(None)
+    if not (total_ids or geo_ids):
+        return
+    
+    refreshed = session.info.setdefault('refreshed_plan_attrs', {})
+    if total_ids:
+        recompute_plan_totals(session.connection(), total_ids)
+        for plan_id in total_ids:
+            refreshed.setdefault(plan_id, set()).update(PLAN_TOTAL_ATTRS)
+    if geo_ids:
+        recompute_plan_geo(session.connection(), geo_ids)
+        for plan_id in geo_ids:
+            refreshed.setdefault(plan_id, set()).update(PLAN_GEO_ATTRS)
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def expire_plan_totals(session, flush_context):
+    """Reload the recomputed columns of loaded plans on next access"""
+    for plan_id, attrs in session.info.pop('refreshed_plan_attrs', {}).items():
+        plan = session.identity_map.get(identity_key(TravelPlan, plan_id))
+        if plan is not None:
+            session.expire(plan, list(attrs))
+
 class PlanShare(db.Model):
+    __table_args__ = (
+        # Access checks for one plan and user
+        db.Index('ix_plan_share_plan_user_status', 'travel_plan_id', 'shared_user_id', 'status'),
+        # Plans shared with a user, and pending invitations
+        db.Index('ix_plan_share_user_status', 'shared_user_id', 'status'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
-    travel_plan_id = db.Column(db.Integer, db.ForeignKey('travel_plan.id'), nullable=False)
+    travel_plan_id = db.Column(db.Integer, db.ForeignKey('travel_plan.id', ondelete='CASCADE'), nullable=False)
     shared_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     status = db.Column(db.String(20), nullable=False, default='pending')
     can_edit = db.Column(db.Boolean, default=False)
@@ -49,3 +308,19 @@ class PlanShare(db.Model):
 
     def __repr__(self):
         return f'<PlanShare plan_id={self.travel_plan_id} user_id={self.shared_user_id} status={self.status}>'
+
+class ItineraryChange(db.Model):
+    """Latest change of one itinerary item of a plan, for delta sync (see app/itinerary_sync.py)"""
+    __table_args__ = (
+        # Changes of a plan after a revision
+        db.Index('ix_itinerary_change_plan_revision', 'travel_plan_id', 'revision'),
+    )
+    
+    travel_plan_id = db.Column(db.Integer, db.ForeignKey('travel_plan.id', ondelete='CASCADE'), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True)  # No foreign key: deletions are logged too
+    revision = db.Column(db.Integer, nullable=False)
+    inserted_revision = db.Column(db.Integer, nullable=False, default=0)  # 0 if added before the log
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    
+    def __repr__(self):
+        return f'<ItineraryChange plan_id={self.travel_plan_id} item_id={self.item_id} revision={self.revision}>'
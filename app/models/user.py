@@ -1,4 +1,5 @@
 from app import db
+from sqlalchemy import func
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
@@ -18,6 +19,19 @@ class User(UserMixin, db.Model):
     travel_plans = db.relationship('TravelPlan', backref='user', lazy='dynamic')
     memories = db.relationship('Memory', backref='user', lazy='dynamic')
     
+    @staticmethod
+    def find_by_email(email):
+        """Case-insensitive email lookup (uses ix_user_email_lower)
+
+        Older accounts may differ only by case; the exact match wins, then the
+        oldest account, so the same address always finds the same user.
+        """
+        if not email:
+            return None
+        email = email.strip()
+        return User.query.filter(func.lower(User.email) == email.lower()) \
+            .order_by((User.email == email).desc(), User.id).first()
+    
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
         
@@ -26,3 +40,6 @@ class User(UserMixin, db.Model):
         
     def __repr__(self):
         return f'<User {self.username}>'
+
+# Case-insensitive email lookups
+db.Index('ix_user_email_lower', func.lower(User.email))
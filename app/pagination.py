@@ -0,0 +1,156 @@
+"""Keyset Pagination Module
+
+Long listings (travel plans, memories, the memory timeline and the travel
+timeline API) are paged by seeking past the last row shown instead of
+loading every row or counting an OFFSET. Each page is one indexed range
+scan, however deep the user has scrolled.
+
+1. Rows are ordered by a sort column plus the primary key as a tie-breaker,
+   e.g. ``(visit_date, id)`` or ``(start_date, id)``
+2. The next page starts after the last row of the current one. Its sort
+   values travel in an opaque ``cursor`` token (URL-safe base64 JSON), used
+   by both the HTML views (``?cursor=...``) and the JSON endpoints
+3. NULLs in a nullable sort column sort lowest (SQLite's behaviour): first
+   when ascending, last when descending. They are read as a separate
+   segment ordered by id, so every query keeps a plain index-friendly
+   ``WHERE`` clause on every database
+"""
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class KeysetPage:
+    """One page of rows and the cursor of the page after it"""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+
+def page_size(requested=None):
+    """Rows per page, from ``?limit=`` when given, capped at MAX_PAGE_SIZE"""
+    default = current_app.config.get('PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    try:
+        size = int(requested) if requested not in (None, '') else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, current_app.config.get('MAX_PAGE_SIZE', MAX_PAGE_SIZE)))
+
+
+def encode_cursor(column, value, row_id):
+    """Cursor token for the row with sort ``value`` and primary key ``row_id``"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([column.key, value, row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(column, token):
+    """Sort value and primary key stored in a cursor token
+
+    Raises:
+        ValueError: If the token is malformed or was made for another sort
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        key, value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if key != column.key or not isinstance(row_id, int):
+            raise ValueError
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError, json.JSONDecodeError):
+        raise ValueError('Invalid pagination cursor')
+    return value, row_id
+
+
+def _seek(column, id_column, value, row_id, descending):
+    """Rows strictly after (value, row_id), written so an index range applies"""
+    if descending:
+        return and_(column <= value, or_(column < value, id_column < row_id))
+    return and_(column >= value, or_(column > value, id_column > row_id))
+
+
+def keyset_page(query, column, id_column, cursor=None, limit=None, descending=False):
+    """Fetch one page of ``query`` ordered by ``(column, id_column)``
+
+    Args:
+        query: Filtered query without an ORDER BY
+        column: Sort column
+        id_column: Unique tie-breaker (the primary key)
+        cursor: Token of the previous page, or None for the first page
+        limit: Rows per page (see page_size)
+        descending: Sort direction
+
+    Returns:
+        KeysetPage
+
+    Raises:
+        ValueError: If the cursor is invalid
+    """
+    limit = page_size(limit)
+    after = decode_cursor(column, cursor) if cursor else None
+
+    # NULLs sort lowest, so they come last when descending and first when ascending
+    segments = ['values']
+    if column.nullable:
+        segments = ['values', 'nulls'] if descending else ['nulls', 'values']
+    if after is not None:
+        segments = segments[segments.index('nulls' if after[0] is None else 'values'):]
+
+    id_order = id_column.desc() if descending else id_column.asc()
+    rows = []
+    for segment in segments:
+        if segment == 'nulls':
+            segment_query = query.filter(column.is_(None)).order_by(id_order)
+            if after is not None:
+                segment_query = segment_query.filter(
+                    id_column < after[1] if descending else id_column > after[1]
+                )
+        else:
+            segment_query = query.filter(column.isnot(None)).order_by(
+                column.desc() if descending else column.asc(), id_order
+            )
+            if after is not None:
+                segment_query = segment_query.filter(
+                    _seek(column, id_column, after[0], after[1], descending)
+                )
+        rows.extend(segment_query.limit(limit + 1 - len(rows)).all())
+        if len(rows) > limit:
+            break
+        # The next segment is read from its start
+        after = None
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(column, getattr(last, column.key), getattr(last, id_column.key))
+    return KeysetPage(rows, next_cursor)
+
+
+def next_page_url(page, **overrides):
+    """URL of the page after ``page`` for the current endpoint, or None"""
+    if not page.has_more:
+        return None
+    args = request.args.to_dict()
+    args.pop('xhr', None)
+    args.update(overrides)
+    args['cursor'] = page.next_cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+
+def wants_fragment():
+    """Whether an infinite-scroll request asked for the next rows only (``?xhr=true``)"""
+    return request.args.get('xhr', '').lower() in ('1', 'true')
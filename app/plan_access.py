@@ -0,0 +1,144 @@
+"""Plan Access Module
+
+One place to decide what the current user may do with a travel plan,
+instead of loading the plan and then querying its shares in every route:
+
+1. ``plan_access(plan_id)`` loads the plan together with the user's accepted
+   share (if any) in one query, outer-joined on
+   ix_plan_share_plan_user_status, and returns a ``PlanAccess``
+2. Results are memoized for the rest of the request, per plan, so the
+   decorator and the view (or several helpers) share one query
+3. ``@plan_access_required(capability)`` checks the capability before the
+   view runs: ``view`` (owner, accepted share or public plan), ``edit``
+   (owner or accepted share with can_edit) or ``own``. The view then gets
+   the plan with ``plan_access(plan_id).plan`` without another query
+
+Missing plans are a 404. Refusals are a 403 JSON error by default; pages
+flash the message and redirect, and streams get a plain 403.
+"""
+from functools import wraps
+
+from flask import abort, flash, g, has_request_context, jsonify, redirect, url_for
+from flask_login import current_user
+from sqlalchemy import and_, select
+
+from app import db
+from app.models.travel_plan import PlanShare, TravelPlan
+
+CAPABILITIES = ('view', 'edit', 'own')
+RESPONSES = ('json', 'page', 'abort')
+
+
+class PlanAccess:
+    """A plan and what one user may do with it"""
+
+    def __init__(self, plan, user_id=None, share=None):
+        self.plan = plan
+        self.user_id = user_id
+        self.share = share  # The user's accepted PlanShare, if any
+
+    @property
+    def is_owner(self):
+        return self.user_id is not None and self.plan.user_id == self.user_id
+
+    @property
+    def can_view(self):
+        return self.is_owner or self.share is not None or bool(self.plan.is_public)
+
+    @property
+    def can_edit(self):
+        return self.is_owner or (self.share is not None and bool(self.share.can_edit))
+
+    def allows(self, capability):
+        """Whether the user has ``capability`` ('view', 'edit' or 'own')"""
+        if capability not in CAPABILITIES:
+            raise ValueError(f'Unknown capability "{capability}"; use one of {", ".join(CAPABILITIES)}')
+        return {'view': self.can_view, 'edit': self.can_edit, 'own': self.is_owner}[capability]
+
+
+def load_plan_access(plan_id, user_id):
+    """PlanAccess of a user to a plan from one query, or None if there is no such plan"""
+    share_join = and_(PlanShare.travel_plan_id == TravelPlan.id,
+                      PlanShare.shared_user_id == user_id,
+                      PlanShare.status == 'accepted')
+    row = db.session.execute(
+        select(TravelPlan, PlanShare).outerjoin(PlanShare, share_join)
+        .where(TravelPlan.id == plan_id)
+        .order_by(PlanShare.can_edit.desc())  # Duplicate shares: the most permissive
+        .limit(1)
+    ).first()
+    if row is None:
+        return None
+    plan, share = row
+    return PlanAccess(plan, user_id, share)
+
+
+def _current_user_id():
+    return current_user.id if current_user and current_user.is_authenticated else None
+
+
+def plan_access(plan_id):
+    """PlanAccess of the current user to a plan, memoized per request; None if there is no plan"""
+    if not has_request_context():
+        return load_plan_access(plan_id, None)
+    user_id = _current_user_id()
+    cache = g.setdefault('plan_access', {})
+    key = (plan_id, user_id)
+    if key not in cache:
+        cache[key] = load_plan_access(plan_id, user_id)
+    return cache[key]
+
+
+def forget_plan_access(plan_id=None):
+    """Drop memoized access (of one plan, or all), e.g. after changing its shares"""
+    if not has_request_context():
+        return
+    cache = g.get('plan_access')
+    if cache:
+        for key in [key for key in cache if plan_id is None or key[0] == plan_id]:
+            del cache[key]
+
+
+def _denied(access, capability, message, response):
+    if response == 'abort':
+        abort(403)
+    if response == 'page':
+        flash(message, 'danger')
+        # Users who can see the plan go back to it; others to their plans
+        if capability != 'view' and access.can_view:
+            return redirect(url_for('planner.view_plan', plan_id=access.plan.id))
+        return redirect(url_for('planner.index'))
+    return jsonify({'success': False, 'message': message}), 403
+
+
+def plan_access_required(capability='view', message=None, response='json'):
+    """Only let users with ``capability`` on the ``plan_id`` plan into a view
+
+    Args:
+        capability: 'view', 'edit' or 'own'
+        message: Shown to refused users
+        response: How to refuse: 'json' (403 error), 'page' (flash and
+            redirect) or 'abort' (plain 403)
+    """
+    if capability not in CAPABILITIES:
+        raise ValueError(f'Unknown capability "{capability}"; use one of {", ".join(CAPABILITIES)}')
+    if response not in RESPONSES:
+        raise ValueError(f'Unknown response "{response}"; use one of {", ".join(RESPONSES)}')
+    if message is None:
+        message = {
+            'view': 'You do not have permission to access this plan',
+            'edit': 'You do not have permission to edit this plan',
+            'own': 'You do not have permission to modify this plan',
+        }[capability]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            access = plan_access(kwargs['plan_id'])
+            if access is None:
+                abort(404)
+            if not access.allows(capability):
+                return _denied(access, capability, message, response)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,263 @@
+"""Plan Events Module
+
+Pushes itinerary changes to everyone who has a plan open, as Server-Sent
+Events, so collaborators on a shared plan see each other's edits without
+reloading or polling:
+
+1. When a transaction that changed a plan's items commits, the plan's new
+   revision (see app.itinerary_sync) is published on the plan's channel
+2. Publishing goes through a backend. ``memory`` (the default) delivers to
+   the subscribers of this process only. ``file`` is a stand-in for a broker
+   such as Redis pub/sub, for several worker processes on one host: events
+   are appended to ``PLAN_EVENTS_FILE`` and every process tails it. Other
+   backends can be installed with ``set_backend``
+3. Each open stream is a subscription to the in-process hub. An event only
+   wakes the stream up; it then sends everything that changed since the last
+   revision it sent, so bursts of events are coalesced and none are lost
+4. Event ids are plan revisions. A reconnecting browser sends the last one
+   as ``Last-Event-ID`` and gets the changes it missed, or a ``reset`` event
+   if the change log no longer has them. Comments are sent as heartbeats,
+   and streams end after ``MAX_STREAM_SECONDS`` so the browser reconnects
+   (and its permissions are checked again)
+
+Streams hold a worker thread while open, so the server must run threaded or
+with async workers.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import event
+
+from app import app, db
+from app.itinerary_sync import changes_since
+from app.models.travel_plan import TravelPlan
+
+HEARTBEAT_SECONDS = 15
+MAX_STREAM_SECONDS = 600
+RETRY_MILLISECONDS = 3000
+FILE_POLL_SECONDS = 0.2
+
+
+class Subscription:
+    """One listener on a channel; events only need to wake it up, so they are coalesced"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._wakeups = queue.Queue(maxsize=1)
+
+    def notify(self):
+        try:
+            self._wakeups.put_nowait(True)
+        except queue.Full:
+            pass  # Already woken up
+
+    def wait(self, timeout):
+        """True if an event arrived within ``timeout`` seconds"""
+        try:
+            return self._wakeups.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+
+class Hub:
+    """In-process subscriptions by channel"""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def deliver(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+class MemoryBackend:
+    """Delivers events to the subscribers of this process"""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, channel, message):
+        self.hub.deliver(channel, message)
+
+    def close(self):
+        pass
+
+
+class FileBackend:
+    """Shares events between the processes of one host through an append-only file
+
+    Every process appends one JSON line per event and tails the file in a
+    background thread, delivering what it reads (its own events included) to
+    its hub. Lines are written with a single O_APPEND write, so they do not
+    interleave. The file can be truncated at any time.
+    """
+
+    def __init__(self, hub, path, poll_seconds=FILE_POLL_SECONDS):
+        self.hub = hub
+        self.path = path
+        self.poll_seconds = poll_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._position = os.path.getsize(path)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._tail, name='plan-events-tail', daemon=True)
+        self._thread.start()
+
+    def publish(self, channel, message):
+        line = json.dumps({'channel': channel, 'message': message}, separators=(',', ':')) + '\n'
+        os.write(self._fd, line.encode('utf-8'))
+
+    def _tail(self):
+        buffer = b''
+        while not self._stopped.wait(self.poll_seconds):
+            try:
+                with open(self.path, 'rb') as events:
+                    events.seek(0, os.SEEK_END)
+                    if events.tell() < self._position:
+                        self._position, buffer = 0, b''  # Truncated
+                    events.seek(self._position)
+                    buffer += events.read()
+                    self._position = events.tell()
+            except OSError:
+                continue
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                    self.hub.deliver(record['channel'], record['message'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._fd)
+
+
+def _file_backend(hub):
+    path = (app.config.get('PLAN_EVENTS_FILE') or os.environ.get('PLAN_EVENTS_FILE')
+            or os.path.join(app.instance_path, 'plan_events.log'))
+    return FileBackend(hub, path)
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'file': _file_backend,
+}
+
+hub = Hub()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """The configured backend (PLAN_EVENTS_BACKEND: memory or file), created on first use"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = app.config.get('PLAN_EVENTS_BACKEND') or os.environ.get('PLAN_EVENTS_BACKEND') or 'memory'
+            if name not in BACKENDS:
+                raise ValueError(f'Unknown PLAN_EVENTS_BACKEND "{name}"; use one of {", ".join(BACKENDS)}')
+            _backend = BACKENDS[name](hub)
+        return _backend
+
+
+def set_backend(new_backend):
+    """Replace the backend (None: the configured one on next use); the old one is closed"""
+    global _backend
+    with _backend_lock:
+        old, _backend = _backend, new_backend
+    if old is not None:
+        old.close()
+
+
+def publish(plan_id, revision):
+    backend().publish(plan_id, {'plan_id': plan_id, 'revision': revision})
+
+
+@event.listens_for(db.session, 'after_commit')
+def publish_plan_revisions(session):
+    for plan_id, revision in session.info.pop('plan_revisions', {}).items():
+        try:
+            publish(plan_id, revision)
+        except Exception:
+            app.logger.exception('Could not publish plan %s revision %s', plan_id, revision)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_plan_revisions(session):
+    session.info.pop('plan_revisions', None)
+
+
+def _event(name, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {name}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream(plan_id, last_event_id=None):
+    """Server-Sent Events text of a plan's itinerary changes
+
+    Events: ``ready`` (the current revision, on a fresh connection),
+    ``changes`` (a delta as from itinerary_sync.changes_since, plus ``since``),
+    ``reset`` (the missed changes are gone; reload the itinerary) and
+    ``deleted`` (the plan was deleted; the stream ends).
+    """
+    # Subscribe before reading the revision, so no commit falls in between
+    subscription = hub.subscribe(plan_id)
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        deadline = time.monotonic() + MAX_STREAM_SECONDS
+        sent = last_event_id
+        woken = True
+        while True:
+            if woken:
+                plan = db.session.get(TravelPlan, plan_id, populate_existing=True)
+                if plan is None:
+                    yield _event('deleted', {'plan_id': plan_id})
+                    return
+                if sent is None:
+                    sent = plan.revision
+                    yield _event('ready', {'revision': sent}, sent)
+                elif plan.revision != sent:
+                    changes = changes_since(plan, sent)
+                    if changes is None:
+                        yield _event('reset', {'revision': plan.revision}, plan.revision)
+                    else:
+                        yield _event('changes', dict(changes, since=sent), plan.revision)
+                    sent = plan.revision
+                # Do not hold a connection (or a read transaction) while waiting
+                db.session.close()
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            woken = subscription.wait(min(HEARTBEAT_SECONDS, remaining))
+            if not woken:
+                yield ': heartbeat\n\n'
+    finally:
+        hub.unsubscribe(subscription)
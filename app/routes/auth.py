@@ -12,7 +12,7 @@ def register():
     """User registration page"""
     if request.method == 'POST':
         username = request.form.get('username')
-        email = request.form.get('email')
+        email = (request.form.get('email') or '').strip()
         password = request.form.get('password')
         confirm_password = request.form.get('confirm_password')
         
@@ -39,7 +39,8 @@ def register():
             flash('Username already exists', 'danger')
             return render_template('auth/register.html')
             
-        if User.query.filter_by(email=email).first():
+        # Case variants of a registered address are the same address
+        if User.find_by_email(email):
             flash('Email already registered', 'danger')
             return render_template('auth/register.html')
             
@@ -63,7 +64,7 @@ def login():
         remember = 'remember' in request.form
         
         # Find user by email
-        user = User.query.filter_by(email=email).first()
+        user = User.find_by_email(email)
         
         # Check password
         if user and user.check_password(password):
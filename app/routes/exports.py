@@ -0,0 +1,31 @@
+from datetime import date
+
+from flask import Blueprint, Response, stream_with_context
+from flask_login import login_required, current_user
+from app import exports
+
+exports_bp = Blueprint('exports', __name__, url_prefix='/export')
+
+
+def _download(chunks, mimetype, filename):
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@exports_bp.route('/<any(plans, items, memories, tags, photos):dataset>.<any(ndjson, csv):file_format>')
+@login_required
+def export_dataset(dataset, file_format):
+    """One of the user's datasets as NDJSON or CSV, streamed as it is read"""
+    chunks = exports.export_chunks(exports.DATASETS[dataset], current_user.id, file_format)
+    return _download(chunks, exports.FORMATS[file_format],
+                     f'{dataset}-{date.today().isoformat()}.{file_format}')
+
+
+@exports_bp.route('/archive.zip')
+@login_required
+def export_archive():
+    """ZIP archive of all the user's data and memory photos"""
+    return _download(exports.archive_chunks(current_user.id), 'application/zip',
+                     f'travel-export-{date.today().isoformat()}.zip')
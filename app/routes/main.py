@@ -1,7 +1,9 @@
 from flask import Blueprint, render_template, redirect, url_for
 from flask_login import current_user, login_required
+from app.db_routing import read_replica
 from app.models.travel_plan import TravelPlan
 from app.models.memory import Memory
+from app.trending import trending_destinations
 from datetime import datetime
 from sqlalchemy import func
 
@@ -14,28 +16,34 @@ def index():
 
 @main_bp.route('/dashboard')
 @login_required
+@read_replica
 def dashboard():
     """Dashboard view showing both travel plans and memories"""
-    # Get upcoming travel plans (where start_date is in the future)
+    # The trip and memory queries are passed unexecuted: the template runs
+    # them inside cached fragments, so they only hit the database on a miss
     upcoming_trips = TravelPlan.query.filter_by(user_id=current_user.id).filter(
         TravelPlan.start_date >= datetime.utcnow()
-    ).order_by(TravelPlan.start_date).limit(6).all()
+    ).order_by(TravelPlan.start_date).limit(6)
     
     # Count unique destinations
     destinations = TravelPlan.query.filter_by(user_id=current_user.id).with_entities(
-        func.count(func.distinct(TravelPlan.destination))
+        func.count(func.distinct(TravelPlan.destination_id))
     ).scalar() or 0
     
     # Get recent memories
     recent_memories = Memory.query.filter_by(user_id=current_user.id).order_by(
         Memory.created_at.desc()
-    ).limit(6).all()
+    ).limit(6)
+    
+    # Most planned destinations across all users this week
+    trending = trending_destinations('week', limit=5)
     
     return render_template(
         'dashboard.html',
-        upcoming_trips=upcoming_trips,
-        recent_memories=recent_memories,
-        destinations=destinations
+        upcoming_trips_query=upcoming_trips,
+        recent_memories_query=recent_memories,
+        destinations=destinations,
+        trending=trending
     )
 
 @main_bp.route('/about')
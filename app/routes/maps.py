@@ -0,0 +1,196 @@
+from io import BytesIO
+
+from flask import Blueprint, abort, jsonify, request, send_file, url_for
+from flask_login import login_required, current_user
+from sqlalchemy import or_, select
+from app import clustering, heatmap
+from app.db_routing import read_replica
+from app.models.memory import Memory
+from app.models.travel_plan import TravelPlan, ItineraryItem, PlanShare
+from app.spatial import (BoundingBox, MEMORY_POINTS, ITEM_POINTS, MAX_RADIUS_KM,
+                         in_bbox, within_radius)
+
+maps_bp = Blueprint('maps', __name__, url_prefix='/maps')
+
+MAX_POINTS = 2000  # Per layer; zoomed-out views should use clusters instead
+LAYERS = ('memories', 'items')
+CLUSTER_LAYERS = LAYERS + ('plans',)
+MAX_CLUSTERS = 2000
+MAX_ZOOM = 24
+
+
+def _requested_layers(available=LAYERS):
+    layer = request.args.get('layer', 'all')
+    return LAYERS if layer == 'all' else tuple(name for name in available if name == layer)
+
+
+def _memory_query():
+    return Memory.query.filter(Memory.user_id == current_user.id)
+
+
+def _item_query():
+    """Itinerary items of plans the user owns or accepted a share of (optionally one plan)"""
+    shared_plan_ids = select(PlanShare.travel_plan_id).where(
+        PlanShare.shared_user_id == current_user.id, PlanShare.status == 'accepted'
+    )
+    query = ItineraryItem.query.join(TravelPlan, TravelPlan.id == ItineraryItem.travel_plan_id).filter(
+        or_(TravelPlan.user_id == current_user.id, TravelPlan.id.in_(shared_plan_ids))
+    )
+    plan_id = request.args.get('plan_id', type=int)
+    if plan_id is not None:
+        query = query.filter(ItineraryItem.travel_plan_id == plan_id)
+    return query
+
+
+def memory_point(memory):
+    return {
+        'type': 'memory',
+        'id': memory.id,
+        'lat': memory.lat,
+        'lng': memory.lng,
+        'title': memory.title,
+        'location': memory.location,
+        'url': url_for('memories.view_memory', memory_id=memory.id)
+    }
+
+
+def item_point(item):
+    return {
+        'type': 'item',
+        'id': item.id,
+        'lat': item.lat,
+        'lng': item.lng,
+        'title': item.activity,
+        'location': item.location,
+        'plan_id': item.travel_plan_id,
+        'day': item.day,
+        'url': url_for('planner.view_plan', plan_id=item.travel_plan_id)
+    }
+
+
+@maps_bp.route('/api/points')
+@login_required
+@read_replica
+def points_in_view():
+    """Memories and itinerary items inside a map view
+
+    Query parameters:
+        bbox: "west,south,east,north", as from Leaflet's getBounds().toBBoxString()
+        layer: memories, items or all (default)
+        plan_id: Only the items of this plan
+    """
+    try:
+        bbox = BoundingBox.parse(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    points, truncated = [], False
+    layers = _requested_layers()
+    if 'memories' in layers:
+        rows = in_bbox(_memory_query(), Memory, MEMORY_POINTS, bbox) \
+            .order_by(Memory.id).limit(MAX_POINTS + 1).all()
+        truncated = truncated or len(rows) > MAX_POINTS
+        points.extend(memory_point(memory) for memory in rows[:MAX_POINTS])
+    if 'items' in layers:
+        rows = in_bbox(_item_query(), ItineraryItem, ITEM_POINTS, bbox) \
+            .order_by(ItineraryItem.id).limit(MAX_POINTS + 1).all()
+        truncated = truncated or len(rows) > MAX_POINTS
+        points.extend(item_point(item) for item in rows[:MAX_POINTS])
+
+    return jsonify({'success': True, 'points': points, 'count': len(points), 'truncated': truncated})
+
+
+@maps_bp.route('/api/nearby')
+@login_required
+@read_replica
+def points_nearby():
+    """Memories and itinerary items within a radius of a point, nearest first
+
+    Query parameters:
+        lat, lng: Center
+        radius: Radius in kilometers (default 10, at most MAX_RADIUS_KM)
+        layer, plan_id: As for /api/points
+    """
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', 10, type=float)
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return jsonify({'success': False, 'message': 'lat and lng are required'}), 400
+    if not 0 < radius <= MAX_RADIUS_KM:
+        return jsonify({'success': False, 'message': f'radius must be between 0 and {MAX_RADIUS_KM} km'}), 400
+
+    nearby = []
+    layers = _requested_layers()
+    if 'memories' in layers:
+        nearby.extend((memory_point(memory), distance) for memory, distance
+                      in within_radius(_memory_query(), Memory, MEMORY_POINTS, lat, lng, radius))
+    if 'items' in layers:
+        nearby.extend((item_point(item), distance) for item, distance
+                      in within_radius(_item_query(), ItineraryItem, ITEM_POINTS, lat, lng, radius))
+
+    nearby.sort(key=lambda pair: pair[1])
+    points = [dict(point, distance_km=round(distance, 3)) for point, distance in nearby[:MAX_POINTS]]
+    return jsonify({'success': True, 'points': points, 'count': len(points),
+                    'truncated': len(nearby) > MAX_POINTS})
+
+
+@maps_bp.route('/api/clusters')
+@login_required
+@read_replica
+def clusters_in_view():
+    """Clusters of memories, itinerary items or trip destinations inside a map view
+
+    Query parameters:
+        bbox: "west,south,east,north", as from Leaflet's getBounds().toBBoxString()
+        zoom: Map zoom level, as from Leaflet's getZoom()
+        layer: memories, items, plans, or all (default; memories and items)
+
+    Each cluster has its centroid, count (in total and per point type), up to
+    clustering.MAX_REPRESENTATIVES ids and the zoom level at which it splits
+    (null if its points can not be told apart).
+    """
+    try:
+        bbox = BoundingBox.parse(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    zoom = request.args.get('zoom', type=float)
+    if zoom is None or not 0 <= zoom <= MAX_ZOOM:
+        return jsonify({'success': False, 'message': f'zoom must be between 0 and {MAX_ZOOM}'}), 400
+    layers = _requested_layers(CLUSTER_LAYERS)
+    if not layers:
+        return jsonify({'success': False, 'message': 'Unknown layer'}), 400
+
+    found = clustering.hierarchy_for(current_user.id, layers).clusters(bbox, zoom)
+    return jsonify({
+        'success': True,
+        'zoom': min(int(zoom), clustering.MAX_CLUSTER_ZOOM),
+        'clusters': [cluster.to_dict() for cluster in found[:MAX_CLUSTERS]],
+        'count': sum(cluster.count for cluster in found),
+        'truncated': len(found) > MAX_CLUSTERS
+    })
+
+
+@maps_bp.route('/heatmap/<int:z>/<int:x>/<int:y>.png')
+@login_required
+@read_replica
+def heatmap_tile(z, x, y):
+    """Density heatmap tile of the user's memories and itinerary items
+
+    Query parameters:
+        layer: memories, items or all (default)
+    """
+    layers = _requested_layers()
+    if not layers or not heatmap.valid_tile(z, x, y):
+        abort(404)
+
+    rendered = heatmap.tile(current_user.id, layers, z, x, y)
+    if rendered is None:
+        response = send_file(BytesIO(heatmap.empty_tile()), mimetype='image/png', etag='empty', max_age=0)
+    else:
+        path, fingerprint = rendered
+        response = send_file(path, mimetype='image/png', etag=fingerprint, max_age=0)
+    # Tiles show one user's data; browsers revalidate them with the fingerprint ETag
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -1,19 +1,81 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app, current_app, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from app import db
+from app.db_routing import read_replica
+from app.pagination import keyset_page, next_page_url, wants_fragment
+from app.search import MEMORY_INDEX, next_results_url, paginate_results, query_words, ranked
 import os
 from datetime import datetime
-from app.models.memory import Memory, Photo, MemoryTag
+from app.models.memory import Memory, Photo, Tag, memory_tags, normalize_tag, tag_counts
 
 memories_bp = Blueprint('memories', __name__, url_prefix='/memories')
 
+# Sort options of the memories page: (sort column, descending); ties are broken by id
+MEMORY_SORTS = {
+    'date-desc': (Memory.visit_date, True),
+    'date-asc': (Memory.visit_date, False),
+    'rating-desc': (Memory.emotional_rating, True),
+    'location': (Memory.location, False),
+}
+
 @memories_bp.route('/')
 @login_required
+@read_replica
 def index():
     """Memories main page showing user's travel memories"""
-    memories = Memory.query.filter_by(user_id=current_user.id).order_by(Memory.visit_date.desc()).all()
-    return render_template('memories/index.html', memories=memories)
+    query = Memory.query.filter_by(user_id=current_user.id)
+    
+    location = request.args.get('location', '').strip()
+    if location:
+        query = query.filter(Memory.location.ilike(f'%{location}%'))
+    tag = request.args.get('tag', '').strip()
+    if tag:
+        # One indexed lookup of the tag, then its links on (tag_id, memory_id)
+        tag_id = db.session.query(Tag.id).filter_by(normalized_name=normalize_tag(tag)).scalar()
+        query = query.join(memory_tags, memory_tags.c.memory_id == Memory.id) \
+                     .filter(memory_tags.c.tag_id == tag_id)
+    
+    sort_column, descending = MEMORY_SORTS.get(request.args.get('sort'), MEMORY_SORTS['date-desc'])
+    try:
+        page = keyset_page(query, sort_column, Memory.id, cursor=request.args.get('cursor'),
+                           limit=request.args.get('limit'), descending=descending)
+    except ValueError:
+        abort(400)
+    
+    if wants_fragment():
+        return jsonify({
+            'success': True,
+            'html': render_template('memories/_memory_cards.html', memories=page.items),
+            'next_cursor': page.next_cursor,
+            'next_url': next_page_url(page)
+        })
+    return render_template('memories/index.html', memories=page.items, next_url=next_page_url(page),
+                           tag_counts=tag_counts(current_user.id), active_tag=normalize_tag(tag))
+
+@memories_bp.route('/search')
+@login_required
+@read_replica
+def search():
+    """Search the user's memories by title, location, description and tags, best match first"""
+    search_query = request.args.get('q', '').strip()
+    words = query_words(search_query)
+    if not words:
+        return redirect(url_for('memories.index'))
+
+    query = ranked(Memory.query.filter_by(user_id=current_user.id), Memory, MEMORY_INDEX, words)
+    results = paginate_results(query, request.args.get('page'), request.args.get('limit'))
+    next_url = next_results_url(results)
+
+    if wants_fragment():
+        return jsonify({
+            'success': True,
+            'html': render_template('memories/_memory_cards.html', memories=results.items),
+            'total_count': results.total_count,
+            'next_url': next_url
+        })
+    return render_template('memories/index.html', memories=results.items, next_url=next_url,
+                           search_query=search_query, total_count=results.total_count)
 
 @memories_bp.route('/create', methods=['GET', 'POST'])
 @login_required
@@ -52,11 +114,7 @@ def create_memory():
         db.session.flush()  # Get the memory ID for relationships
         
         # Add tags
-        for tag_name in tags:
-            tag_name = tag_name.strip()
-            if tag_name:
-                tag = MemoryTag(name=tag_name, memory_id=memory.id)
-                db.session.add(tag)
+        memory.set_tags(tags)
         
         # Handle photo uploads
         if 'photos' in request.files:
@@ -124,17 +182,8 @@ def edit_memory(memory_id):
         memory.emotional_rating = int(request.form.get('emotional_rating', 3))
         memory.is_public = 'is_public' in request.form
         
-        # Update tags
-        # First remove existing tags
-        MemoryTag.query.filter_by(memory_id=memory.id).delete()
-        
-        # Then add new tags
-        tags = request.form.get('tags', '').split(',')
-        for tag_name in tags:
-            tag_name = tag_name.strip()
-            if tag_name:
-                tag = MemoryTag(name=tag_name, memory_id=memory.id)
-                db.session.add(tag)
+        # Update tags (only added and removed tags are written)
+        memory.set_tags(request.form.get('tags', '').split(','))
         
         # Handle photo uploads
         if 'photos' in request.files:
@@ -163,7 +212,7 @@ def edit_memory(memory_id):
         return redirect(url_for('memories.view_memory', memory_id=memory.id))
         
     # Get existing tags as comma-separated string
-    tags = [tag.name for tag in memory.tags]
+    tags = [tag.normalized_name for tag in memory.tags]
     tags_string = ', '.join(tags)
     
     return render_template('memories/edit.html', memory=memory, tags_string=tags_string)
@@ -179,13 +228,7 @@ def delete_memory(memory_id):
         flash('You do not have permission to delete this memory', 'danger')
         return redirect(url_for('memories.index'))
         
-    # Delete associated photos from filesystem
-    for photo in memory.photos:
-        try:
-            os.remove(os.path.join(current_app.static_folder, 'uploads', photo.filename))
-        except:
-            pass  # File might not exist
-            
+    # Photos and tags are removed by the database; their files after the commit
     db.session.delete(memory)
     db.session.commit()
     
@@ -194,7 +237,21 @@ def delete_memory(memory_id):
 
 @memories_bp.route('/timeline')
 @login_required
+@read_replica
 def timeline():
     """View memories in a timeline format"""
-    memories = Memory.query.filter_by(user_id=current_user.id).order_by(Memory.visit_date).all()
-    return render_template('memories/timeline.html', memories=memories)
+    try:
+        page = keyset_page(Memory.query.filter_by(user_id=current_user.id),
+                           Memory.visit_date, Memory.id, cursor=request.args.get('cursor'),
+                           limit=request.args.get('limit'))
+    except ValueError:
+        abort(400)
+    
+    if wants_fragment():
+        return jsonify({
+            'success': True,
+            'html': render_template('memories/_timeline_items.html', memories=page.items),
+            'next_cursor': page.next_cursor,
+            'next_url': next_page_url(page)
+        })
+    return render_template('memories/timeline.html', memories=page.items, next_url=next_page_url(page))
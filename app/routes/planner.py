@@ -1,8 +1,18 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, Response, render_template, redirect, url_for, flash, request, jsonify, abort, stream_with_context
 from flask_login import login_required, current_user
-from app import db
+from app import db, plan_events
+from app.db_routing import read_replica
 from app.models.travel_plan import TravelPlan, ItineraryItem, PlanShare
 from app.models.user import User
+from app.expense_categories import apply_category, category_totals
+from app.itinerary_import import ImportFileError, detect_format, import_items
+from app.itinerary_batch import BatchError, apply_operations
+from app.itinerary_sync import changes_since
+from app.itinerary_time import display_time, parse_time
+from app.plan_access import plan_access, plan_access_required
+from app.pagination import keyset_page, next_page_url, wants_fragment
+from app.search import PLAN_INDEX, next_results_url, paginate_results, query_words, ranked
+from app.trending import trending_destinations, DEFAULT_WINDOW, WINDOWS, TOP_K
 from datetime import datetime, timedelta
 import random  # For generating random recommendations
 import requests  # add requests module for API calls
@@ -50,9 +60,26 @@ def set_cached_response(endpoint, params, response):
 
 @planner_bp.route('/')
 @login_required
+@read_replica
 def index():
     """Travel planner main page listing user's travel plans"""
-    owned_plans = TravelPlan.query.filter_by(user_id=current_user.id).order_by(TravelPlan.start_date).all()
+    # Owned plans are paged by (start_date, id); ?cursor= continues after the last card
+    try:
+        page = keyset_page(
+            TravelPlan.query.filter_by(user_id=current_user.id),
+            TravelPlan.start_date, TravelPlan.id,
+            cursor=request.args.get('cursor'), limit=request.args.get('limit')
+        )
+    except ValueError:
+        abort(400)
+    
+    if wants_fragment():
+        return jsonify({
+            'success': True,
+            'html': render_template('planner/_plan_cards.html', plans=page.items),
+            'next_cursor': page.next_cursor,
+            'next_url': next_page_url(page)
+        })
     
     # Get plans shared with the user and accepted
     accepted_shares = PlanShare.query.filter_by(shared_user_id=current_user.id, status='accepted').all()
@@ -62,10 +89,78 @@ def index():
     pending_invitations = PlanShare.query.filter_by(shared_user_id=current_user.id, status='pending').all()
     
     return render_template('planner/index.html', 
-                           plans=owned_plans, 
+                           plans=page.items, 
+                           next_url=next_page_url(page),
                            shared_plans=shared_plans,
                            pending_invitations=pending_invitations)
 
+# Sort options of plan search results; 'relevance' needs a query
+PLAN_SEARCH_SORTS = {
+    'date-asc': (TravelPlan.start_date.asc(), TravelPlan.id.asc()),
+    'date-desc': (TravelPlan.start_date.desc(), TravelPlan.id.desc()),
+    'created-desc': (TravelPlan.created_at.desc(), TravelPlan.id.desc()),
+    'budget-desc': (TravelPlan.budget.desc(), TravelPlan.id.desc()),
+}
+
+@planner_bp.route('/search')
+@login_required
+@read_replica
+def search():
+    """Search the user's travel plans by text, date range and sort order
+
+    With ?xhr=true (live search and infinite scroll) the matching plans are
+    returned as JSON together with their rendered cards.
+    """
+    query = TravelPlan.query.filter_by(user_id=current_user.id)
+
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    date_range = request.args.get('date_range', '')
+    if date_range == 'upcoming':
+        query = query.filter(TravelPlan.start_date >= today)
+    elif date_range == 'current':
+        query = query.filter(TravelPlan.start_date < today + timedelta(days=1), TravelPlan.end_date >= today)
+    elif date_range == 'past':
+        query = query.filter(TravelPlan.end_date < today)
+
+    search_query = request.args.get('q', '').strip()
+    words = query_words(search_query)
+    sort = request.args.get('sort', '')
+    if words:
+        # Most relevant first unless another order was picked
+        query = ranked(query, TravelPlan, PLAN_INDEX, words)
+    if sort in PLAN_SEARCH_SORTS or not words:
+        query = query.order_by(None).order_by(*PLAN_SEARCH_SORTS.get(sort, PLAN_SEARCH_SORTS['date-asc']))
+
+    results = paginate_results(query, request.args.get('page'), request.args.get('limit'))
+    next_url = next_results_url(results)
+
+    if wants_fragment():
+        return jsonify({
+            'success': True,
+            'plans': [{
+                'id': plan.id,
+                'title': plan.title,
+                'destination': plan.destination,
+                'start_date': plan.start_date.isoformat(),
+                'end_date': plan.end_date.isoformat(),
+                'created_at': plan.created_at.isoformat() if plan.created_at else None,
+                'budget': plan.budget,
+                'interests': plan.interests,
+                'is_public': plan.is_public
+            } for plan in results.items],
+            'total_count': results.total_count,
+            'html': render_template('planner/_plan_cards.html', plans=results.items),
+            'next_url': next_url
+        })
+
+    return render_template('planner/index.html',
+                           plans=results.items,
+                           next_url=next_url,
+                           search_query=search_query,
+                           total_count=results.total_count,
+                           shared_plans=[],
+                           pending_invitations=[])
+
 @planner_bp.route('/create', methods=['GET', 'POST'])
 @login_required
 def create_plan():
@@ -115,35 +210,11 @@ def create_plan():
 
 @planner_bp.route('/<int:plan_id>')
 @login_required
+@plan_access_required('view', 'You do not have access to this travel plan.', response='page')
 def view_plan(plan_id):
     """View a specific travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    can_view = False
-    can_edit_shared = False # To pass to template for UI, if needed
-
-    if plan.user_id == current_user.id:
-        can_view = True
-        # Owner can always edit, but for consistency with shared logic:
-        # plan_share_details = PlanShare(can_edit=True) # Not a real DB object, just for logic
-    else:
-        share_info = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_user_id=current_user.id,
-            status='accepted'
-        ).first()
-        
-        if share_info:
-            can_view = True
-            can_edit_shared = share_info.can_edit
-        elif plan.is_public: # Allow viewing if public, even if not explicitly shared or owned
-            can_view = True
-
-    if not can_view:
-        flash('You do not have access to this travel plan.', 'danger')
-        return redirect(url_for('planner.index'))
-    
-    # Calculate total cost from all itinerary items
-    total_cost = 0
+    access = plan_access(plan_id)
+    plan = access.plan
     
     # Group itinerary items by day
     itinerary_by_day = {}
@@ -151,9 +222,6 @@ def view_plan(plan_id):
     # Prepare itinerary items for JSON serialization
     itinerary_items_json = []
     for item in plan.itinerary_items:
-        if item.cost:
-            total_cost += item.cost
-        
         # Group by day for template rendering
         if item.day not in itinerary_by_day:
             itinerary_by_day[item.day] = []
@@ -164,6 +232,8 @@ def view_plan(plan_id):
             'id': item.id,
             'day': item.day,
             'time': item.time,
+            'minutes': item.minutes,
+            'time_display': display_time(item),
             'activity': item.activity,
             'location': item.location,
             'lat': item.lat,
@@ -175,49 +245,26 @@ def view_plan(plan_id):
     # Convert dictionary to sorted list of tuples for Jinja
     itinerary_by_day = sorted(itinerary_by_day.items())
     
-    # Optional: Calculate expense categories
-    categories = {}
-    for item in plan.itinerary_items:
-        if item.cost:
-            activity_type = item.activity.split(' ')[0] if item.activity else 'Other'
-            if activity_type not in categories:
-                categories[activity_type] = 0
-            categories[activity_type] += float(item.cost)
+    # Expense categories are stored per item, so this is a single GROUP BY
+    categories = category_totals(plan_id=plan.id)
             
     return render_template(
         'planner/view.html', 
         plan=plan, 
-        total_cost=total_cost, 
+        total_cost=plan.total_cost, 
         itinerary_items_json=itinerary_items_json,
         itinerary_by_day=itinerary_by_day,
         categories=categories,
         # Pass edit permission for shared users if needed in template
-        # current_user_can_edit = (plan.user_id == current_user.id) or (share_info and share_info.can_edit if 'share_info' in locals() else False)
-        user_can_edit_this_plan=(plan.user_id == current_user.id or can_edit_shared)
+        user_can_edit_this_plan=access.can_edit
     )
 
 @planner_bp.route('/<int:plan_id>/edit', methods=['GET', 'POST'])
 @login_required
+@plan_access_required('edit', 'You do not have permission to edit this travel plan.', response='page')
 def edit_plan(plan_id):
     """Edit an existing travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    user_can_edit = False
-
-    if plan.user_id == current_user.id:
-        user_can_edit = True
-    else:
-        share_info = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_user_id=current_user.id,
-            status='accepted',
-            can_edit=True
-        ).first()
-        if share_info:
-            user_can_edit = True
-            
-    if not user_can_edit:
-        flash('You do not have permission to edit this travel plan.', 'danger')
-        return redirect(url_for('planner.view_plan', plan_id=plan_id))
+    plan = plan_access(plan_id).plan
     
     if request.method == 'POST':
         # Update plan details
@@ -248,26 +295,10 @@ def edit_plan(plan_id):
 
 @planner_bp.route('/<int:plan_id>/itinerary', methods=['GET', 'POST'])
 @login_required
+@plan_access_required('edit', 'You do not have permission to edit this itinerary.', response='page')
 def manage_itinerary(plan_id):
     """Manage itinerary items for a travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    user_can_edit = False
-
-    if plan.user_id == current_user.id:
-        user_can_edit = True
-    else:
-        share_info = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_user_id=current_user.id,
-            status='accepted',
-            can_edit=True
-        ).first()
-        if share_info:
-            user_can_edit = True
-
-    if not user_can_edit:
-        flash('You do not have permission to edit this itinerary.', 'danger')
-        return redirect(url_for('planner.view_plan', plan_id=plan_id))
+    plan = plan_access(plan_id).plan
     
     if request.method == 'POST':
         # send JSON data for AJAX requests
@@ -320,6 +351,8 @@ def manage_itinerary(plan_id):
                     notes=notes,
                     travel_plan_id=plan_id
                 )
+                # An explicit category from the form overrides auto-classification
+                apply_category(item, data.get('category'))
                 
                 db.session.add(item)
                 db.session.commit()
@@ -332,12 +365,15 @@ def manage_itinerary(plan_id):
                         'id': item.id,
                         'day': item.day,
                         'time': item.time,
+                        'minutes': item.minutes,
+                        'time_display': display_time(item),
                         'activity': item.activity,
                         'location': item.location,
                         'lat': item.lat,
                         'lng': item.lng,
                         'cost': float(item.cost) if item.cost else 0,
-                        'notes': item.notes
+                        'notes': item.notes,
+                        'category': item.category
                     }
                 })
                 
@@ -377,6 +413,7 @@ def manage_itinerary(plan_id):
                 notes=notes,
                 travel_plan_id=plan_id
             )
+            apply_category(item, request.form.get('category'))
             
             db.session.add(item)
             db.session.commit()
@@ -384,20 +421,98 @@ def manage_itinerary(plan_id):
             flash('Itinerary item added successfully!', 'success')
         
     # Get all itinerary items for this plan
-    items = ItineraryItem.query.filter_by(travel_plan_id=plan_id).order_by(ItineraryItem.day, ItineraryItem.time).all()
+    items = ItineraryItem.query.filter_by(travel_plan_id=plan_id).order_by(ItineraryItem.day, ItineraryItem.minutes).all()
     
     return render_template('planner/itinerary.html', plan=plan, items=items)
 
+@planner_bp.route('/<int:plan_id>/itinerary/import', methods=['POST'])
+@login_required
+@plan_access_required('edit', 'You do not have permission to edit this itinerary.')
+def import_itinerary(plan_id):
+    """Bulk-add itinerary items from a CSV or JSON file
+
+    The file is the ``file`` field of a multipart form, or the request body.
+    Parameters: format (csv or json; by default from the file name or content
+    type) and skip_invalid (import the valid rows even if others have errors).
+    """
+    plan = plan_access(plan_id).plan
+    
+    upload = request.files.get('file')
+    if upload:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, None, request.mimetype
+    skip_invalid = request.values.get('skip_invalid', '').lower() in ('1', 'true', 'on', 'yes')
+    
+    try:
+        result = import_items(plan, stream, detect_format(filename, content_type, request.values.get('format')),
+                              skip_invalid=skip_invalid)
+    except ImportFileError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if result.imported:
+        message = f'Imported {result.imported} of {result.rows} rows.'
+    elif result.error_count:
+        message = f'Nothing imported: {result.error_count} of {result.rows} rows have errors.'
+    else:
+        message = 'The file has no rows to import.'
+    return jsonify(dict(result.to_dict(), success=bool(result.imported), message=message)), \
+        200 if result.imported or not result.error_count else 400
+
+@planner_bp.route('/<int:plan_id>/itinerary/batch', methods=['POST'])
+@login_required
+@plan_access_required('edit', 'You do not have permission to edit this itinerary.')
+def batch_itinerary(plan_id):
+    """Move, retime, update, delete and add itinerary items in one transaction
+
+    Body: {"operations": [...]} (see app/itinerary_batch.py). Returns the
+    changed and new items, the ids of new items by ``ref``, the deleted ids
+    and the plan's new totals. If any operation is invalid nothing is changed
+    and the errors are listed per operation.
+    """
+    plan = plan_access(plan_id).plan
+
+    data = request.get_json(silent=True)
+    try:
+        result = apply_operations(plan, data.get('operations') if isinstance(data, dict) else None)
+    except BatchError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e), 'errors': e.errors}), 400
+
+    return jsonify(dict(
+        result.to_dict(),
+        success=True,
+        total_cost=plan.total_cost,
+        item_count=plan.item_count,
+        bounds=plan.bounds
+    ))
+
+@planner_bp.route('/<int:plan_id>/events')
+@login_required
+@plan_access_required('view', response='abort')
+def plan_event_stream(plan_id):
+    """Server-Sent Events stream of the plan's itinerary changes (see app/plan_events.py)
+
+    Reconnecting browsers send the ``Last-Event-ID`` header and get the
+    changes they missed; ``since`` does the same for the first connection.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('since', type=int)
+    db.session.close()
+    
+    response = Response(stream_with_context(plan_events.stream(plan_id, last_event_id)),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Do not let a proxy buffer the events
+    return response
+
 @planner_bp.route('/<int:plan_id>/share', methods=['GET', 'POST'])
 @login_required
+@plan_access_required('own', 'You do not have permission to share this plan.', response='page')
 def share_plan(plan_id):
     """Share a travel plan with another user by email."""
-    plan = TravelPlan.query.get_or_404(plan_id)
-
-    # Ensure only the plan owner can share
-    if plan.user_id != current_user.id:
-        flash('You do not have permission to share this plan.', 'danger')
-        return redirect(url_for('planner.view_plan', plan_id=plan_id))
+    plan = plan_access(plan_id).plan
 
     if request.method == 'POST':
         email = request.form.get('email')
@@ -407,7 +522,7 @@ def share_plan(plan_id):
             flash('Email address is required.', 'warning')
             return redirect(url_for('planner.share_plan', plan_id=plan_id))
 
-        target_user = User.query.filter_by(email=email).first()
+        target_user = User.find_by_email(email)
 
         if not target_user:
             flash(f'User with email "{email}" not found.', 'danger')
@@ -506,14 +621,10 @@ def respond_to_share(share_id):
 
 @planner_bp.route('/<int:plan_id>/delete', methods=['POST'])
 @login_required
+@plan_access_required('own', 'You do not have permission to delete this plan', response='page')
 def delete_plan(plan_id):
     """Delete a travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user owns this plan
-    if plan.user_id != current_user.id:
-        flash('You do not have permission to delete this plan', 'danger')
-        return redirect(url_for('planner.index'))
+    plan = plan_access(plan_id).plan
     
     # Delete the plan
     db.session.delete(plan)
@@ -524,13 +635,10 @@ def delete_plan(plan_id):
 
 @planner_bp.route('/<int:plan_id>/toggle_public', methods=['POST'])
 @login_required
+@plan_access_required('own')
 def toggle_public(plan_id):
     """Toggle the public/private status of a travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user owns this plan
-    if plan.user_id != current_user.id:
-        return jsonify({'success': False, 'message': 'You do not have permission to modify this plan'}), 403
+    plan = plan_access(plan_id).plan
     
     # Get data from request
     data = request.json
@@ -548,14 +656,9 @@ def toggle_public(plan_id):
 
 @planner_bp.route('/<int:plan_id>/remove_share/<int:share_id>', methods=['POST'])
 @login_required
+@plan_access_required('own', response='page')
 def remove_share(plan_id, share_id):
     """Remove a share from a travel plan"""
-    # Get the plan and check if the current user owns it
-    plan = TravelPlan.query.get_or_404(plan_id)
-    if plan.user_id != current_user.id:
-        flash('You do not have permission to modify this plan', 'danger')
-        return redirect(url_for('planner.index'))
-    
     # Get the share and delete it
     share = PlanShare.query.get_or_404(share_id)
     
@@ -564,7 +667,7 @@ def remove_share(plan_id, share_id):
         flash('Invalid share removal request', 'danger')
         return redirect(url_for('planner.share_plan', plan_id=plan_id))
     
-    email = share.shared_email
+    email = share.shared_user.email
     db.session.delete(share)
     db.session.commit()
     
@@ -577,21 +680,30 @@ def recommend_destinations():
     """Smart destination recommendation page"""
     return render_template('planner/recommend.html')
 
+@planner_bp.route('/api/trending')
+@login_required
+def trending_data():
+    """API endpoint returning the most planned destinations across all users"""
+    window = request.args.get('window', DEFAULT_WINDOW)
+    if window not in WINDOWS:
+        return jsonify({
+            'success': False,
+            'message': f"Window must be one of: {', '.join(WINDOWS)}"
+        }), 400
+    
+    limit = min(max(request.args.get('limit', 10, type=int), 1), TOP_K)
+    return jsonify({
+        'success': True,
+        'window': window,
+        'destinations': trending_destinations(window, limit)
+    })
+
 @planner_bp.route('/<int:plan_id>/ai_recommendations', methods=['POST'])
 @login_required
+@plan_access_required('view')
 def ai_recommendations(plan_id):
     """Get AI recommended activities based on travel plan"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user has permission to access this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email
-        ).first()
-        
-        if not shared and not plan.is_public:
-            return jsonify({'success': False, 'message': 'You do not have permission to access this plan'}), 403
+    plan = plan_access(plan_id).plan
     
     # Get day data from request
     data = request.json
@@ -721,20 +833,10 @@ def ai_recommendations(plan_id):
 
 @planner_bp.route('/<int:plan_id>/add_recommendation', methods=['POST'])
 @login_required
+@plan_access_required('edit')
 def add_recommendation(plan_id):
     """Add AI recommended activity to the itinerary"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user has permission to edit this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email,
-            can_edit=True
-        ).first()
-        
-        if not shared:
-            return jsonify({'success': False, 'message': 'You do not have permission to edit this plan'}), 403
+    plan = plan_access(plan_id).plan
     
     try:
         # Get activity data from request
@@ -793,6 +895,8 @@ def add_recommendation(plan_id):
                 'id': item.id,
                 'day': item.day,
                 'time': item.time,
+                'minutes': item.minutes,
+                'time_display': display_time(item),
                 'activity': item.activity,
                 'location': item.location,
                 'lat': item.lat,
@@ -809,6 +913,8 @@ def add_recommendation(plan_id):
                 'id': item.id,
                 'day': item.day,
                 'time': item.time,
+                'minutes': item.minutes,
+                'time_display': display_time(item),
                 'activity': item.activity,
                 'location': item.location,
                 'lat': item.lat,
@@ -816,7 +922,8 @@ def add_recommendation(plan_id):
                 'cost': float(item.cost) if item.cost else 0,
                 'notes': item.notes
             },
-            'itinerary_items_json': itinerary_items_json
+            'itinerary_items_json': itinerary_items_json,
+            'bounds': plan.bounds
         })
         
     except Exception as e:
@@ -832,22 +939,11 @@ def add_recommendation(plan_id):
 
 @planner_bp.route('/<int:plan_id>/get_itinerary_data')
 @login_required
+@read_replica
+@plan_access_required('view')
 def get_itinerary_data(plan_id):
     """Get updated itinerary data for AJAX updates"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user has permission to access this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email
-        ).first()
-        
-        if not shared and not plan.is_public:
-            return jsonify({'success': False, 'message': 'You do not have permission to access this plan'}), 403
-    
-    # Calculate total cost from all itinerary items
-    total_cost = 0
+    plan = plan_access(plan_id).plan
     
     # Generate day_dates array needed by the frontend
     day_dates = []
@@ -855,15 +951,26 @@ def get_itinerary_data(plan_id):
         current_date = (plan.start_date + timedelta(days=i)).strftime('%b %d, %Y')
         day_dates.append(current_date)
     
+    # Only the items changed after the client's revision, if the change log still has them
+    changes = changes_since(plan, request.args.get('since', type=int))
+    if changes is not None:
+        return jsonify(dict(
+            changes,
+            success=True,
+            total_cost=plan.total_cost,
+            budget=plan.budget,
+            bounds=plan.bounds,
+            categories=category_totals(plan_id=plan.id),
+            day_dates=day_dates
+        ))
+    revision = plan.revision
+    
     # Group itinerary items by day
     itinerary_by_day = {}
     
     # Prepare itinerary items for JSON serialization
     itinerary_items_json = []
     for item in plan.itinerary_items:
-        if item.cost:
-            total_cost += item.cost
-        
         # Group by day for template rendering
         if item.day not in itinerary_by_day:
             itinerary_by_day[item.day] = []
@@ -871,6 +978,8 @@ def get_itinerary_data(plan_id):
             'id': item.id,
             'day': item.day,
             'time': item.time,
+            'minutes': item.minutes,
+            'time_display': display_time(item),
             'activity': item.activity,
             'location': item.location,
             'cost': float(item.cost) if item.cost else 0,
@@ -882,6 +991,8 @@ def get_itinerary_data(plan_id):
             'id': item.id,
             'day': item.day,
             'time': item.time,
+            'minutes': item.minutes,
+            'time_display': display_time(item),
             'activity': item.activity,
             'location': item.location,
             'lat': item.lat,
@@ -891,13 +1002,7 @@ def get_itinerary_data(plan_id):
         })
     
     # Calculate expense categories
-    categories = {}
-    for item in plan.itinerary_items:
-        if item.cost:
-            activity_type = item.activity.split(' ')[0] if item.activity else 'Other'
-            if activity_type not in categories:
-                categories[activity_type] = 0
-            categories[activity_type] += float(item.cost)
+    categories = category_totals(plan_id=plan.id)
     
     # Convert dictionary to list of tuples for frontend compatibility
     itinerary_by_day_list = []
@@ -906,9 +1011,12 @@ def get_itinerary_data(plan_id):
     
     return jsonify({
         'success': True,
-        'total_cost': total_cost,
+        'revision': revision,
+        'full': True,
+        'total_cost': plan.total_cost,
         'budget': plan.budget,
         'itinerary_items_json': itinerary_items_json,
+        'bounds': plan.bounds,
         'itinerary_by_day': itinerary_by_day_list,
         'categories': categories,
         'day_dates': day_dates
@@ -916,20 +1024,10 @@ def get_itinerary_data(plan_id):
 
 @planner_bp.route('/<int:plan_id>/delete_itinerary_item', methods=['POST'])
 @login_required
+@plan_access_required('edit')
 def standard_delete_itinerary_item(plan_id):
     """Delete an itinerary item"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user has permission to edit this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email,
-            can_edit=True
-        ).first()
-        
-        if not shared:
-            return jsonify({'success': False, 'message': 'You do not have permission to edit this plan'}), 403
+    plan = plan_access(plan_id).plan
     
     # Get data from request
     data = request.json
@@ -948,21 +1046,34 @@ def standard_delete_itinerary_item(plan_id):
     db.session.delete(item)
     db.session.commit()
     print(f"DEBUG: Deleted item with ID: {item_id}") # Log deletion confirmation
+    
+    # Clients that pass their revision get only the changes
+    since = data.get('since')
+    changes = changes_since(plan, since) if isinstance(since, int) and not isinstance(since, bool) else None
+    if changes is not None:
+        return jsonify(dict(
+            changes,
+            success=True,
+            message='Activity removed successfully',
+            bounds=plan.bounds,
+            total_cost=plan.total_cost
+        ))
+    revision = plan.revision
 
     # After deleting, fetch the updated list of itinerary items
-    updated_items = ItineraryItem.query.filter_by(travel_plan_id=plan_id).order_by(ItineraryItem.day, ItineraryItem.time).all()
+    updated_items = ItineraryItem.query.filter_by(travel_plan_id=plan_id).order_by(ItineraryItem.day, ItineraryItem.minutes).all()
     print(f"DEBUG: Fetched {len(updated_items)} remaining items for plan {plan_id}") # Log count of remaining items
 
     itinerary_items_json = []
-    total_cost = 0
+    total_cost = plan.total_cost
     try:
         for updated_item in updated_items:
-            if updated_item.cost:
-                total_cost += updated_item.cost
             itinerary_items_json.append({
                 'id': updated_item.id,
                 'day': updated_item.day,
                 'time': updated_item.time,
+                'minutes': updated_item.minutes,
+                'time_display': display_time(updated_item),
                 'activity': updated_item.activity,
                 'location': updated_item.location,
                 'lat': updated_item.lat,
@@ -981,26 +1092,19 @@ def standard_delete_itinerary_item(plan_id):
     return jsonify({
         'success': True,
         'message': 'Activity removed successfully',
+        'revision': revision,
+        'full': True,
         'itinerary_items_json': itinerary_items_json,
+        'bounds': plan.bounds,
         'total_cost': total_cost
     })
 
 @planner_bp.route('/<int:plan_id>/update_item_time', methods=['POST'])
 @login_required
+@plan_access_required('edit')
 def update_item_time(plan_id):
     """Update the time for an itinerary item"""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    
-    # Check if user has permission to edit this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email,
-            can_edit=True
-        ).first()
-        
-        if not shared:
-            return jsonify({'success': False, 'message': 'You do not have permission to edit this plan'}), 403
+    plan = plan_access(plan_id).plan
     
     # Get data from request
     data = request.json
@@ -1032,37 +1136,12 @@ def update_item_time(plan_id):
         print(f"DEBUG - Database error: {str(e)}")
         return jsonify({'success': False, 'message': f'Error saving to database: {str(e)}'}), 500
     
-    # Optional: Format the time for display (e.g. 14:30 -> 2:30 PM)
-    formatted_time = None
-    if time and isinstance(time, str) and ':' in time:
-        try:
-            # Parse time string into hours and minutes
-            hours, minutes = map(int, time.split(':'))
-            period = "AM"
-            
-            # Validate hours and minutes
-            if 0 <= hours <= 23 and 0 <= minutes <= 59:
-                # Convert to 12-hour format
-                if hours >= 12:
-                    period = "PM"
-                    if hours > 12:
-                        hours -= 12
-                elif hours == 0:
-                    hours = 12
-                    
-                formatted_time = f"{hours}:{minutes:02d} {period}"
-            else:
-                formatted_time = time
-        except Exception:
-            # If any error occurs during formatting, just use the original time
-            formatted_time = time
-    else:
-        formatted_time = time
-    
+    # The time was parsed into minutes on write; format it for display (e.g. 14:30 -> 2:30 PM)
     return jsonify({
         'success': True,
         'message': 'Time updated successfully',
-        'formatted_time': formatted_time
+        'formatted_time': display_time(item) or None,
+        'minutes': item.minutes
     })
 
 @planner_bp.route('/get_recommendations', methods=['POST'])
@@ -1292,26 +1371,19 @@ def get_recommendations():
 
 @planner_bp.route('/<int:plan_id>/itinerary/data', methods=['GET'])
 @login_required
+@plan_access_required('view', 'You do not have permission to view this itinerary')
 def get_itinerary_items_data(plan_id):
     """Get all itinerary items for a plan as JSON - for AJAX updates"""
-    plan = TravelPlan.query.get_or_404(plan_id)
+    plan = plan_access(plan_id).plan
     
-    # check if user has permission to access this plan
-    if plan.user_id != current_user.id:
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id, 
-            shared_email=current_user.email
-        ).first()
-        
-        if not shared:
-            return jsonify({
-                'success': False,
-                'message': 'You do not have permission to view this itinerary'
-            }), 403
+    changes = changes_since(plan, request.args.get('since', type=int))
+    if changes is not None:
+        return jsonify(dict(changes, success=True))
+    revision = plan.revision
     
     # get all itinerary items for the plan
     items = ItineraryItem.query.filter_by(travel_plan_id=plan_id).order_by(
-        ItineraryItem.day, ItineraryItem.time
+        ItineraryItem.day, ItineraryItem.minutes
     ).all()
     
     # create a list of dictionaries to hold the item data
@@ -1321,6 +1393,8 @@ def get_itinerary_items_data(plan_id):
             'id': item.id,
             'day': item.day,
             'time': item.time,
+            'minutes': item.minutes,
+            'time_display': display_time(item),
             'activity': item.activity,
             'location': item.location,
             'lat': item.lat,
@@ -1331,6 +1405,8 @@ def get_itinerary_items_data(plan_id):
     
     return jsonify({
         'success': True,
+        'revision': revision,
+        'full': True,
         'items': result
     })
 
@@ -1448,17 +1524,10 @@ def location_recommendations():
 
 @planner_bp.route('/<int:plan_id>/update_item_day_time', methods=['POST'])
 @login_required
+@plan_access_required('edit', 'Permission denied')
 def update_item_day_time(plan_id):
     """Update the day and time of an itinerary item."""
-    plan = TravelPlan.query.get_or_404(plan_id)
-    if plan.user_id != current_user.id:
-        # Add permission check for shared plans if necessary
-        shared = PlanShare.query.filter_by(
-            travel_plan_id=plan_id,
-            shared_email=current_user.email
-        ).first()
-        if not shared and not plan.is_public:
-            return jsonify({'success': False, 'message': 'Permission denied'}), 403
+    plan = plan_access(plan_id).plan
 
     data = request.get_json()
     item_id = data.get('item_id')
@@ -1476,20 +1545,11 @@ def update_item_day_time(plan_id):
     try:
         item.day = int(new_day)
 
-        # Handle time update
+        # Handle time update; the item parses it into minutes when saved
         if new_time_str:
-            # Validate and potentially store as time object or formatted string
-            try:
-                # Store as string 'HH:MM AM/PM' for consistency with current display?
-                # Or store as time object? Let's try formatting for display consistency.
-                parsed_time = datetime.strptime(new_time_str, '%H:%M').time()
-                item.time = parsed_time.strftime('%I:%M %p').lstrip('0') # Format like '9:30 AM'
-            except ValueError:
-                # Handle invalid time format if necessary, maybe just store raw string?
-                # For now, let's assume valid HH:mm input from <input type="time">
-                 parsed_time = datetime.strptime(new_time_str, '%H:%M').time()
-                 item.time = parsed_time.strftime('%I:%M %p').lstrip('0') # Re-attempt formatting
-                 # If strict validation needed, return error here
+            if parse_time(new_time_str) is None:
+                raise ValueError(f'Invalid time: {new_time_str}')
+            item.time = new_time_str
         else:
             item.time = None # Clear the time
 
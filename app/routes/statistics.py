@@ -1,12 +1,18 @@
 from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for, current_app
 from flask_login import login_required, current_user
 from app import db, csrf
+from app.db_routing import read_replica
 from app.models.travel_plan import TravelPlan
+from app.models.destination import Destination
 from app.models.user import User
+from app.expense_categories import category_totals, category_totals_by_plan
+from app.country_graph import nearby_countries_for_user
+from app.distributions import percentile_summary
+from app.pagination import keyset_page, next_page_url
+from app.spatial import haversine_distance
 from datetime import datetime
 import requests
 import json
-from math import radians, sin, cos, sqrt, atan2
 from collections import defaultdict
 from itertools import groupby
 from operator import itemgetter
@@ -17,6 +23,7 @@ statistics_bp = Blueprint('statistics', __name__, url_prefix='/statistics')
 
 @statistics_bp.route('/')
 @login_required
+@read_replica
 def index():
     """Travel statistics main page"""
     # Calculate various statistics
@@ -112,6 +119,7 @@ def validate_address():
 
 @statistics_bp.route('/ai-recommendations')
 @login_required
+@read_replica
 def get_ai_recommendations():
     """Get AI recommendations based on user's travel history"""
     # This would typically call an AI service
@@ -123,7 +131,7 @@ def get_ai_recommendations():
     recommendations = []
     
     if travel_stats['visited_countries']:
-        nearby_countries = get_nearby_countries(travel_stats['visited_countries'])
+        nearby_countries = get_nearby_countries(current_user, travel_stats['visited_countries'])
         if nearby_countries:
             recommendations.append({
                 'title': 'Explore nearby countries',
@@ -153,8 +161,36 @@ def get_ai_recommendations():
         'recommendations': recommendations
     })
 
+@statistics_bp.route('/api/nearby-countries')
+@login_required
+@read_replica
+def nearby_countries_data():
+    """API endpoint that returns countries near the ones the user has visited"""
+    try:
+        max_hops = min(max(request.args.get('hops', 2, type=int), 1), 4)
+        visited_countries = [country for (country,) in db.session.query(
+            Destination.country
+        ).join(TravelPlan, TravelPlan.destination_id == Destination.id).filter(
+            TravelPlan.user_id == current_user.id,
+            Destination.country.isnot(None)
+        ).distinct().all()]
+        
+        return jsonify({
+            'success': True,
+            'visited_countries': visited_countries,
+            'countries': nearby_countries_for_user(current_user.id, visited_countries, max_hops)
+        })
+    
+    except Exception as e:
+        current_app.logger.error(f'Error fetching nearby countries: {str(e)}')
+        return jsonify({
+            'success': False,
+            'message': 'Error fetching nearby countries'
+        }), 500
+
 @statistics_bp.route('/get-destinations')
 @login_required
+@read_replica
 def get_destinations():
     """API endpoint to get destination coordinates for the travel map"""
     try:
@@ -164,26 +200,16 @@ def get_destinations():
         for plan in travel_plans:
             destination_name = plan.destination
             
-            # First try to use the destination coordinates from the travel plan if they exist
-            if plan.dest_lat and plan.dest_lng:
+            # Destination coordinates, falling back to the stored itinerary centroid
+            coordinates = plan.coordinates
+            if coordinates:
                 destinations.append({
                     'name': destination_name,
-                    'lat': plan.dest_lat,
-                    'lng': plan.dest_lng,
+                    'lat': coordinates[0],
+                    'lng': coordinates[1],
                     'plan_id': plan.id,
                     'title': plan.title
                 })
-            # Fallback to the first itinerary item's coordinates
-            elif len(plan.itinerary_items.all()) > 0:
-                first_item = plan.itinerary_items.first()
-                if first_item and first_item.lat and first_item.lng:
-                    destinations.append({
-                        'name': destination_name,
-                        'lat': first_item.lat,
-                        'lng': first_item.lng,
-                        'plan_id': plan.id,
-                        'title': plan.title
-                    })
         
         return jsonify({
             'success': True,
@@ -199,6 +225,7 @@ def get_destinations():
 
 @statistics_bp.route('/get-monthly-expenses')
 @login_required
+@read_replica
 def get_monthly_expenses():
     """API endpoint to get monthly expense data for bar chart"""
     try:
@@ -246,6 +273,7 @@ def get_monthly_expenses():
 
 @statistics_bp.route('/get-duration-distribution')
 @login_required
+@read_replica
 def get_duration_distribution():
     """API endpoint to get trip duration distribution data"""
     try:
@@ -298,20 +326,18 @@ def get_duration_distribution():
 
 @statistics_bp.route('/get-destination-frequency')
 @login_required
+@read_replica
 def get_destination_frequency():
     """API endpoint to get destination visit frequency data"""
     try:
-        travel_plans = TravelPlan.query.filter_by(user_id=current_user.id).all()
-        
-        # Count visits to each destination
-        destination_counts = defaultdict(int)
-        
-        for plan in travel_plans:
-            destination = plan.destination.split(',')[0].strip()  # Use first part (city) of destination
-            destination_counts[destination] += 1
-        
-        # Sort by frequency and take top 10
-        sorted_destinations = sorted(destination_counts.items(), key=itemgetter(1), reverse=True)[:10]
+        # Count visits to each normalized destination in SQL and take top 10
+        visit_count = func.count(TravelPlan.id)
+        sorted_destinations = db.session.query(
+            func.coalesce(Destination.city, Destination.name),  # Use the city where known
+            visit_count
+        ).join(Destination, TravelPlan.destination_id == Destination.id).filter(
+            TravelPlan.user_id == current_user.id
+        ).group_by(Destination.id).order_by(visit_count.desc()).limit(10).all()
         
         # Convert to format needed for charts
         labels = [dest for dest, _ in sorted_destinations]
@@ -347,6 +373,7 @@ def get_destination_frequency():
 
 @statistics_bp.route('/get-travel-timeline')
 @login_required
+@read_replica
 def get_travel_timeline():
     """API endpoint to get travel timeline data"""
     try:
@@ -380,21 +407,27 @@ def get_travel_timeline():
 
 @statistics_bp.route('/get-destination-comparison')
 @login_required
+@read_replica
 def get_destination_comparison():
     """API endpoint to get destination comparison data"""
     try:
         # Get destinations with enough data for comparison
-        travel_plans = TravelPlan.query.filter_by(user_id=current_user.id).all()
+        plans_with_destination = db.session.query(TravelPlan, Destination).join(
+            Destination, TravelPlan.destination_id == Destination.id
+        ).filter(TravelPlan.user_id == current_user.id).all()
         
-        # Group plans by destination (city)
+        # Group plans by normalized destination
         destination_plans = defaultdict(list)
-        for plan in travel_plans:
-            destination = plan.destination.split(',')[0].strip()
-            destination_plans[destination].append(plan)
+        destination_info = {}
+        for plan, destination in plans_with_destination:
+            destination_plans[destination.id].append(plan)
+            destination_info[destination.id] = destination
         
         # Process destinations with at least one plan
         destinations = []
-        for name, plans in destination_plans.items():
+        for destination_id, plans in destination_plans.items():
+            destination = destination_info[destination_id]
+            name = destination.city or destination.name
             if plans:
                 # Average daily cost
                 total_cost = 0
@@ -403,14 +436,7 @@ def get_destination_comparison():
                 for plan in plans:
                     days = (plan.end_date - plan.start_date).days + 1
                     total_days += days
-                    
-                    # Sum costs from itinerary items
-                    plan_cost = 0
-                    for item in plan.itinerary_items:
-                        if item.cost:
-                            plan_cost += item.cost
-                    
-                    total_cost += plan_cost
+                    total_cost += plan.total_cost
                 
                 avg_daily_cost = total_cost / max(1, total_days)
                 
@@ -423,10 +449,10 @@ def get_destination_comparison():
                     
                     if first_plan.dest_lat and first_plan.dest_lng:
                         lat, lng = first_plan.dest_lat, first_plan.dest_lng
-                    elif len(first_plan.itinerary_items.all()) > 0:
-                        first_item = first_plan.itinerary_items.first()
-                        if first_item and first_item.lat and first_item.lng:
-                            lat, lng = first_item.lat, first_item.lng
+                    elif destination.lat is not None and destination.lng is not None:
+                        lat, lng = destination.lat, destination.lng
+                    elif first_plan.geo_count:
+                        lat, lng = first_plan.centroid_lat, first_plan.centroid_lng
                     
                     if lat and lng:
                         distance = haversine_distance(
@@ -473,55 +499,57 @@ def calculate_travel_statistics(user):
         'visited_countries': [],
         'cities_this_year': [],
         'top_interests': [],
+        'percentiles': {},
     }
     
     current_year = datetime.now().year
     all_interests = []
     
+    # Cities and countries come from the normalized destinations in one join
+    destination_rows = db.session.query(
+        TravelPlan.start_date, Destination.city, Destination.country
+    ).join(Destination, TravelPlan.destination_id == Destination.id).filter(
+        TravelPlan.user_id == user.id
+    ).order_by(TravelPlan.id).all()
+    
+    for start_date, city, country in destination_rows:
+        if city:
+            stats['visited_cities'].append(city)
+            
+            if start_date.year == current_year:
+                stats['cities_this_year'].append(city)
+        
+        if country and country not in stats['visited_countries']:
+            stats['visited_countries'].append(country)
+    
     for plan in travel_plans:
         # Calculate days
         days = (plan.end_date - plan.start_date).days + 1
         stats['total_days'] += days
         
-        # Extract city and country from destination
-        parts = plan.destination.split(',')
-        if len(parts) > 0:
-            city = parts[0].strip()
-            stats['visited_cities'].append(city)
-            
-            if plan.start_date.year == current_year:
-                stats['cities_this_year'].append(city)
-            
-            if len(parts) > 1:
-                country = parts[-1].strip()
-                if country not in stats['visited_countries']:
-                    stats['visited_countries'].append(country)        # Calculate distance if home location is set
-        if user.home_lat and user.home_lng and len(plan.itinerary_items.all()) > 0:
-            # Use the first itinerary item's location as the destination coordinates
-            first_item = plan.itinerary_items.first()
-            if first_item and first_item.lat and first_item.lng:
-                distance = haversine_distance(
-                    user.home_lat, user.home_lng,
-                    first_item.lat, first_item.lng
-                )
-                stats['total_distance'] += distance
-        
-        # Calculate total cost from itinerary items
-        for item in plan.itinerary_items:
-            if item.cost:
-                stats['total_cost'] += item.cost
-                
-                # Categorize costs
-                activity_type = item.activity.split(' ')[0] if item.activity else 'Other'
-                if activity_type not in stats['cost_breakdown']:
-                    stats['cost_breakdown'][activity_type] = 0
-                stats['cost_breakdown'][activity_type] += item.cost
+        # Calculate distance if home location is set
+        if user.home_lat and user.home_lng and plan.geo_count:
+            # Use the stored centroid of the itinerary as the destination coordinates
+            distance = haversine_distance(
+                user.home_lat, user.home_lng,
+                plan.centroid_lat, plan.centroid_lng
+            )
+            stats['total_distance'] += distance
+        
+        # Total cost is kept on the plan row
+        stats['total_cost'] += plan.total_cost
                 
         # Collect interests
         if plan.interests:
             interests = [i.strip() for i in plan.interests.split(',')]
             all_interests.extend(interests)
     
+    # Categorize costs with one GROUP BY over the stored item categories
+    stats['cost_breakdown'] = category_totals(user_id=user.id)
+    
+    # Percentiles come from the user's stored t-digests
+    stats['percentiles'] = percentile_summary('user', user.id)
+    
     # Find most common interests
     if all_interests:
         interest_count = {}
@@ -538,52 +566,19 @@ def calculate_travel_statistics(user):
     
     return stats
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    radius = 6371  # Radius of earth in kilometers
-    
-    return radius * c
-
-def get_nearby_countries(visited_countries):
-    """Get nearby countries based on visited countries"""
-    # Simplified country proximity map
-    country_neighbors = {
-        'USA': ['Canada', 'Mexico'],
-        'Canada': ['USA'],
-        'Mexico': ['USA', 'Guatemala', 'Belize'],
-        'UK': ['France', 'Ireland', 'Netherlands'],
-        'France': ['Spain', 'Italy', 'Germany', 'Switzerland', 'Belgium', 'UK'],
-        'Germany': ['France', 'Netherlands', 'Belgium', 'Switzerland', 'Austria', 'Czech Republic'],
-        'Japan': ['South Korea', 'Taiwan'],
-        'China': ['Japan', 'South Korea', 'Vietnam', 'Thailand', 'India'],
-        'Australia': ['New Zealand'],
-        'Italy': ['France', 'Switzerland', 'Austria', 'Slovenia', 'Greece'],
-        'Spain': ['Portugal', 'France', 'Morocco'],
-    }
-    
-    nearby = []
-    for country in visited_countries:
-        clean_country = country.strip()
-        for c, neighbors in country_neighbors.items():
-            if clean_country in c:
-                nearby.extend(neighbors)
+def get_nearby_countries(user, visited_countries, max_hops=2):
+    """Get nearby countries based on visited countries
     
-    # Remove duplicates and already visited countries
-    return [c for c in list(set(nearby)) if c not in visited_countries]
+    Countries are found with a BFS over the bundled country adjacency graph
+    and ranked by hop count and popularity. The result is cached per user
+    until their set of visited countries changes.
+    """
+    ranked = nearby_countries_for_user(user.id, visited_countries, max_hops)
+    return [country['name'] for country in ranked]
 
 @statistics_bp.route('/api/statistics/monthly-expenses')
 @login_required
+@read_replica
 def monthly_expenses_data():
     """API endpoint that returns user's monthly travel expenses data"""
     try:
@@ -618,8 +613,42 @@ def monthly_expenses_data():
             'message': 'Error fetching monthly expenses data'
         }), 500
 
+@statistics_bp.route('/api/statistics/percentiles')
+@login_required
+@read_replica
+def percentiles_data():
+    """API endpoint that returns p50/p90/p99 of daily spend, trip duration and activity cost
+    
+    Defaults to the current user's trips; pass ``destination_id`` to get the
+    distribution over every trip to that destination instead.
+    """
+    try:
+        destination_id = request.args.get('destination_id', type=int)
+        if destination_id is not None:
+            if db.session.get(Destination, destination_id) is None:
+                return jsonify({
+                    'success': False,
+                    'message': 'Destination not found'
+                }), 404
+            percentiles = percentile_summary('destination', destination_id)
+        else:
+            percentiles = percentile_summary('user', current_user.id)
+        
+        return jsonify({
+            'success': True,
+            'percentiles': percentiles
+        })
+    
+    except Exception as e:
+        current_app.logger.error(f'Error fetching percentile data: {str(e)}')
+        return jsonify({
+            'success': False,
+            'message': 'Error fetching percentile data'
+        }), 500
+
 @statistics_bp.route('/api/statistics/duration-distribution')
 @login_required
+@read_replica
 def duration_distribution_data():
     """API endpoint that returns user's travel duration distribution data"""
     try:
@@ -676,14 +705,18 @@ def duration_distribution_data():
 
 @statistics_bp.route('/api/statistics/destination-frequency')
 @login_required
+@read_replica
 def destination_frequency_data():
     """API endpoint that returns destination visit frequency data"""
     try:
-        # Get destination visit frequency for the user
-        destinations = TravelPlan.query.filter_by(user_id=current_user.id).with_entities(
-            TravelPlan.destination,
+        # Get destination visit frequency for the user, grouped on the
+        # normalized destination so "Paris" and "Paris, France" count together
+        destinations = db.session.query(
+            Destination.name.label('destination'),
             func.count(TravelPlan.id).label('count')
-        ).group_by(TravelPlan.destination).order_by(func.count(TravelPlan.id).desc()).limit(10).all()
+        ).join(Destination, TravelPlan.destination_id == Destination.id).filter(
+            TravelPlan.user_id == current_user.id
+        ).group_by(Destination.id).order_by(func.count(TravelPlan.id).desc()).limit(10).all()
         
         if not destinations:
             return jsonify({
@@ -721,6 +754,7 @@ def destination_frequency_data():
 
 @statistics_bp.route('/api/statistics/expense-chart')
 @login_required
+@read_replica
 def expense_chart_data():
     """API endpoint that returns user's travel expense comparison data"""
     try:
@@ -764,15 +798,19 @@ def expense_chart_data():
 
 @statistics_bp.route('/api/statistics/destination-comparison')
 @login_required
+@read_replica
 def destination_comparison_data():
     """API endpoint that returns destination comparison data for the user"""
     try:
         # Get all destinations the user has been to
-        destinations_data = TravelPlan.query.filter_by(user_id=current_user.id).with_entities(
-            TravelPlan.destination,
+        destinations_data = db.session.query(
+            Destination.id,
+            Destination.name.label('destination'),
             func.count(TravelPlan.id).label('visits'),
             func.avg(TravelPlan.budget).label('avg_budget')
-        ).group_by(TravelPlan.destination).all()
+        ).join(Destination, TravelPlan.destination_id == Destination.id).filter(
+            TravelPlan.user_id == current_user.id
+        ).group_by(Destination.id).all()
         
         if not destinations_data:
             return jsonify({
@@ -780,14 +818,19 @@ def destination_comparison_data():
                 'destinations': []
             })
         
+        # Load trip dates once and group them by destination
+        trips_by_destination = defaultdict(list)
+        trip_dates = db.session.query(
+            TravelPlan.destination_id, TravelPlan.start_date, TravelPlan.end_date
+        ).filter(TravelPlan.user_id == current_user.id).all()
+        for trip in trip_dates:
+            trips_by_destination[trip.destination_id].append(trip)
+        
         # Compute data for each destination
         destination_stats = []
         for dest in destinations_data:
             # Calculate average duration of stay at this destination
-            trips = TravelPlan.query.filter_by(
-                user_id=current_user.id,
-                destination=dest.destination
-            ).all()
+            trips = trips_by_destination[dest.id]
             
             total_days = 0
             valid_trips = 0
@@ -827,23 +870,29 @@ def destination_comparison_data():
 
 @statistics_bp.route('/api/statistics/travel-timeline')
 @login_required
+@read_replica
 def travel_timeline_data():
-    """API endpoint that returns user's travel timeline data"""
+    """API endpoint that returns user's travel timeline data
+    
+    Trips come newest first, one page at a time: pass the returned
+    ``next_cursor`` as ``?cursor=`` to get the next page (``?limit=`` sets the size).
+    """
+    try:
+        page = keyset_page(
+            TravelPlan.query.filter_by(user_id=current_user.id),
+            TravelPlan.start_date, TravelPlan.id,
+            cursor=request.args.get('cursor'), limit=request.args.get('limit'), descending=True
+        )
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid cursor'
+        }), 400
+    
     try:
-        # Get user's travel plans ordered by start date
-        travel_plans = TravelPlan.query.filter_by(
-            user_id=current_user.id
-        ).order_by(TravelPlan.start_date.desc()).all()
-        
-        if not travel_plans:
-            return jsonify({
-                'success': True,
-                'trips': []
-            })
-        
         # Prepare timeline data
         timeline_data = []
-        for plan in travel_plans:
+        for plan in page.items:
             # Check if dates are valid
             if not plan.start_date or not plan.end_date:
                 continue
@@ -856,12 +905,14 @@ def travel_timeline_data():
                 'start_date': plan.start_date.isoformat(),
                 'end_date': plan.end_date.isoformat(),
                 'budget': float(plan.budget) if plan.budget else None,
-                'description': plan.description
+                'description': plan.interests
             })
         
         return jsonify({
             'success': True,
-            'trips': timeline_data
+            'trips': timeline_data,
+            'next_cursor': page.next_cursor,
+            'next_url': next_page_url(page)
         })
     
     except Exception as e:
@@ -873,6 +924,7 @@ def travel_timeline_data():
 
 @statistics_bp.route('/api/expenses/by-trip')
 @login_required
+@read_replica
 def expenses_by_trip():
     """API endpoint that returns expense data categorized by trip"""
     try:
@@ -889,6 +941,9 @@ def expenses_by_trip():
         # Aggregate categories
         all_categories = {}
         
+        # Per-trip category totals come from a single GROUP BY query
+        plan_categories = category_totals_by_plan(current_user.id)
+        
         for plan in travel_plans:
             # Data for each trip
             trip_data = {
@@ -900,25 +955,11 @@ def expenses_by_trip():
                 }
             }
             
-            # Process all expense items in the trip
-            categories_dict = {}
+            categories_dict = plan_categories.get(plan.id, {})
             
-            for item in plan.itinerary_items:
-                if item.cost and item.cost > 0:
-                    # Use the first word of activity as category
-                    category = item.activity.split(' ')[0] if item.activity else 'Other'
-                    
-                    # Add to this trip's category
-                    if category not in categories_dict:
-                        categories_dict[category] = item.cost
-                    else:
-                        categories_dict[category] += item.cost
-                    
-                    # Also add to overall categories
-                    if category not in all_categories:
-                        all_categories[category] = item.cost
-                    else:
-                        all_categories[category] += item.cost
+            # Also add to overall categories
+            for category, value in categories_dict.items():
+                all_categories[category] = all_categories.get(category, 0) + value
             
             # Convert dict to lists
             for category, value in categories_dict.items():
@@ -0,0 +1,292 @@
+"""Full-Text Search Module
+
+Searches a user's travel plans and memories by relevance instead of
+scanning their text columns with LIKE:
+
+1. Two search indexes hold one document per row. ``plan_search`` covers the
+   plan title, destination and interests plus the activities and notes of
+   its itinerary items; ``memory_search`` covers the memory title, location,
+   description and tag names
+2. On SQLite they are FTS5 virtual tables keyed by the row id and ranked
+   with bm25. On PostgreSQL they are tables with a weighted ``tsvector``
+   column behind a GIN index, ranked with ts_rank_cd
+3. The documents of changed plans and memories are rebuilt in the same
+   transaction as the change (see the session hook at the bottom of this
+   module). Code that writes with Core statements instead of the ORM calls
+   ``reindex_plans``/``reindex_memories`` itself
+
+Every word typed must match as a word prefix, so results appear while the
+user is still typing. ``flask rebuild-search-index`` rebuilds both indexes.
+"""
+import re
+
+from flask import request, url_for
+from sqlalchemy import Float, Integer, bindparam, event, inspect, text
+
+from app import db
+
+DEFAULT_RESULTS_PER_PAGE = 12
+MAX_RESULTS_PER_PAGE = 50
+MAX_QUERY_WORDS = 8
+
+_WORD = re.compile(r'\w+')
+
+
+class SearchIndex:
+    """A search index over one table
+
+    Args:
+        name: Index table name
+        key: Row id column of the PostgreSQL table
+        source: Indexed table
+        columns: (name, bm25 weight, tsvector weight) per document column
+        documents: Per dialect, a SELECT of ``row_id`` and the document
+            columns ``c1``..``cN`` from the source table aliased ``src``
+    """
+
+    def __init__(self, name, key, source, columns, documents):
+        self.name = name
+        self.key = key
+        self.source = source
+        self.columns = columns
+        self.documents = documents
+
+    def create_statements(self, dialect):
+        if dialect == 'sqlite':
+            names = ', '.join(column for column, _, _ in self.columns)
+            return [
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} USING fts5({names}, "
+                f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            ]
+        return [
+            f'CREATE TABLE IF NOT EXISTS {self.name} ('
+            f'{self.key} INTEGER PRIMARY KEY REFERENCES {self.source} (id) ON DELETE CASCADE, '
+            f'document TSVECTOR NOT NULL)',
+            f'CREATE INDEX IF NOT EXISTS ix_{self.name}_document ON {self.name} USING GIN (document)',
+        ]
+
+    def reindex_statements(self, dialect, filtered):
+        """DELETE and INSERT that rebuild the documents (of the rows in ``:ids`` if filtered)"""
+        documents = self.documents[dialect] + (' WHERE src.id IN :ids' if filtered else '')
+        numbered = [f'c{i}' for i in range(1, len(self.columns) + 1)]
+
+        if dialect == 'sqlite':
+            names = ', '.join(column for column, _, _ in self.columns)
+            delete = f'DELETE FROM {self.name}' + (' WHERE rowid IN :ids' if filtered else '')
+            insert = (f'INSERT INTO {self.name} (rowid, {names}) '
+                      f'SELECT row_id, {", ".join(numbered)} FROM ({documents})')
+        else:
+            vector = ' || '.join(
+                f"setweight(to_tsvector('simple', d.{number}), '{label}')"
+                for number, (_, _, label) in zip(numbered, self.columns)
+            )
+            delete = f'DELETE FROM {self.name}' + (f' WHERE {self.key} IN :ids' if filtered else '')
+            insert = (f'INSERT INTO {self.name} ({self.key}, document) '
+                      f'SELECT d.row_id, {vector} FROM ({documents}) AS d')
+        return delete, insert
+
+    def matches(self, dialect, words):
+        """Subquery of (id, rank) for the rows matching every word, best rank lowest"""
+        if dialect == 'sqlite':
+            weights = ', '.join(str(weight) for _, weight, _ in self.columns)
+            statement = text(
+                f'SELECT rowid AS id, bm25({self.name}, {weights}) AS rank '
+                f'FROM {self.name} WHERE {self.name} MATCH :query'
+            ).bindparams(query=' '.join(f'"{word}"*' for word in words))
+        else:
+            statement = text(
+                f"SELECT {self.key} AS id, -ts_rank_cd(document, to_tsquery('simple', :query)) AS rank "
+                f"FROM {self.name} WHERE document @@ to_tsquery('simple', :query)"
+            ).bindparams(query=' & '.join(f'{word}:*' for word in words))
+        return statement.columns(id=Integer, rank=Float).subquery(f'{self.name}_matches')
+
+
+PLAN_INDEX = SearchIndex(
+    'plan_search', 'plan_id', 'travel_plan',
+    columns=(
+        ('title', 10.0, 'A'),
+        ('destination', 8.0, 'A'),
+        ('interests', 3.0, 'B'),
+        ('itinerary', 1.0, 'C'),
+    ),
+    documents={
+        dialect: (
+            "SELECT src.id AS row_id, src.title AS c1, src.destination AS c2, "
+            "coalesce(src.interests, '') AS c3, "
+            f"coalesce((SELECT {aggregate}(i.activity || ' ' || coalesce(i.notes, ''), ' ') "
+            "FROM itinerary_item i WHERE i.travel_plan_id = src.id), '') AS c4 "
+            "FROM travel_plan src"
+        )
+        for dialect, aggregate in (('sqlite', 'group_concat'), ('postgresql', 'string_agg'))
+    },
+)
+
+MEMORY_INDEX = SearchIndex(
+    'memory_search', 'memory_id', 'memory',
+    columns=(
+        ('title', 10.0, 'A'),
+        ('location', 6.0, 'B'),
+        ('description', 2.0, 'C'),
+        ('tags', 4.0, 'B'),
+    ),
+    documents={
+        dialect: (
+            "SELECT src.id AS row_id, src.title AS c1, coalesce(src.location, '') AS c2, "
+            "coalesce(src.description, '') AS c3, "
+            f"coalesce((SELECT {aggregate}(t.normalized_name, ' ') FROM memory_tags mt "
+            "JOIN tag t ON t.id = mt.tag_id WHERE mt.memory_id = src.id), '') AS c4 "
+            "FROM memory src"
+        )
+        for dialect, aggregate in (('sqlite', 'group_concat'), ('postgresql', 'string_agg'))
+    },
+)
+
+SEARCH_INDEXES = (PLAN_INDEX, MEMORY_INDEX)
+
+
+def supported(dialect):
+    """Whether full-text search is available on this database dialect"""
+    return dialect in ('sqlite', 'postgresql')
+
+
+def create_search_tables(connection):
+    """Create the search indexes if they do not exist"""
+    dialect = connection.dialect.name
+    if supported(dialect):
+        for index in SEARCH_INDEXES:
+            for statement in index.create_statements(dialect):
+                connection.exec_driver_sql(statement)
+
+
+def drop_search_tables(connection):
+    """Drop the search indexes"""
+    if supported(connection.dialect.name):
+        for index in SEARCH_INDEXES:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {index.name}')
+
+
+def _reindex(connection, index, row_ids):
+    dialect = connection.dialect.name
+    if not supported(dialect):
+        return
+    filtered = row_ids is not None
+    params = {}
+    if filtered:
+        params['ids'] = sorted(set(row_ids))
+        if not params['ids']:
+            return
+    for statement in index.reindex_statements(dialect, filtered):
+        clause = text(statement)
+        if filtered:
+            clause = clause.bindparams(bindparam('ids', expanding=True))
+        connection.execute(clause, params)
+
+
+def reindex_plans(connection, plan_ids=None):
+    """Rebuild the search documents of travel plans
+
+    Args:
+        connection: Connection of the current transaction
+        plan_ids: Plans to reindex (deleted plans are removed), or None for every plan
+    """
+    _reindex(connection, PLAN_INDEX, plan_ids)
+
+
+def reindex_memories(connection, memory_ids=None):
+    """Rebuild the search documents of memories
+
+    Args:
+        connection: Connection of the current transaction
+        memory_ids: Memories to reindex (deleted memories are removed), or None for every memory
+    """
+    _reindex(connection, MEMORY_INDEX, memory_ids)
+
+
+def query_words(query):
+    """Words of a search box query, lowercased (at most MAX_QUERY_WORDS)"""
+    return [word.lower() for word in _WORD.findall(query or '')][:MAX_QUERY_WORDS]
+
+
+def ranked(query, model, index, words):
+    """Restrict an ORM query to rows matching ``words`` and order it by relevance"""
+    matches = index.matches(db.session.get_bind().dialect.name, words)
+    return query.join(matches, matches.c.id == model.id).order_by(matches.c.rank, model.id)
+
+
+class SearchResults:
+    """One page of search results and the total number of matches"""
+
+    def __init__(self, items, total_count, page, per_page):
+        self.items = items
+        self.total_count = total_count
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def has_more(self):
+        return self.page * self.per_page < self.total_count
+
+
+def paginate_results(query, page=None, per_page=None):
+    """Fetch one page of an ordered query with its total count"""
+    try:
+        page = max(1, int(page or 1))
+    except (TypeError, ValueError):
+        page = 1
+    try:
+        per_page = int(per_page or DEFAULT_RESULTS_PER_PAGE)
+    except (TypeError, ValueError):
+        per_page = DEFAULT_RESULTS_PER_PAGE
+    per_page = max(1, min(per_page, MAX_RESULTS_PER_PAGE))
+
+    total_count = query.order_by(None).count()
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return SearchResults(items, total_count, page, per_page)
+
+
+def next_results_url(results):
+    """URL of the page of results after ``results``, or None"""
+    if not results.has_more:
+        return None
+    args = request.args.to_dict()
+    args.pop('xhr', None)
+    args['page'] = results.page + 1
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+
+# Keep the index tables alongside the models for db.create_all()/drop_all()
+event.listen(db.metadata, 'after_create', lambda target, connection, **kw: create_search_tables(connection))
+event.listen(db.metadata, 'before_drop', lambda target, connection, **kw: drop_search_tables(connection))
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@event.listens_for(db.session, 'after_flush')
+def refresh_search_documents(session, flush_context):
+    """Reindex the plans and memories whose searchable text was written"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+    from app.models.memory import Memory
+
+    plan_ids, memory_ids = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        dirty = obj in session.dirty
+        if isinstance(obj, TravelPlan):
+            if not dirty or _changed(obj, 'title', 'destination', 'interests'):
+                plan_ids.add(obj.id)
+        elif isinstance(obj, ItineraryItem):
+            if not dirty or _changed(obj, 'activity', 'notes', 'travel_plan_id'):
+                plan_ids.add(obj.travel_plan_id)
+                plan_ids.update(inspect(obj).attrs.travel_plan_id.history.deleted or ())
+        elif isinstance(obj, Memory):
+            if not dirty or _changed(obj, 'title', 'location', 'description', 'tags'):
+                memory_ids.add(obj.id)
+
+    plan_ids.discard(None)
+    memory_ids.discard(None)
+    if plan_ids:
+        reindex_plans(session.connection(), plan_ids)
+    if memory_ids:
+        reindex_memories(session.connection(), memory_ids)
@@ -0,0 +1,269 @@
+"""Spatial Index Module
+
+Answers "which memories and itinerary items are inside this map view" (or
+within a radius of a point) without loading every row that has coordinates:
+
+1. Two point indexes hold one entry per row with coordinates:
+   ``memory_geo`` for memories and ``itinerary_item_geo`` for itinerary items
+2. On SQLite they are R-tree virtual tables (``rtree`` module). On
+   PostgreSQL they are tables with a built-in ``point`` column behind a GiST
+   index, queried with ``<@ box``; with PostGIS the same GiST index serves
+   ``ST_MakeEnvelope`` lookups. R-tree boxes are stored as 32-bit floats,
+   so index hits are re-checked against the exact lat/lng columns
+3. Entries of changed rows are rebuilt in the same transaction as the change
+   (see the session hooks at the bottom of this module). Code that writes
+   with Core statements calls ``reindex_memory_points``/``reindex_item_points``
+
+Bounding boxes use Leaflet's ``toBBoxString()`` order, "west,south,east,north".
+A box that crosses the antimeridian (west > east) is split in two.
+"""
+from math import atan2, cos, radians, sin, sqrt
+
+from sqlalchemy import Integer, and_, bindparam, event, inspect, or_, select, text
+
+from app import db
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE_LAT = 111.32
+MAX_RADIUS_KM = 500
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    return EARTH_RADIUS_KM * c
+
+
+class BoundingBox:
+    """A lat/lng rectangle, with west > east when it crosses the antimeridian"""
+
+    def __init__(self, west, south, east, north):
+        self.west = west
+        self.south = south
+        self.east = east
+        self.north = north
+
+    @classmethod
+    def parse(cls, value):
+        """Box from "west,south,east,north"
+
+        Longitudes are wrapped into [-180, 180] and latitudes clamped to
+        [-90, 90]. A box 360 degrees wide or more covers every longitude.
+
+        Raises:
+            ValueError: If the value is not four numbers with south <= north
+        """
+        try:
+            west, south, east, north = (float(part) for part in (value or '').split(','))
+        except ValueError:
+            raise ValueError('bbox must be "west,south,east,north"')
+        if any(coordinate != coordinate for coordinate in (west, south, east, north)) or south > north:
+            raise ValueError('bbox must be "west,south,east,north"')
+
+        south, north = max(south, -90.0), min(north, 90.0)
+        if east - west >= 360:
+            return cls(-180.0, south, 180.0, north)
+        return cls(_wrap_lng(west), south, _wrap_lng(east), north)
+
+    @classmethod
+    def around(cls, lat, lng, radius_km):
+        """Smallest box containing the circle of ``radius_km`` around a point"""
+        dlat = radius_km / KM_PER_DEGREE_LAT
+        south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        if south <= -90 or north >= 90:
+            return cls(-180.0, south, 180.0, north)
+        dlng = dlat / cos(radians(max(abs(south), abs(north))))
+        if dlng >= 180:
+            return cls(-180.0, south, 180.0, north)
+        return cls(_wrap_lng(lng - dlng), south, _wrap_lng(lng + dlng), north)
+
+    def parts(self):
+        """(west, south, east, north) boxes that do not cross the antimeridian"""
+        if self.west <= self.east:
+            return [(self.west, self.south, self.east, self.north)]
+        return [(self.west, self.south, 180.0, self.north), (-180.0, self.south, self.east, self.north)]
+
+    def contains(self, lat_column, lng_column):
+        """SQL condition on exact coordinate columns"""
+        return or_(*(
+            and_(lat_column.between(south, north), lng_column.between(west, east))
+            for west, south, east, north in self.parts()
+        ))
+
+
+def _wrap_lng(lng):
+    if -180 <= lng <= 180:
+        return lng
+    return (lng + 180) % 360 - 180
+
+
+class SpatialIndex:
+    """A point index over the ``lat``/``lng`` columns of one table"""
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+
+    def create_statements(self, dialect):
+        if dialect == 'sqlite':
+            return [f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} '
+                    f'USING rtree(id, min_lat, max_lat, min_lng, max_lng)']
+        return [
+            f'CREATE TABLE IF NOT EXISTS {self.name} ('
+            f'id INTEGER PRIMARY KEY REFERENCES {self.source} (id) ON DELETE CASCADE, '
+            f'location POINT NOT NULL)',
+            f'CREATE INDEX IF NOT EXISTS ix_{self.name}_location ON {self.name} USING GIST (location)',
+        ]
+
+    def reindex_statements(self, dialect, filtered):
+        """DELETE and INSERT that rebuild the entries (of the rows in ``:ids`` if filtered)"""
+        where = 'lat IS NOT NULL AND lng IS NOT NULL' + (' AND id IN :ids' if filtered else '')
+        delete = f'DELETE FROM {self.name}' + (' WHERE id IN :ids' if filtered else '')
+        if dialect == 'sqlite':
+            insert = (f'INSERT INTO {self.name} (id, min_lat, max_lat, min_lng, max_lng) '
+                      f'SELECT id, lat, lat, lng, lng FROM {self.source} WHERE {where}')
+        else:
+            insert = (f'INSERT INTO {self.name} (id, location) '
+                      f'SELECT id, point(lng, lat) FROM {self.source} WHERE {where}')
+        return delete, insert
+
+    def within(self, dialect, bbox):
+        """Subquery of the ids whose point may lie inside ``bbox``"""
+        conditions, params = [], {}
+        for i, (west, south, east, north) in enumerate(bbox.parts()):
+            params.update({f'west{i}': west, f'south{i}': south, f'east{i}': east, f'north{i}': north})
+            if dialect == 'sqlite':
+                conditions.append(f'(max_lat >= :south{i} AND min_lat <= :north{i} '
+                                  f'AND max_lng >= :west{i} AND min_lng <= :east{i})')
+            else:
+                conditions.append(f'location <@ box(point(:west{i}, :south{i}), point(:east{i}, :north{i}))')
+        statement = text(f'SELECT id FROM {self.name} WHERE {" OR ".join(conditions)}').bindparams(**params)
+        return statement.columns(id=Integer).subquery(f'{self.name}_hits')
+
+
+MEMORY_POINTS = SpatialIndex('memory_geo', 'memory')
+ITEM_POINTS = SpatialIndex('itinerary_item_geo', 'itinerary_item')
+
+SPATIAL_INDEXES = (MEMORY_POINTS, ITEM_POINTS)
+
+
+def supported(dialect):
+    """Whether the spatial indexes are available on this database dialect"""
+    return dialect in ('sqlite', 'postgresql')
+
+
+def create_spatial_tables(connection):
+    """Create the spatial indexes if they do not exist"""
+    dialect = connection.dialect.name
+    if supported(dialect):
+        for index in SPATIAL_INDEXES:
+            for statement in index.create_statements(dialect):
+                connection.exec_driver_sql(statement)
+
+
+def drop_spatial_tables(connection):
+    """Drop the spatial indexes"""
+    if supported(connection.dialect.name):
+        for index in SPATIAL_INDEXES:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {index.name}')
+
+
+def _reindex(connection, index, row_ids):
+    dialect = connection.dialect.name
+    if not supported(dialect):
+        return
+    filtered = row_ids is not None
+    params = {}
+    if filtered:
+        params['ids'] = sorted(set(row_ids))
+        if not params['ids']:
+            return
+    for statement in index.reindex_statements(dialect, filtered):
+        clause = text(statement)
+        if filtered:
+            clause = clause.bindparams(bindparam('ids', expanding=True))
+        connection.execute(clause, params)
+
+
+def reindex_memory_points(connection, memory_ids=None):
+    """Rebuild the spatial entries of memories (None for every memory)"""
+    _reindex(connection, MEMORY_POINTS, memory_ids)
+
+
+def reindex_item_points(connection, item_ids=None):
+    """Rebuild the spatial entries of itinerary items (None for every item)"""
+    _reindex(connection, ITEM_POINTS, item_ids)
+
+
+def in_bbox(query, model, index, bbox):
+    """Restrict an ORM query over ``model`` to rows inside ``bbox``"""
+    hits = index.within(db.session.get_bind().dialect.name, bbox)
+    return query.join(hits, hits.c.id == model.id).filter(bbox.contains(model.lat, model.lng))
+
+
+def within_radius(query, model, index, lat, lng, radius_km):
+    """Rows of an ORM query within ``radius_km`` of a point, nearest first
+
+    Returns:
+        list of (row, distance in km)
+    """
+    rows = in_bbox(query, model, index, BoundingBox.around(lat, lng, radius_km)).all()
+    nearby = [(row, haversine_distance(lat, lng, row.lat, row.lng)) for row in rows]
+    return sorted((pair for pair in nearby if pair[1] <= radius_km), key=lambda pair: pair[1])
+
+
+# Keep the index tables alongside the models for db.create_all()/drop_all()
+event.listen(db.metadata, 'after_create', lambda target, connection, **kw: create_spatial_tables(connection))
+event.listen(db.metadata, 'before_drop', lambda target, connection, **kw: drop_spatial_tables(connection))
+
+
+def _moved(obj):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in ('lat', 'lng'))
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_cascaded_item_points(session, flush_context, instances):
+    """Remember the items of deleted plans, which ON DELETE CASCADE removes unseen"""
+    from app.models.travel_plan import TravelPlan, ItineraryItem
+
+    plan_ids = [obj.id for obj in session.deleted if isinstance(obj, TravelPlan)]
+    if plan_ids:
+        item_ids = session.connection().execute(
+            select(ItineraryItem.id).where(ItineraryItem.travel_plan_id.in_(plan_ids))
+        ).scalars()
+        session.info.setdefault('cascaded_item_ids', set()).update(item_ids)
+
+
+@event.listens_for(db.session, 'after_flush')
+def refresh_spatial_entries(session, flush_context):
+    """Reindex the memories and itinerary items whose coordinates were written"""
+    from app.models.travel_plan import ItineraryItem
+    from app.models.memory import Memory
+
+    memory_ids, item_ids = set(), session.info.pop('cascaded_item_ids', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj in session.dirty and not (isinstance(obj, (Memory, ItineraryItem)) and _moved(obj)):
+            continue
+        if isinstance(obj, Memory):
+            memory_ids.add(obj.id)
+        elif isinstance(obj, ItineraryItem):
+            item_ids.add(obj.id)
+
+    memory_ids.discard(None)
+    item_ids.discard(None)
+    if memory_ids:
+        reindex_memory_points(session.connection(), memory_ids)
+    if item_ids:
+        reindex_item_points(session.connection(), item_ids)
@@ -0,0 +1,82 @@
+/**
+ * Infinite Scroll
+ * Appends the next page of a keyset-paginated listing when its
+ * "Load more" link scrolls into view. Without JavaScript the link
+ * simply opens the next page.
+ *
+ * Markup:
+ *   <div data-infinite-scroll="#list-id"><a href="/next?cursor=...">Load more</a></div>
+ *
+ * The next page is requested with ?xhr=true and must answer
+ * { success, html, next_url }.
+ */
+
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-infinite-scroll]').forEach(initInfiniteScroll);
+});
+
+/**
+ * Wire up one "Load more" block
+ * @param {HTMLElement} loader - Element holding the link to the next page
+ */
+function initInfiniteScroll(loader) {
+    const list = document.querySelector(loader.getAttribute('data-infinite-scroll'));
+    const link = loader.querySelector('a');
+    if (!list || !link) return;
+
+    let loading = false;
+    let failed = false;
+
+    function loadNextPage() {
+        if (loading) return;
+        loading = true;
+        link.classList.add('disabled');
+
+        const url = new URL(link.href, window.location);
+        url.searchParams.set('xhr', 'true');
+
+        fetch(url.toString(), { headers: { 'Accept': 'application/json' } })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Network response was not ok');
+                }
+                return response.json();
+            })
+            .then(data => {
+                list.insertAdjacentHTML('beforeend', data.html);
+                list.dispatchEvent(new CustomEvent('infinite-scroll:loaded', { bubbles: true }));
+
+                if (data.next_url) {
+                    link.href = data.next_url;
+                    link.classList.remove('disabled');
+                    loading = false;
+                } else {
+                    if (observer) observer.disconnect();
+                    loader.remove();
+                }
+            })
+            .catch(error => {
+                // Leave the link in place so a click still opens the next page
+                console.error('Error loading more items:', error);
+                failed = true;
+                link.classList.remove('disabled');
+                if (observer) observer.disconnect();
+            });
+    }
+
+    link.addEventListener('click', function(e) {
+        if (failed) return;
+        e.preventDefault();
+        loadNextPage();
+    });
+
+    let observer = null;
+    if ('IntersectionObserver' in window) {
+        observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextPage();
+            }
+        }, { rootMargin: '200px' });
+        observer.observe(loader);
+    }
+}
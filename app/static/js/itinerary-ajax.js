@@ -437,7 +437,7 @@ function addItemToDOM(item) {
     itemElement.setAttribute('data-item-id', item.id);
     
     // Format time if available
-    const timeDisplay = item.time ? `${item.time} - ` : '';
+    const timeDisplay = item.time ? `${item.time_display || item.time} - ` : '';
     
     // Format cost if available
     const costDisplay = item.cost ? `<span class="badge bg-success">$${item.cost.toFixed(2)}</span>` : '';
@@ -488,7 +488,7 @@ function updateItemInDOM(item) {
     }
     
     // Format time if available
-    const timeDisplay = item.time ? `${item.time} - ` : '';
+    const timeDisplay = item.time ? `${item.time_display || item.time} - ` : '';
     
     // Format cost if available
     const costDisplay = item.cost ? `<span class="badge bg-success">$${item.cost.toFixed(2)}</span>` : '';
@@ -31,6 +31,16 @@ function initPlansSearch() {
         searchPlans(searchInput.value);
     }, 500)); // 500ms delay to avoid too many requests while typing
     
+    // Re-run the search when the date range or sort order changes
+    ['#date-range', '#sort-by'].forEach(selector => {
+        const select = document.querySelector(selector);
+        if (select) {
+            select.addEventListener('change', function() {
+                searchPlans(searchInput.value);
+            });
+        }
+    });
+
     // Handle destination filter dropdown
     const destinationFilters = document.querySelectorAll('.destination-filter');
     destinationFilters.forEach(filter => {
@@ -88,10 +98,10 @@ function searchPlans(query) {
     if (sortBy) params.append('sort', sortBy);
     params.append('xhr', 'true');
     
-    // Update URL with search parameters without reload
-    const url = new URL(window.location);
-    url.search = params.toString().replace('xhr=true&', '').replace('&xhr=true', '');
-    window.history.pushState({}, '', url);
+    // Update URL with search parameters without reload (reloading shows the same results)
+    const pageParams = new URLSearchParams(params);
+    pageParams.delete('xhr');
+    window.history.pushState({}, '', `/planner/search?${pageParams.toString()}`);
     
     // Send AJAX request to search plans
     fetch(`/planner/search?${params.toString()}`)
@@ -102,7 +112,7 @@ function searchPlans(query) {
             return response.json();
         })
         .then(data => {
-            updatePlansDisplay(data.plans, data.total_count, query);
+            updatePlansDisplay(data, query);
         })
         .catch(error => {
             console.error('Error searching plans:', error);
@@ -118,17 +128,17 @@ function searchPlans(query) {
 
 /**
  * Update the plans display with search results
- * @param {Array} plans - The filtered plans data
- * @param {number} totalCount - Total number of matching plans
+ * @param {Object} data - Search response: plans, total_count, html (rendered cards) and next_url
  * @param {string} query - The search query
  */
-function updatePlansDisplay(plans, totalCount, query) {
+function updatePlansDisplay(data, query) {
     const plansContainer = document.querySelector('.plans-container');
     if (!plansContainer) return;
     
     plansContainer.classList.remove('loading');
     
     // Update search results count
+    const totalCount = data.total_count;
     const resultsCount = document.querySelector('#search-results-count');
     if (resultsCount) {
         if (query) {
@@ -139,7 +149,7 @@ function updatePlansDisplay(plans, totalCount, query) {
         }
     }
     
-    if (plans.length === 0) {
+    if (data.plans.length === 0) {
         plansContainer.innerHTML = `
             <div class="text-center py-5">
                 <div class="empty-state">
@@ -166,60 +176,24 @@ function updatePlansDisplay(plans, totalCount, query) {
         return;
     }
     
-    // Build the HTML for each plan
-    let plansHTML = '';
-    plans.forEach((plan, index) => {
-        // Format dates
-        const startDate = new Date(plan.start_date);
-        const endDate = new Date(plan.end_date);
-        const createdAt = new Date(plan.created_at);
-        
-        const startFormatted = startDate.toLocaleDateString('en-US', { month: 'short', day: 'numeric' });
-        const endFormatted = endDate.toLocaleDateString('en-US', { month: 'short', day: 'numeric', year: 'numeric' });
-        const createdFormatted = createdAt.toLocaleDateString('en-US', { month: 'short', day: 'numeric', year: 'numeric' });
-        
-        plansHTML += `
-            <div class="col-md-6 col-lg-4 animate fade-in" style="animation-delay: ${index * 0.1}s;">
-                <div class="card h-100">
-                    <div class="card-body">
-                        <div class="d-flex justify-content-between align-items-center mb-3">
-                            <h5 class="card-title mb-0">${plan.title}</h5>
-                            ${plan.is_public ? '<span class="badge bg-info">Public</span>' : ''}
-                        </div>
-                        <div class="d-flex align-items-center mb-2">
-                            <i class="fas fa-map-marker-alt text-danger me-2"></i>
-                            <span>${plan.destination}</span>
-                        </div>
-                        <div class="d-flex align-items-center mb-2">
-                            <i class="fas fa-calendar text-primary me-2"></i>
-                            <span>${startFormatted} - ${endFormatted}</span>
-                        </div>
-                        <div class="d-flex align-items-center mb-3">
-                            <i class="fas fa-money-bill-wave text-success me-2"></i>
-                            <span>Budget: $${plan.budget}</span>
-                        </div>
-                        <p class="card-text small text-muted mb-3">
-                            ${plan.interests ? plan.interests.substring(0, 100) + (plan.interests.length > 100 ? '...' : '') : 'No interests specified'}
-                        </p>
-                        <div class="d-flex align-items-center small text-muted mb-3">
-                            <i class="fas fa-clock me-2"></i>
-                            <span>Created ${createdFormatted}</span>
-                        </div>
-                        <div class="d-flex justify-content-between">
-                            <a href="/planner/view/${plan.id}" class="btn btn-primary btn-sm">
-                                <i class="fas fa-eye me-1"></i> View
-                            </a>
-                            <a href="/planner/edit/${plan.id}" class="btn btn-outline-secondary btn-sm">
-                                <i class="fas fa-edit me-1"></i> Edit
-                            </a>
-                        </div>
-                    </div>
-                </div>
-            </div>
-        `;
-    });
-    
-    plansContainer.innerHTML = `<div class="row g-4">${plansHTML}</div>`;
+    // The cards are rendered by the server, the same partial as the plans page
+    plansContainer.innerHTML = `<div class="row g-4" id="plans-list">${data.html}</div>`;
+    
+    // Further result pages load as the user scrolls
+    if (data.next_url) {
+        const loader = document.createElement('div');
+        loader.className = 'text-center mt-4';
+        loader.setAttribute('data-infinite-scroll', '#plans-list');
+        const link = document.createElement('a');
+        link.href = data.next_url;
+        link.className = 'btn btn-outline-primary';
+        link.textContent = 'Load more plans';
+        loader.appendChild(link);
+        plansContainer.appendChild(loader);
+        if (typeof initInfiniteScroll === 'function') {
+            initInfiniteScroll(loader);
+        }
+    }
 }
 
 /**
@@ -45,6 +45,10 @@ function initializeStatisticsMap() {
         maxZoom: 19
     }).addTo(map);
     
+    // Optional density heatmap of all memories and itinerary stops, rendered server-side as tiles
+    const heatmapLayer = L.tileLayer(heatmapTileUrl, { maxZoom: 19, maxNativeZoom: 18, opacity: 0.8 });
+    L.control.layers(null, { 'Travel heatmap': heatmapLayer }).addTo(map);
+    
     // Add home marker with custom icon
     const homeIcon = L.divIcon({
         className: 'custom-div-icon',
@@ -18,6 +18,7 @@ def register_filters(app):
         import decimal
         from app.models.travel_plan import ItineraryItem
         from app.models.memory import Memory
+        from app.itinerary_time import display_time
         
         class CustomJSONEncoder(python_json.JSONEncoder):
             def default(self, obj):
@@ -28,12 +29,15 @@ def register_filters(app):
                         'id': obj.id,
                         'day': obj.day,
                         'time': obj.time,
+                        'minutes': obj.minutes,
+                        'time_display': display_time(obj),
                         'activity': obj.activity,
                         'location': obj.location,
                         'lat': obj.lat,
                         'lng': obj.lng,
                         'cost': float(obj.cost) if obj.cost else 0,
-                        'notes': obj.notes
+                        'notes': obj.notes,
+                        'category': obj.category
                     }
                 if isinstance(obj, Memory):
                     return {
@@ -56,6 +60,12 @@ def register_filters(app):
         
         return python_json.dumps(obj, cls=CustomJSONEncoder)
     
+    @app.template_filter('item_time')
+    def item_time(item):
+        """Display an itinerary item's time from its stored minutes (e.g. '2:30 PM')."""
+        from app.itinerary_time import display_time
+        return display_time(item)
+    
     @app.template_filter('from_json')
     def convert_from_json(json_str):
         """Convert a JSON string back to a Python object."""
@@ -106,7 +116,10 @@ def register_filters(app):
             from flask import request
             return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
             
+        from app.fragment_cache import cache_fragment
+            
         return dict(
             day_timedelta=day_timedelta,
-            is_ajax_request=is_ajax_request
+            is_ajax_request=is_ajax_request,
+            cache_fragment=cache_fragment
         )
@@ -0,0 +1,256 @@
+"""Trending Destinations Module
+
+Keeps a global, cross-user view of which destinations people are planning
+trips to right now, without scanning the travel_plan table on each request:
+
+1. Every committed TravelPlan insert adds its normalized destination to a
+   Count-Min sketch (a small fixed-size grid of counters that over-estimates
+   frequencies by a bounded amount)
+2. Each time window ("day", "week", "month") is a ring of buckets, one
+   sketch per bucket plus a running total sketch. When a bucket falls out of
+   the window its counters are subtracted from the total
+3. A bounded set of heavy-hitter candidates (a min-heap of the current
+   top counts) is updated on every insert, so reading the top destinations
+   costs O(k) no matter how many plans exist
+
+The sketches live in process memory. They are warmed from the database
+(plans created within the longest window) the first time they are used and
+fed by the plans this process commits. Other workers' plans only reach them
+through the database, so the sketches are rebuilt once they are older than
+the smallest bucket: workers agree to within one bucket.
+"""
+import hashlib
+import heapq
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# window name -> (bucket size, number of buckets)
+WINDOWS = OrderedDict([
+    ('day', (timedelta(hours=1), 24)),
+    ('week', (timedelta(days=1), 7)),
+    ('month', (timedelta(days=1), 30)),
+])
+DEFAULT_WINDOW = 'week'
+
+SKETCH_WIDTH = 1024
+SKETCH_DEPTH = 4
+TOP_K = 50  # Number of heavy-hitter candidates tracked per window
+REBUILD_AFTER = min(size for size, _ in WINDOWS.values())
+
+
+class CountMinSketch:
+    """Count-Min sketch with ``depth`` rows of ``width`` counters"""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        # Two 64-bit hashes combined as h1 + i * h2 give ``depth`` independent columns
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Add ``count`` occurrences of ``key`` and return its new estimate"""
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        """Estimated number of occurrences of ``key`` (never an under-estimate)"""
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def subtract(self, other):
+        """Remove every count recorded in ``other`` (a sketch of the same shape)"""
+        for row, other_row in zip(self.rows, other.rows):
+            for i, value in enumerate(other_row):
+                if value:
+                    row[i] -= value
+
+
+class TopK:
+    """Keeps the ``capacity`` keys with the highest counts seen so far"""
+
+    def __init__(self, capacity=TOP_K):
+        self.capacity = capacity
+        self.counts = {}
+        self._heap = []  # (count, key), may contain stale entries
+
+    def update(self, key, count):
+        if key in self.counts:
+            self.counts[key] = count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+        else:
+            smallest = self._min()
+            if count <= smallest[0]:
+                return
+            del self.counts[smallest[1]]
+            heapq.heappop(self._heap)
+            self.counts[key] = count
+        heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _min(self):
+        # Drop stale heap entries until the top matches the live count
+        while self._heap[0][0] != self.counts.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def _rebuild(self):
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def refresh(self, sketch):
+        """Re-read every candidate's count from ``sketch`` after buckets expire"""
+        self.counts = {key: sketch.estimate(key) for key in self.counts}
+        self.counts = {key: count for key, count in self.counts.items() if count > 0}
+        self._rebuild()
+
+    def top(self, limit):
+        return sorted(self.counts.items(), key=lambda pair: (-pair[1], pair[0]))[:limit]
+
+
+class SlidingWindow:
+    """Count-Min sketch and top-k over a window made of fixed-size buckets"""
+
+    def __init__(self, bucket_size, bucket_count):
+        self.bucket_seconds = int(bucket_size.total_seconds())
+        self.bucket_count = bucket_count
+        self.buckets = OrderedDict()  # bucket index -> CountMinSketch
+        self.total = CountMinSketch()
+        self.top_k = TopK()
+
+    def _bucket_index(self, when):
+        return int(when.timestamp()) // self.bucket_seconds
+
+    def advance(self, now):
+        """Expire buckets that are no longer inside the window ending at ``now``"""
+        oldest = self._bucket_index(now) - self.bucket_count + 1
+        expired = False
+        while self.buckets and next(iter(self.buckets)) < oldest:
+            _, sketch = self.buckets.popitem(last=False)
+            self.total.subtract(sketch)
+            expired = True
+        if expired:
+            self.top_k.refresh(self.total)
+
+    def add(self, key, when, now):
+        self.advance(now)
+        index = self._bucket_index(when)
+        if index < self._bucket_index(now) - self.bucket_count + 1:
+            return
+        bucket = self.buckets.get(index)
+        if bucket is None:
+            bucket = self.buckets[index] = CountMinSketch()
+            # Keep buckets ordered oldest first (inserts are almost always the newest)
+            for later in [i for i in self.buckets if i > index]:
+                self.buckets.move_to_end(later)
+        bucket.add(key)
+        self.top_k.update(key, self.total.add(key))
+
+    def top(self, limit, now):
+        self.advance(now)
+        return self.top_k.top(limit)
+
+
+class TrendingTracker:
+    """All trending windows plus the lazy warm-up from the database"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.windows = {name: SlidingWindow(*spec) for name, spec in WINDOWS.items()}
+        self.loaded = False
+        self.loaded_at = None
+
+    def stale(self, now=None):
+        """Whether the sketches need (re)building from the database"""
+        now = now or datetime.utcnow()
+        return not self.loaded or now - self.loaded_at >= REBUILD_AFTER
+
+    def record(self, key, when=None, now=None):
+        now = now or datetime.utcnow()
+        with self._lock:
+            for window in self.windows.values():
+                window.add(key, when or now, now)
+
+    def top(self, window=DEFAULT_WINDOW, limit=10, now=None):
+        now = now or datetime.utcnow()
+        with self._lock:
+            return self.windows[window].top(limit, now)
+
+    def load(self, rows, now=None):
+        """Warm the sketches from (destination name, created_at) rows"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            self.reset()
+            for key, created_at in sorted(rows, key=lambda row: row[1]):
+                for window in self.windows.values():
+                    window.add(key, created_at, now)
+            self.loaded = True
+            self.loaded_at = now
+
+
+tracker = TrendingTracker()
+
+
+def _recent_plan_rows():
+    """(destination name, created_at) for plans inside the longest window"""
+    from app import db
+    from app.models.travel_plan import TravelPlan
+    from app.models.destination import Destination
+
+    longest = max(size * count for size, count in WINDOWS.values())
+    query = db.select(Destination.name, TravelPlan.created_at).join(
+        TravelPlan, TravelPlan.destination_id == Destination.id
+    ).where(TravelPlan.created_at >= datetime.utcnow() - longest)
+
+    # Use a separate connection: this may run from an after_commit hook
+    with db.engine.connect() as connection:
+        return connection.execute(query).fetchall()
+
+
+def ensure_loaded():
+    """Warm the sketches from the database when first needed or older than a bucket"""
+    if tracker.stale():
+        tracker.load(_recent_plan_rows())
+
+
+def record_destinations(names):
+    """Feed newly committed plan destinations into the sketches"""
+    if tracker.stale():
+        # The rebuild query already sees the newly committed plans
+        ensure_loaded()
+        return
+    for name in names:
+        tracker.record(name)
+
+
+def trending_destinations(window=DEFAULT_WINDOW, limit=10):
+    """Most planned destinations across all users in a time window
+
+    Args:
+        window: One of WINDOWS ("day", "week", "month")
+        limit: Maximum number of destinations returned
+
+    Returns:
+        list of dicts with ``destination`` and estimated ``count``
+    """
+    if window not in WINDOWS:
+        raise ValueError(f'Unknown trending window: {window}')
+    ensure_loaded()
+    return [
+        {'destination': name, 'count': count}
+        for name, count in tracker.top(window, limit)
+    ]
@@ -0,0 +1,56 @@
+"""Add spatial indexes for memory and itinerary item coordinates
+
+Revision ID: 0b6d3e9a5c72
+Revises: f2a7c4d9e136
+Create Date: 2025-05-29 11:27:03.448519
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0b6d3e9a5c72'
+down_revision = 'f2a7c4d9e136'
+branch_labels = None
+depends_on = None
+
+# Index table -> indexed table, as of this revision (see app/spatial.py)
+SPATIAL_TABLES = {'memory_geo': 'memory', 'itinerary_item_geo': 'itinerary_item'}
+
+
+def create_statements(dialect, name, source):
+    if dialect == 'sqlite':
+        return [f'CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING rtree(id, min_lat, max_lat, min_lng, max_lng)']
+    return [
+        f'CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY REFERENCES {source} (id) '
+        f'ON DELETE CASCADE, location POINT NOT NULL)',
+        f'CREATE INDEX IF NOT EXISTS ix_{name}_location ON {name} USING GIST (location)',
+    ]
+
+
+def index_statement(dialect, name, source):
+    if dialect == 'sqlite':
+        return (f'INSERT INTO {name} (id, min_lat, max_lat, min_lng, max_lng) '
+                f'SELECT id, lat, lat, lng, lng FROM {source} WHERE lat IS NOT NULL AND lng IS NOT NULL')
+    return (f'INSERT INTO {name} (id, location) '
+            f'SELECT id, point(lng, lat) FROM {source} WHERE lat IS NOT NULL AND lng IS NOT NULL')
+
+
+def upgrade():
+    # R-tree tables on SQLite, point columns with GiST indexes on PostgreSQL
+    connection = op.get_bind()
+    dialect = connection.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        return
+    for name, source in SPATIAL_TABLES.items():
+        for statement in create_statements(dialect, name, source):
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql(f'DELETE FROM {name}')
+        connection.exec_driver_sql(index_statement(dialect, name, source))
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name in ('sqlite', 'postgresql'):
+        for name in SPATIAL_TABLES:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {name}')
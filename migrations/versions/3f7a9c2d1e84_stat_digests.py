@@ -0,0 +1,36 @@
+"""Add stored t-digests for percentile statistics
+
+Revision ID: 3f7a9c2d1e84
+Revises: 8c4e2f6b9d15
+Create Date: 2025-05-22 09:48:13.604127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a9c2d1e84'
+down_revision = '8c4e2f6b9d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # No backfill: plan digests are built on the first percentile read
+    op.create_table('stat_digest',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('scope', sa.String(length=20), nullable=False),
+    sa.Column('scope_id', sa.Integer(), nullable=False),
+    sa.Column('metric', sa.String(length=30), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.Column('stale', sa.Boolean(), nullable=False, server_default=sa.false()),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('scope', 'scope_id', 'metric', name='uq_stat_digest_scope_metric')
+    )
+
+
+def downgrade():
+    op.drop_table('stat_digest')
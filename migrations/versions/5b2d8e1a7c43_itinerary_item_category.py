@@ -0,0 +1,104 @@
+"""Add persisted expense category to itinerary items
+
+Revision ID: 5b2d8e1a7c43
+Revises: 44c225cf1f6c
+Create Date: 2025-05-20 10:12:41.208315
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2d8e1a7c43'
+down_revision = '44c225cf1f6c'
+branch_labels = None
+depends_on = None
+
+# The keyword rules of app/expense_categories.py as of this revision
+CATEGORY_RULES = [
+    ('Accommodation', frozenset((
+        'hotel', 'hostel', 'airbnb', 'accommodation', 'resort', 'motel', 'lodge',
+        'inn', 'guesthouse', 'ryokan', 'checkin', 'checkout', 'stay', 'camping',
+    ))),
+    ('Transport', frozenset((
+        'flight', 'fly', 'airport', 'train', 'bus', 'taxi', 'uber', 'lyft', 'ferry',
+        'metro', 'subway', 'tram', 'shuttle', 'transfer', 'rental', 'car', 'drive',
+        'parking', 'fuel', 'petrol', 'transit',
+    ))),
+    ('Food', frozenset((
+        'breakfast', 'brunch', 'lunch', 'dinner', 'supper', 'meal', 'food', 'eat',
+        'restaurant', 'cafe', 'coffee', 'bakery', 'bar', 'pub', 'drinks', 'snack',
+        'tasting', 'wine', 'beer', 'dining', 'picnic', 'street-food', 'dessert',
+    ))),
+    ('Shopping', frozenset((
+        'shopping', 'shop', 'mall', 'souvenir', 'souvenirs', 'boutique', 'market',
+        'bazaar', 'outlet', 'gift', 'gifts',
+    ))),
+    ('Entertainment', frozenset((
+        'show', 'concert', 'theatre', 'theater', 'cinema', 'movie', 'festival',
+        'club', 'nightlife', 'game', 'match', 'spa', 'massage', 'class', 'workshop',
+        'hike', 'hiking', 'dive', 'diving', 'snorkel', 'snorkeling', 'ski', 'skiing',
+        'surf', 'surfing', 'kayak', 'kayaking', 'cruise', 'safari', 'bike', 'cycling',
+    ))),
+    ('Sightseeing', frozenset((
+        'visit', 'tour', 'museum', 'gallery', 'temple', 'shrine', 'church',
+        'cathedral', 'castle', 'palace', 'monument', 'landmark', 'park', 'garden',
+        'zoo', 'aquarium', 'tower', 'bridge', 'beach', 'view', 'viewpoint',
+        'sightseeing', 'walk', 'explore', 'square', 'ruins',
+    ))),
+]
+
+_WORD_RE = re.compile(r"[a-z]+(?:-[a-z]+)*")
+
+
+def classify(activity):
+    """Category of an activity by the keyword rules, or 'Other'"""
+    words = set()
+    for word in _WORD_RE.findall((activity or '').lower()):
+        words.add(word)
+        if '-' in word:
+            words.add(word.replace('-', ''))
+            words.update(word.split('-'))
+    for name, keywords in CATEGORY_RULES:
+        if words & keywords:
+            return name
+    return 'Other'
+
+
+def upgrade():
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('category', sa.String(length=30), nullable=True))
+        batch_op.add_column(sa.Column('category_overridden', sa.Boolean(), nullable=False,
+                                      server_default=sa.false()))
+        batch_op.create_index(batch_op.f('ix_itinerary_item_category'), ['category'], unique=False)
+
+    # Backfill existing rows with the keyword rules
+    itinerary_item = sa.table(
+        'itinerary_item',
+        sa.column('id', sa.Integer),
+        sa.column('activity', sa.String),
+        sa.column('category', sa.String),
+    )
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(itinerary_item.c.id, itinerary_item.c.activity)).fetchall()
+    updates = [
+        {'item_id': row.id, 'category': classify(row.activity)}
+        for row in rows
+    ]
+    if updates:
+        connection.execute(
+            itinerary_item.update()
+            .where(itinerary_item.c.id == sa.bindparam('item_id'))
+            .values(category=sa.bindparam('category')),
+            updates
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_itinerary_item_category'))
+        batch_op.drop_column('category_overridden')
+        batch_op.drop_column('category')
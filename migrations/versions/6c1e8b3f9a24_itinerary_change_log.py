@@ -0,0 +1,43 @@
+"""Add per-plan revisions and the itinerary change log
+
+Revision ID: 6c1e8b3f9a24
+Revises: 0b6d3e9a5c72
+Create Date: 2025-06-02 10:14:52.380617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c1e8b3f9a24'
+down_revision = '0b6d3e9a5c72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('revision', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('change_floor', sa.Integer(), nullable=False, server_default='0'))
+
+    # Existing items are part of every plan's revision 0 snapshot, so the log starts empty
+    op.create_table(
+        'itinerary_change',
+        sa.Column('travel_plan_id', sa.Integer(), nullable=False),
+        sa.Column('item_id', sa.Integer(), nullable=False),
+        sa.Column('revision', sa.Integer(), nullable=False),
+        sa.Column('inserted_revision', sa.Integer(), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['travel_plan_id'], ['travel_plan.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('travel_plan_id', 'item_id')
+    )
+    op.create_index('ix_itinerary_change_plan_revision', 'itinerary_change', ['travel_plan_id', 'revision'])
+
+
+def downgrade():
+    op.drop_index('ix_itinerary_change_plan_revision', table_name='itinerary_change')
+    op.drop_table('itinerary_change')
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.drop_column('change_floor')
+        batch_op.drop_column('revision')
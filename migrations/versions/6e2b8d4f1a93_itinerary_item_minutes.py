@@ -0,0 +1,83 @@
+"""Add sortable minutes-since-midnight column to itinerary items
+
+Revision ID: 6e2b8d4f1a93
+Revises: a41d6e8f2b57
+Create Date: 2025-05-24 15:21:09.337162
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2b8d4f1a93'
+down_revision = 'a41d6e8f2b57'
+branch_labels = None
+depends_on = None
+
+# The time parser of app/itinerary_time.py as of this revision
+_TIME_PATTERN = re.compile(
+    r'^(?P<hour>\d{1,2})(?:[:.h]?(?P<minute>\d{2}))?(?::\d{2})?\s*(?P<period>[ap])?\.?\s*m?\.?$',
+    re.IGNORECASE
+)
+
+
+def parse_time(value):
+    """Minutes since midnight of a time of day, or None"""
+    match = _TIME_PATTERN.match(str(value).strip())
+    if not match:
+        return None
+    hour = int(match.group('hour'))
+    minute = int(match.group('minute') or 0)
+    period = (match.group('period') or '').lower()
+    if period:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if period == 'p' else 0)
+    elif match.group('minute') is None:
+        return None
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+
+def upgrade():
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('minutes', sa.SmallInteger(), nullable=True))
+        batch_op.drop_index('ix_itinerary_item_plan_day_time')
+        batch_op.create_index('ix_itinerary_item_plan_day_minutes', ['travel_plan_id', 'day', 'minutes'], unique=False)
+
+    # Backfill: parse every stored time once and rewrite it as "HH:MM"
+    itinerary_item = sa.table(
+        'itinerary_item',
+        sa.column('id', sa.Integer),
+        sa.column('time', sa.String),
+        sa.column('minutes', sa.SmallInteger),
+    )
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(itinerary_item.c.id, itinerary_item.c.time)
+        .where(itinerary_item.c.time.isnot(None))
+    ).fetchall()
+
+    updates = []
+    for row in rows:
+        minutes = parse_time(row.time)
+        if minutes is not None:
+            updates.append({'item_id': row.id, 'minutes': minutes, 'time': f'{minutes // 60:02d}:{minutes % 60:02d}'})
+    if updates:
+        connection.execute(
+            itinerary_item.update()
+            .where(itinerary_item.c.id == sa.bindparam('item_id'))
+            .values(minutes=sa.bindparam('minutes'), time=sa.bindparam('time')),
+            updates
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_itinerary_item_plan_day_minutes')
+        batch_op.create_index('ix_itinerary_item_plan_day_time', ['travel_plan_id', 'day', 'time'], unique=False)
+        batch_op.drop_column('minutes')
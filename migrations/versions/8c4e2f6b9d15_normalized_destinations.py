@@ -0,0 +1,189 @@
+"""Add normalized destination table referenced by travel plans
+
+Revision ID: 8c4e2f6b9d15
+Revises: 5b2d8e1a7c43
+Create Date: 2025-05-21 14:37:02.551870
+
+"""
+import json
+import os
+import string
+from collections import namedtuple
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e2f6b9d15'
+down_revision = '5b2d8e1a7c43'
+branch_labels = None
+depends_on = None
+
+# The destination parser of app/destinations.py as of this revision; only the
+# bundled country and city lists are read from the app
+DATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'app', 'data')
+
+ParsedDestination = namedtuple(
+    'ParsedDestination',
+    ['key', 'name', 'city', 'country', 'country_code', 'lat', 'lng']
+)
+
+
+def _clean(text):
+    return ' '.join((text or '').split()).strip(' ,.')
+
+
+def load_data():
+    """(code -> country name, lower-cased name or alias -> code, lower-cased city -> [code, lat, lng])"""
+    with open(os.path.join(DATA_DIR, 'countries.json'), encoding='utf-8') as f:
+        countries = json.load(f)
+    with open(os.path.join(DATA_DIR, 'cities.json'), encoding='utf-8') as f:
+        cities = json.load(f)
+    names, aliases = {}, {}
+    for code, info in countries.items():
+        names[code] = info['name']
+        aliases[info['name'].lower()] = code
+        for alias in info.get('aliases', []):
+            aliases[alias.lower()] = code
+    return names, aliases, cities
+
+
+def parse_destination(text, data):
+    names, aliases, cities = data
+    parts = [_clean(part) for part in (text or '').split(',')]
+    parts = [part for part in parts if part]
+    if not parts:
+        return None
+
+    city = parts[0]
+    if city.islower():
+        city = string.capwords(city)
+    country_code = aliases.get(parts[-1].lower())
+    if country_code and len(parts) == 1:
+        city = None
+    # A region or state instead of a country ("Paris, Texas") stays a place of its own
+    region = ', '.join(parts[1:]) if country_code is None and len(parts) > 1 else None
+    if region and region.islower():
+        region = string.capwords(region)
+
+    lat = lng = None
+    if city and region is None:
+        entry = cities.get(city.lower())
+        if entry:
+            if country_code is None:
+                country_code = entry[0]
+            if entry[0] == country_code:
+                lat, lng = entry[1], entry[2]
+
+    country = names.get(country_code) if country_code else None
+    name = ', '.join(part for part in (city, region or country) if part)
+    key_city = name if region else city
+    return ParsedDestination(
+        key=f"{(key_city or '').lower()}|{country_code or ''}",
+        name=name,
+        city=city,
+        country=country,
+        country_code=country_code,
+        lat=lat,
+        lng=lng
+    )
+
+
+def upgrade():
+    destination = op.create_table('destination',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=160), nullable=False),
+    sa.Column('name', sa.String(length=160), nullable=False),
+    sa.Column('city', sa.String(length=100), nullable=True),
+    sa.Column('city_key', sa.String(length=100), nullable=True),
+    sa.Column('country', sa.String(length=100), nullable=True),
+    sa.Column('country_code', sa.String(length=2), nullable=True),
+    sa.Column('lat', sa.Float(), nullable=True),
+    sa.Column('lng', sa.Float(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('key')
+    )
+    with op.batch_alter_table('destination', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_destination_city_key'), ['city_key'], unique=False)
+        batch_op.create_index(batch_op.f('ix_destination_country_code'), ['country_code'], unique=False)
+
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('destination_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_travel_plan_destination_id'), ['destination_id'], unique=False)
+        batch_op.create_foreign_key('fk_travel_plan_destination_id_destination',
+                                    'destination', ['destination_id'], ['id'])
+
+    # Backfill: resolve every distinct destination string once
+    connection = op.get_bind()
+    travel_plan = sa.table(
+        'travel_plan',
+        sa.column('id', sa.Integer),
+        sa.column('destination', sa.String),
+        sa.column('dest_lat', sa.Float),
+        sa.column('dest_lng', sa.Float),
+        sa.column('destination_id', sa.Integer),
+    )
+    plans = connection.execute(sa.select(
+        travel_plan.c.id, travel_plan.c.destination,
+        travel_plan.c.dest_lat, travel_plan.c.dest_lng
+    )).fetchall()
+
+    data = load_data()
+    parsed_plans = [(plan, parse_destination(plan.destination, data)) for plan in plans]
+    # Destinations with a known country first, so bare city names can reuse them
+    parsed_plans.sort(key=lambda pair: pair[1] is None or pair[1].country_code is None)
+
+    destination_ids = {}
+    countries_by_city = {}
+    updates = []
+    for plan, parsed in parsed_plans:
+        if parsed is None:
+            continue
+
+        key = parsed.key
+        if parsed.country_code is None and parsed.city and parsed.name == parsed.city:
+            known = countries_by_city.get(parsed.city.lower(), set())
+            if len(known) == 1:
+                key = f"{parsed.city.lower()}|{next(iter(known))}"
+
+        if key not in destination_ids:
+            result = connection.execute(destination.insert().values(
+                key=key,
+                name=parsed.name,
+                city=parsed.city,
+                city_key=parsed.city.lower() if parsed.city else None,
+                country=parsed.country,
+                country_code=parsed.country_code,
+                lat=parsed.lat if parsed.lat is not None else plan.dest_lat,
+                lng=parsed.lng if parsed.lng is not None else plan.dest_lng,
+                created_at=datetime.utcnow()
+            ))
+            destination_ids[key] = result.inserted_primary_key[0]
+            if parsed.city and parsed.country_code:
+                countries_by_city.setdefault(parsed.city.lower(), set()).add(parsed.country_code)
+
+        updates.append({'plan_id': plan.id, 'destination_id': destination_ids[key]})
+
+    if updates:
+        connection.execute(
+            travel_plan.update()
+            .where(travel_plan.c.id == sa.bindparam('plan_id'))
+            .values(destination_id=sa.bindparam('destination_id')),
+            updates
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_travel_plan_destination_id_destination', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_travel_plan_destination_id'))
+        batch_op.drop_column('destination_id')
+
+    with op.batch_alter_table('destination', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_destination_country_code'))
+        batch_op.drop_index(batch_op.f('ix_destination_city_key'))
+
+    op.drop_table('destination')
@@ -0,0 +1,37 @@
+"""Add denormalized total_cost and item_count to travel plans
+
+Revision ID: 9d4a7c1e5b26
+Revises: 6e2b8d4f1a93
+Create Date: 2025-05-25 10:42:51.804213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4a7c1e5b26'
+down_revision = '6e2b8d4f1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('total_cost', sa.Float(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('item_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from the existing itinerary items in one statement
+    op.execute(
+        "UPDATE travel_plan SET "
+        "total_cost = (SELECT COALESCE(SUM(cost), 0) FROM itinerary_item "
+        "WHERE itinerary_item.travel_plan_id = travel_plan.id), "
+        "item_count = (SELECT COUNT(id) FROM itinerary_item "
+        "WHERE itinerary_item.travel_plan_id = travel_plan.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.drop_column('item_count')
+        batch_op.drop_column('total_cost')
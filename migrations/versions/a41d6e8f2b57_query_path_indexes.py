@@ -0,0 +1,66 @@
+"""Add composite indexes for the hot query paths
+
+Revision ID: a41d6e8f2b57
+Revises: 3f7a9c2d1e84
+Create Date: 2025-05-23 11:05:27.918446
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41d6e8f2b57'
+down_revision = '3f7a9c2d1e84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.create_index('ix_travel_plan_user_id_start_date', ['user_id', 'start_date'], unique=False)
+
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.create_index('ix_itinerary_item_plan_day_time', ['travel_plan_id', 'day', 'time'], unique=False)
+
+    with op.batch_alter_table('plan_share', schema=None) as batch_op:
+        batch_op.create_index('ix_plan_share_plan_user_status', ['travel_plan_id', 'shared_user_id', 'status'], unique=False)
+        batch_op.create_index('ix_plan_share_user_status', ['shared_user_id', 'status'], unique=False)
+
+    with op.batch_alter_table('memory', schema=None) as batch_op:
+        batch_op.create_index('ix_memory_user_id_visit_date', ['user_id', 'visit_date'], unique=False)
+        batch_op.create_index('ix_memory_user_id_created_at', ['user_id', 'created_at'], unique=False)
+
+    with op.batch_alter_table('memory_tag', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_memory_tag_name'), ['name'], unique=False)
+
+    with op.batch_alter_table('photo', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_photo_memory_id'), ['memory_id'], unique=False)
+
+    # Expression index for case-insensitive email lookups. Not unique, since
+    # existing accounts may differ only by case.
+    op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_email_lower', table_name='user')
+
+    with op.batch_alter_table('photo', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_photo_memory_id'))
+
+    with op.batch_alter_table('memory_tag', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_memory_tag_name'))
+
+    with op.batch_alter_table('memory', schema=None) as batch_op:
+        batch_op.drop_index('ix_memory_user_id_created_at')
+        batch_op.drop_index('ix_memory_user_id_visit_date')
+
+    with op.batch_alter_table('plan_share', schema=None) as batch_op:
+        batch_op.drop_index('ix_plan_share_user_status')
+        batch_op.drop_index('ix_plan_share_plan_user_status')
+
+    with op.batch_alter_table('itinerary_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_itinerary_item_plan_day_time')
+
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.drop_index('ix_travel_plan_user_id_start_date')
@@ -0,0 +1,30 @@
+"""Show tags by their normalized name and remove tags without memories
+
+Revision ID: a7f3c9e1d264
+Revises: d93a5e7b2c48
+Create Date: 2025-06-05 10:42:18.306517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7f3c9e1d264'
+down_revision = 'd93a5e7b2c48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('DELETE FROM tag WHERE NOT EXISTS (SELECT 1 FROM memory_tags WHERE memory_tags.tag_id = tag.id)')
+    with op.batch_alter_table('tag', schema=None) as batch_op:
+        batch_op.drop_column('name')
+
+
+def downgrade():
+    with op.batch_alter_table('tag', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('name', sa.String(length=50), nullable=True))
+    op.execute('UPDATE tag SET name = normalized_name')
+    with op.batch_alter_table('tag', schema=None) as batch_op:
+        batch_op.alter_column('name', existing_type=sa.String(length=50), nullable=False)
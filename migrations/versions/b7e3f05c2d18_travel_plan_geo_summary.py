@@ -0,0 +1,46 @@
+"""Add itinerary centroid and bounding box to travel plans
+
+Revision ID: b7e3f05c2d18
+Revises: 9d4a7c1e5b26
+Create Date: 2025-05-25 16:08:37.116540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3f05c2d18'
+down_revision = '9d4a7c1e5b26'
+branch_labels = None
+depends_on = None
+
+GEO_COLUMNS = ('centroid_lat', 'centroid_lng', 'min_lat', 'min_lng', 'max_lat', 'max_lng')
+
+
+def upgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('geo_count', sa.Integer(), nullable=False, server_default='0'))
+        for name in GEO_COLUMNS:
+            batch_op.add_column(sa.Column(name, sa.Float(), nullable=True))
+
+    # Backfill from the existing items with coordinates
+    located = ("FROM itinerary_item WHERE itinerary_item.travel_plan_id = travel_plan.id "
+               "AND itinerary_item.lat IS NOT NULL AND itinerary_item.lng IS NOT NULL")
+    op.execute(
+        "UPDATE travel_plan SET "
+        f"geo_count = (SELECT COUNT(id) {located}), "
+        f"centroid_lat = (SELECT AVG(lat) {located}), "
+        f"centroid_lng = (SELECT AVG(lng) {located}), "
+        f"min_lat = (SELECT MIN(lat) {located}), "
+        f"min_lng = (SELECT MIN(lng) {located}), "
+        f"max_lat = (SELECT MAX(lat) {located}), "
+        f"max_lng = (SELECT MAX(lng) {located})"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('travel_plan', schema=None) as batch_op:
+        for name in reversed(GEO_COLUMNS):
+            batch_op.drop_column(name)
+        batch_op.drop_column('geo_count')
@@ -0,0 +1,43 @@
+"""Delete itinerary items, shares, photos and tags with ON DELETE CASCADE
+
+Revision ID: c52f9e4a8d71
+Revises: b7e3f05c2d18
+Create Date: 2025-05-26 09:14:22.581094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52f9e4a8d71'
+down_revision = 'b7e3f05c2d18'
+branch_labels = None
+depends_on = None
+
+# PostgreSQL's default constraint names; SQLite's unnamed constraints get the
+# same names when batch mode reflects and rebuilds the table
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+CASCADES = (
+    ('itinerary_item', 'travel_plan_id', 'travel_plan'),
+    ('plan_share', 'travel_plan_id', 'travel_plan'),
+    ('photo', 'memory_id', 'memory'),
+    ('memory_tag', 'memory_id', 'memory'),
+)
+
+
+def _replace_foreign_keys(ondelete):
+    for table, column, referred in CASCADES:
+        name = f'{table}_{column}_fkey'
+        with op.batch_alter_table(table, schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, referred, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    _replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(None)
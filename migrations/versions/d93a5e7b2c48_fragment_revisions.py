@@ -0,0 +1,30 @@
+"""Store fragment cache revisions in the database
+
+Revision ID: d93a5e7b2c48
+Revises: 6c1e8b3f9a24
+Create Date: 2025-06-04 09:21:07.512843
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd93a5e7b2c48'
+down_revision = '6c1e8b3f9a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Missing keys are revision 0, so the table starts empty
+    op.create_table(
+        'fragment_revision',
+        sa.Column('key', sa.String(length=100), nullable=False),
+        sa.Column('revision', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('fragment_revision')
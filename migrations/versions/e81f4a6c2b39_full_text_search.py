@@ -0,0 +1,73 @@
+"""Add full-text search indexes for travel plans and memories
+
+Revision ID: e81f4a6c2b39
+Revises: c52f9e4a8d71
+Create Date: 2025-05-27 10:42:51.306218
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81f4a6c2b39'
+down_revision = 'c52f9e4a8d71'
+branch_labels = None
+depends_on = None
+
+# The search tables and plan documents as of this revision (see app/search.py)
+CREATE_STATEMENTS = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS plan_search USING fts5(title, destination, interests, itinerary, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS memory_search USING fts5(title, location, description, tags, "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    ],
+    'postgresql': [
+        'CREATE TABLE IF NOT EXISTS plan_search (plan_id INTEGER PRIMARY KEY REFERENCES travel_plan (id) '
+        'ON DELETE CASCADE, document TSVECTOR NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_plan_search_document ON plan_search USING GIN (document)',
+        'CREATE TABLE IF NOT EXISTS memory_search (memory_id INTEGER PRIMARY KEY REFERENCES memory (id) '
+        'ON DELETE CASCADE, document TSVECTOR NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_memory_search_document ON memory_search USING GIN (document)',
+    ],
+}
+
+PLAN_DOCUMENTS = (
+    "SELECT src.id AS row_id, src.title AS c1, src.destination AS c2, coalesce(src.interests, '') AS c3, "
+    "coalesce((SELECT {aggregate}(i.activity || ' ' || coalesce(i.notes, ''), ' ') FROM itinerary_item i "
+    "WHERE i.travel_plan_id = src.id), '') AS c4 FROM travel_plan src"
+)
+
+INDEX_PLANS = {
+    'sqlite': (
+        'INSERT INTO plan_search (rowid, title, destination, interests, itinerary) '
+        'SELECT row_id, c1, c2, c3, c4 FROM (' + PLAN_DOCUMENTS.format(aggregate='group_concat') + ')'
+    ),
+    'postgresql': (
+        "INSERT INTO plan_search (plan_id, document) SELECT d.row_id, "
+        "setweight(to_tsvector('simple', d.c1), 'A') || setweight(to_tsvector('simple', d.c2), 'A') || "
+        "setweight(to_tsvector('simple', d.c3), 'B') || setweight(to_tsvector('simple', d.c4), 'C') "
+        "FROM (" + PLAN_DOCUMENTS.format(aggregate='string_agg') + ") AS d"
+    ),
+}
+
+
+def upgrade():
+    # FTS5 tables on SQLite, tsvector tables with GIN indexes on PostgreSQL
+    connection = op.get_bind()
+    dialect = connection.dialect.name
+    if dialect not in CREATE_STATEMENTS:
+        return
+    for statement in CREATE_STATEMENTS[dialect]:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql('DELETE FROM plan_search')
+    connection.exec_driver_sql(INDEX_PLANS[dialect])
+    # Memory documents read the tag tables of the next revision (f2a7c4d9e136),
+    # which builds them once tags have moved there
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name in CREATE_STATEMENTS:
+        for name in ('plan_search', 'memory_search'):
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {name}')
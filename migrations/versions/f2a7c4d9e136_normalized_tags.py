@@ -0,0 +1,119 @@
+"""Move memory tags into a deduplicated tag table linked through memory_tags
+
+Revision ID: f2a7c4d9e136
+Revises: e81f4a6c2b39
+Create Date: 2025-05-28 14:05:37.912640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a7c4d9e136'
+down_revision = 'e81f4a6c2b39'
+branch_labels = None
+depends_on = None
+
+# Memory search documents as of this revision (see app/search.py)
+MEMORY_DOCUMENTS = (
+    "SELECT src.id AS row_id, src.title AS c1, coalesce(src.location, '') AS c2, "
+    "coalesce(src.description, '') AS c3, coalesce((SELECT {aggregate}(t.name, ' ') FROM memory_tags mt "
+    "JOIN tag t ON t.id = mt.tag_id WHERE mt.memory_id = src.id), '') AS c4 FROM memory src"
+)
+
+INDEX_MEMORIES = {
+    'sqlite': (
+        'INSERT INTO memory_search (rowid, title, location, description, tags) '
+        'SELECT row_id, c1, c2, c3, c4 FROM (' + MEMORY_DOCUMENTS.format(aggregate='group_concat') + ')'
+    ),
+    'postgresql': (
+        "INSERT INTO memory_search (memory_id, document) SELECT d.row_id, "
+        "setweight(to_tsvector('simple', d.c1), 'A') || setweight(to_tsvector('simple', d.c2), 'B') || "
+        "setweight(to_tsvector('simple', d.c3), 'C') || setweight(to_tsvector('simple', d.c4), 'B') "
+        "FROM (" + MEMORY_DOCUMENTS.format(aggregate='string_agg') + ") AS d"
+    ),
+}
+
+
+def normalize_tag(name):
+    """Lookup key of a tag name: trimmed, single-spaced and case-folded"""
+    return ' '.join((name or '').split()).casefold()[:50]
+
+
+def upgrade():
+    op.create_table('tag',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('normalized_name', sa.String(length=50), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('tag', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_tag_normalized_name'), ['normalized_name'], unique=True)
+
+    op.create_table('memory_tags',
+    sa.Column('memory_id', sa.Integer(), nullable=False),
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['memory_id'], ['memory.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('memory_id', 'tag_id')
+    )
+    with op.batch_alter_table('memory_tags', schema=None) as batch_op:
+        batch_op.create_index('ix_memory_tags_tag_id_memory_id', ['tag_id', 'memory_id'], unique=False)
+
+    # Backfill: one tag per normalized name (displayed as first typed), one link per memory
+    connection = op.get_bind()
+    tag = sa.table('tag', sa.column('id', sa.Integer), sa.column('name', sa.String),
+                   sa.column('normalized_name', sa.String))
+    links = sa.table('memory_tags', sa.column('memory_id', sa.Integer), sa.column('tag_id', sa.Integer))
+    rows = connection.execute(sa.text('SELECT memory_id, name FROM memory_tag ORDER BY id')).fetchall()
+
+    tags, pairs = {}, set()
+    for memory_id, name in rows:
+        normalized = normalize_tag(name)
+        if not normalized:
+            continue
+        tags.setdefault(normalized, ' '.join(name.split())[:50])
+        pairs.add((memory_id, normalized))
+
+    if tags:
+        connection.execute(tag.insert(), [
+            {'name': name, 'normalized_name': normalized} for normalized, name in tags.items()
+        ])
+        tag_ids = dict(connection.execute(sa.select(tag.c.normalized_name, tag.c.id)).fetchall())
+        connection.execute(links.insert(), [
+            {'memory_id': memory_id, 'tag_id': tag_ids[normalized]} for memory_id, normalized in sorted(pairs)
+        ])
+
+    with op.batch_alter_table('memory_tag', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_memory_tag_name'))
+    op.drop_table('memory_tag')
+
+    if connection.dialect.name in INDEX_MEMORIES:
+        connection.exec_driver_sql('DELETE FROM memory_search')
+        connection.exec_driver_sql(INDEX_MEMORIES[connection.dialect.name])
+
+
+def downgrade():
+    op.create_table('memory_tag',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('memory_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['memory_id'], ['memory.id'], name='memory_tag_memory_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('memory_tag', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_memory_tag_name'), ['name'], unique=False)
+
+    op.execute(
+        'INSERT INTO memory_tag (name, memory_id) '
+        'SELECT tag.name, memory_tags.memory_id FROM memory_tags JOIN tag ON tag.id = memory_tags.tag_id '
+        'ORDER BY memory_tags.memory_id, tag.name'
+    )
+
+    with op.batch_alter_table('memory_tags', schema=None) as batch_op:
+        batch_op.drop_index('ix_memory_tags_tag_id_memory_id')
+    op.drop_table('memory_tags')
+    with op.batch_alter_table('tag', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tag_normalized_name'))
+    op.drop_table('tag')
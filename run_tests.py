@@ -7,10 +7,11 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 # Import test modules
 from tests.test_auth import TestUserModel, TestAuth
-from tests.test_planner import TestPlannerModel, TestPlannerRoutes
-from tests.test_memories import TestMemoryModel, TestMemoryRoutes
+from tests.test_planner import TestPlannerModel, TestPlannerRoutes, TestTrendingDestinations, TestFragmentCache, TestItineraryTime, TestPlanTotals, TestItineraryImport, TestItineraryBatch, TestItinerarySync, TestPlanEvents, TestPlanAccess
+from tests.test_memories import TestMemoryModel, TestMemoryTags, TestMemoryRoutes
 from tests.test_security import TestSecurityFeatures
-from tests.test_statistics import TestStatisticsRoutes, TestStatisticsCalculations
+from tests.test_performance import TestQueryIndexes, TestDatabaseProfiles, TestReadReplicaRouting, TestCascadeDeletes, TestKeysetPagination, TestFullTextSearch, TestSpatialIndex, TestPointClustering, TestHeatmapTiles, TestBulkItineraryImport, TestDataExport
+from tests.test_statistics import TestStatisticsRoutes, TestStatisticsCalculations, TestDestinationNormalization, TestNearbyCountries, TestPercentileDigests
 
 # Skip Selenium tests unless specifically requested
 if '--with-selenium' in sys.argv:
@@ -32,8 +33,18 @@ def create_test_suite():
     # Add planner tests
     test_suite.addTest(unittest.makeSuite(TestPlannerModel))
     test_suite.addTest(unittest.makeSuite(TestPlannerRoutes))
+    test_suite.addTest(unittest.makeSuite(TestTrendingDestinations))
+    test_suite.addTest(unittest.makeSuite(TestFragmentCache))
+    test_suite.addTest(unittest.makeSuite(TestItineraryTime))
+    test_suite.addTest(unittest.makeSuite(TestPlanTotals))
+    test_suite.addTest(unittest.makeSuite(TestItineraryImport))
+    test_suite.addTest(unittest.makeSuite(TestItineraryBatch))
+    test_suite.addTest(unittest.makeSuite(TestItinerarySync))
+    test_suite.addTest(unittest.makeSuite(TestPlanEvents))
+    test_suite.addTest(unittest.makeSuite(TestPlanAccess))
       # Add memory tests
     test_suite.addTest(unittest.makeSuite(TestMemoryModel))
+    test_suite.addTest(unittest.makeSuite(TestMemoryTags))
     test_suite.addTest(unittest.makeSuite(TestMemoryRoutes))
     
     # Add security tests
@@ -42,6 +53,22 @@ def create_test_suite():
     # Add statistics tests
     test_suite.addTest(unittest.makeSuite(TestStatisticsRoutes))
     test_suite.addTest(unittest.makeSuite(TestStatisticsCalculations))
+    test_suite.addTest(unittest.makeSuite(TestDestinationNormalization))
+    test_suite.addTest(unittest.makeSuite(TestNearbyCountries))
+    test_suite.addTest(unittest.makeSuite(TestPercentileDigests))
+    
+    # Add database index tests
+    test_suite.addTest(unittest.makeSuite(TestQueryIndexes))
+    test_suite.addTest(unittest.makeSuite(TestDatabaseProfiles))
+    test_suite.addTest(unittest.makeSuite(TestReadReplicaRouting))
+    test_suite.addTest(unittest.makeSuite(TestCascadeDeletes))
+    test_suite.addTest(unittest.makeSuite(TestKeysetPagination))
+    test_suite.addTest(unittest.makeSuite(TestFullTextSearch))
+    test_suite.addTest(unittest.makeSuite(TestSpatialIndex))
+    test_suite.addTest(unittest.makeSuite(TestPointClustering))
+    test_suite.addTest(unittest.makeSuite(TestHeatmapTiles))
+    test_suite.addTest(unittest.makeSuite(TestBulkItineraryImport))
+    test_suite.addTest(unittest.makeSuite(TestDataExport))
     
     # Add Selenium tests if requested
     if '--with-selenium' in sys.argv:
@@ -1,11 +1,13 @@
 import unittest
+from unittest import mock
 from datetime import datetime
 from io import BytesIO
 from PIL import Image
 from .base import BaseTestCase
 from app.models.user import User
-from app.models.memory import Memory
+from app.models.memory import Memory, Tag, memory_tags, normalize_tag, tag_counts
 from app import db
+from sqlalchemy import event
 
 class TestMemoryModel(BaseTestCase):
     """Test case for the Memory model"""
@@ -44,6 +46,98 @@ class TestMemoryModel(BaseTestCase):
         self.assertEqual(len(user_memories), 1)
         self.assertEqual(user_memories[0].title, "Test Memory")
 
+
+class TestMemoryTags(BaseTestCase):
+    """Test case for normalized memory tags"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.memory = Memory(title="Kyoto", user_id=self.user.id)
+        db.session.add(self.memory)
+        db.session.commit()
+    
+    def _links(self, memory):
+        return sorted(tag.normalized_name for tag in memory.tags)
+    
+    def test_names_are_normalized_and_shared(self):
+        self.assertEqual(normalize_tag("  Street   Food "), "street food")
+        self.memory.set_tags(["Temples", "temples ", "Street  Food", ""])
+        other = Memory(title="Osaka", user_id=self.user.id)
+        db.session.add(other)
+        other.set_tags(["TEMPLES"])
+        db.session.commit()
+        
+        self.assertEqual(self._links(self.memory), ["street food", "temples"])
+        self.assertEqual(Tag.query.count(), 2)
+        self.assertEqual(self._links(other), ["temples"])
+    
+    def test_edits_only_write_changed_links(self):
+        self.memory.set_tags(["Food", "Art", "Night"])
+        db.session.commit()
+        
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith(('INSERT INTO memory_tags', 'DELETE FROM memory_tags')):
+                statements.append(statement.split()[0])
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            self.memory.set_tags(["food", "Art", "Market"])
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        
+        self.assertEqual(self._links(self.memory), ["art", "food", "market"])
+        self.assertEqual(sorted(statements), ["DELETE", "INSERT"])
+        self.assertEqual(Tag.query.count(), 3, "tags without memories are removed")
+    
+    def test_tag_counts_are_per_user(self):
+        other = Memory(title="Osaka", user_id=self.user.id)
+        foreign = Memory(title="Lisbon", user_id=User.query.filter_by(username="admin").first().id)
+        db.session.add_all([other, foreign])
+        self.memory.set_tags(["Food", "Art"])
+        other.set_tags(["food"])
+        foreign.set_tags(["Food", "Surf"])
+        db.session.commit()
+        
+        counts = [(tag.normalized_name, count) for tag, count in tag_counts(self.user.id)]
+        self.assertEqual(counts, [("food", 2), ("art", 1)])
+    
+    def test_deleting_a_memory_removes_its_links(self):
+        self.memory.set_tags(["Food"])
+        db.session.commit()
+        db.session.delete(self.memory)
+        db.session.commit()
+        
+        self.assertEqual(db.session.query(memory_tags).count(), 0)
+        self.assertEqual(Tag.query.count(), 0)
+    
+    def test_shared_tags_outlive_one_memory(self):
+        other = Memory(title="Osaka", user_id=self.user.id)
+        db.session.add(other)
+        self.memory.set_tags(["Food"])
+        other.set_tags(["food"])
+        db.session.commit()
+        self.memory.set_tags([])
+        db.session.commit()
+        
+        self.assertEqual(self._links(other), ["food"])
+        self.assertEqual(Tag.query.count(), 1)
+    
+    def test_tag_created_by_a_concurrent_save(self):
+        db.session.execute(Tag.__table__.insert().values(normalized_name="food"))
+        # The lookup ran before the other save inserted the tag
+        missed = mock.Mock()
+        missed.filter.return_value.all.return_value = []
+        queries = iter([missed, Tag.query])
+        with mock.patch.object(Tag, 'query', new_callable=mock.PropertyMock, side_effect=lambda: next(queries)):
+            self.memory.set_tags(["Food"])
+        db.session.commit()
+        
+        self.assertEqual(self._links(self.memory), ["food"])
+        self.assertEqual(Tag.query.count(), 1)
+
+
 class TestMemoryRoutes(BaseTestCase):
     """Test cases for memory routes"""
     
@@ -6,8 +6,30 @@ import unittest
 import time
 from .base import BaseTestCase
 from app.models.user import User
-from app.models.travel_plan import TravelPlan
+from app.models.travel_plan import TravelPlan, ItineraryItem, PlanShare
+from app.models.memory import Memory, Tag, Photo, memory_tags, photo_path
 from app import db, create_app
+from sqlalchemy import func, text, create_engine, event
+from flask import Flask
+from app.db_config import configure_database, detect_profile, effective_settings
+from app.db_routing import REPLICA_BIND, LAST_WRITE_KEY, read_replica, sync_sqlite_replica
+from app.pagination import keyset_page, encode_cursor
+from app.search import PLAN_INDEX, MEMORY_INDEX, query_words, ranked, reindex_memories
+from app.spatial import BoundingBox, MEMORY_POINTS, ITEM_POINTS, in_bbox, within_radius
+from app import clustering, exports, heatmap
+from app.commands import register_commands
+from app.itinerary_import import import_items
+from app.clustering import ClusterHierarchy, MAX_CLUSTER_ZOOM, hierarchy_for
+from flask import session as cookie_session
+import os
+import shutil
+import csv
+import json
+import zipfile
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+from PIL import Image
 from datetime import datetime, timedelta
 import random
 
@@ -274,5 +296,944 @@ class TestDatabasePerformance(BaseTestCase):
         self.assertLess(query_time, 0.5, "Search query should be under 0.5 seconds")
 
 
+class TestQueryIndexes(BaseTestCase):
+    """Test that the hot query paths are answered from their indexes"""
+    
+    def _query_plan(self, query):
+        """Return the EXPLAIN QUERY PLAN details for an ORM query"""
+        sql = str(query.statement.compile(
+            dialect=db.engine.dialect,
+            compile_kwargs={'literal_binds': True}
+        ))
+        rows = db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}')).fetchall()
+        return ' | '.join(row[-1] for row in rows)
+    
+    def assertUsesIndex(self, query, index_name):
+        plan = self._query_plan(query)
+        self.assertIn(index_name, plan)
+        # Ordered queries should be satisfied by the index, not a sort step
+        self.assertNotIn('USE TEMP B-TREE', plan)
+    
+    def test_travel_plans_by_user_and_date(self):
+        self.assertUsesIndex(
+            TravelPlan.query.filter_by(user_id=1).order_by(TravelPlan.start_date),
+            'ix_travel_plan_user_id_start_date'
+        )
+    
+    def test_itinerary_in_display_order(self):
+        self.assertUsesIndex(
+            ItineraryItem.query.filter_by(travel_plan_id=1).order_by(ItineraryItem.day, ItineraryItem.minutes),
+            'ix_itinerary_item_plan_day_minutes'
+        )
+    
+    def test_plan_share_lookups(self):
+        self.assertUsesIndex(
+            PlanShare.query.filter_by(travel_plan_id=1, shared_user_id=2, status='accepted'),
+            'ix_plan_share_plan_user_status'
+        )
+        self.assertUsesIndex(
+            PlanShare.query.filter_by(shared_user_id=2, status='pending'),
+            'ix_plan_share_user_status'
+        )
+    
+    def test_memories_by_user_and_date(self):
+        self.assertUsesIndex(
+            Memory.query.filter_by(user_id=1).order_by(Memory.visit_date.desc()),
+            'ix_memory_user_id_visit_date'
+        )
+        self.assertUsesIndex(
+            Memory.query.filter_by(user_id=1).order_by(Memory.created_at.desc()),
+            'ix_memory_user_id_created_at'
+        )
+    
+    def test_memory_children(self):
+        self.assertUsesIndex(Tag.query.filter_by(normalized_name='food'), 'ix_tag_normalized_name')
+        self.assertUsesIndex(
+            Memory.query.join(memory_tags, memory_tags.c.memory_id == Memory.id)
+            .filter(memory_tags.c.tag_id == 1),
+            'ix_memory_tags_tag_id_memory_id'
+        )
+        self.assertUsesIndex(Photo.query.filter_by(memory_id=1), 'ix_photo_memory_id')
+    
+    def test_case_insensitive_email(self):
+        self.assertUsesIndex(
+            User.query.filter(func.lower(User.email) == 'test@example.com'),
+            'ix_user_email_lower'
+        )
+        self.assertEqual(User.find_by_email(' Test@Example.com ').username, 'testuser')
+    
+    def test_case_only_duplicate_emails(self):
+        """Test that accounts differing only by email case are found by their exact address"""
+        shouting = User(username='shouting', email='Test@Example.com')
+        shouting.set_password('password123')
+        db.session.add(shouting)
+        db.session.commit()
+        
+        self.assertEqual(User.find_by_email('Test@Example.com').username, 'shouting')
+        self.assertEqual(User.find_by_email('test@example.com').username, 'testuser')
+        # Other variants always find the oldest account
+        self.assertEqual(User.find_by_email('TEST@EXAMPLE.COM').username, 'testuser')
+        # The few case variants are sorted after the index lookup
+        self.assertIn('ix_user_email_lower', self._query_plan(
+            User.query.filter(func.lower(User.email) == 'test@example.com')
+            .order_by((User.email == 'Test@Example.com').desc(), User.id)
+        ))
+
+
+
+class TestDatabaseProfiles(unittest.TestCase):
+    """Test the SQLite and PostgreSQL engine profiles"""
+    
+    def _configure(self, uri):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        profile = configure_database(app)
+        return profile, app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    
+    def test_profile_detection(self):
+        self.assertEqual(detect_profile('sqlite:///travel_planner.db'), 'sqlite')
+        self.assertEqual(detect_profile('postgresql://u:p@localhost/travel'), 'postgresql')
+        self.assertEqual(detect_profile('mysql://u:p@localhost/travel'), 'default')
+    
+    def test_sqlite_pragmas_applied_on_connect(self):
+        with tempfile.TemporaryDirectory() as directory:
+            uri = f"sqlite:///{os.path.join(directory, 'profile.db')}"
+            profile, options = self._configure(uri)
+            self.assertEqual(profile, 'sqlite')
+            
+            engine = create_engine(uri, **options)
+            settings = effective_settings(engine)
+            engine.dispose()
+        
+        self.assertEqual(settings['journal_mode'], 'wal')
+        self.assertEqual(settings['synchronous'], 1)  # NORMAL
+        self.assertEqual(settings['busy_timeout'], 5000)
+        self.assertEqual(settings['cache_size'], -64000)
+        self.assertEqual(settings['foreign_keys'], 1)
+    
+    def test_postgresql_pool_options(self):
+        profile, options = self._configure('postgresql://u:p@localhost/travel')
+        self.assertEqual(profile, 'postgresql')
+        self.assertEqual(options['pool_size'], 10)
+        self.assertEqual(options['max_overflow'], 20)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertTrue(options['pool_pre_ping'])
+
+
+
+class TestReadReplicaRouting(BaseTestCase):
+    """Test read/write routing between the primary and a SQLite replica file"""
+    
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica = create_engine(f"sqlite:///{os.path.join(self.directory.name, 'replica.db')}")
+        db.metadata.create_all(self.replica)
+        db.engines[REPLICA_BIND] = self.replica
+        
+        # A row that only exists on the replica tells us where a read went
+        with self.replica.begin() as connection:
+            connection.execute(User.__table__.insert().values(
+                username='replica_only', email='replica@example.com'
+            ))
+    
+    def tearDown(self):
+        db.session.info.pop('use_replica', None)
+        db.engines.pop(REPLICA_BIND, None)
+        self.replica.dispose()
+        self.directory.cleanup()
+        super().tearDown()
+    
+    def _on_replica(self):
+        return User.query.filter_by(username='replica_only').first() is not None
+    
+    def test_reads_use_primary_by_default(self):
+        self.assertFalse(self._on_replica())
+    
+    def test_opted_in_reads_use_replica_and_writes_primary(self):
+        db.session.info['use_replica'] = True
+        self.assertTrue(self._on_replica())
+        
+        user = User(username='written', email='written@example.com')
+        db.session.add(user)
+        db.session.commit()
+        
+        db.session.info.pop('use_replica')
+        self.assertIsNotNone(User.query.filter_by(username='written').first())
+        with self.replica.connect() as connection:
+            self.assertEqual(connection.execute(
+                text("SELECT count(*) FROM user WHERE username = 'written'")
+            ).scalar(), 0)
+    
+    def test_read_your_writes_window(self):
+        view = read_replica(lambda: self._on_replica())
+        
+        with self.app.test_request_context('/'):
+            self.assertTrue(view())
+            
+            # Committing ORM changes pins this user's reads to the primary
+            db.session.add(User(username='fresh', email='fresh@example.com'))
+            db.session.commit()
+            self.assertIn(LAST_WRITE_KEY, cookie_session)
+            self.assertFalse(view())
+            
+            cookie_session[LAST_WRITE_KEY] -= self.app.config['READ_YOUR_WRITES_SECONDS'] + 1
+            self.assertTrue(view())
+    
+    def test_sync_sqlite_replica(self):
+        with tempfile.TemporaryDirectory() as directory:
+            primary = create_engine(f"sqlite:///{os.path.join(directory, 'primary.db')}")
+            db.metadata.create_all(primary)
+            with primary.begin() as connection:
+                connection.execute(User.__table__.insert().values(username='p', email='p@example.com'))
+            
+            sync_sqlite_replica(primary, self.replica)
+            with self.replica.connect() as connection:
+                names = [row[0] for row in connection.execute(text('SELECT username FROM user'))]
+            primary.dispose()
+        self.assertEqual(names, ['p'])
+
+
+class TestCascadeDeletes(BaseTestCase):
+    """Test that child rows are removed by ON DELETE CASCADE"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.admin = User.query.filter_by(username="admin").first()
+        self.statements = []
+    
+    def _count_deletes(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('DELETE'):
+            self.statements.append(statement)
+    
+    def _delete(self, obj):
+        event.listen(db.engine, 'before_cursor_execute', self._count_deletes)
+        try:
+            db.session.delete(obj)
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', self._count_deletes)
+    
+    def test_plan_delete_is_one_statement(self):
+        plan = TravelPlan(title="Big Trip", destination="Lisbon, Portugal",
+                          start_date=datetime(2025, 5, 1), end_date=datetime(2025, 5, 10),
+                          user_id=self.user.id)
+        db.session.add(plan)
+        db.session.flush()
+        db.session.add_all([ItineraryItem(day=day % 10 + 1, activity=f"Stop {day}", cost=1,
+                                          travel_plan_id=plan.id) for day in range(50)])
+        db.session.add(PlanShare(travel_plan_id=plan.id, shared_user_id=self.admin.id, status='accepted'))
+        db.session.commit()
+        plan_id = plan.id
+        
+        self._delete(plan)
+        tables = [s.split()[2] for s in self.statements]
+        self.assertEqual(tables.count('travel_plan'), 1)
+        self.assertNotIn('itinerary_item', tables)
+        self.assertNotIn('plan_share', tables)
+        self.assertEqual(ItineraryItem.query.filter_by(travel_plan_id=plan_id).count(), 0)
+        self.assertEqual(PlanShare.query.filter_by(travel_plan_id=plan_id).count(), 0)
+    
+    def test_memory_delete_cascades_and_unlinks_after_commit(self):
+        os.makedirs(os.path.dirname(photo_path('x')), exist_ok=True)
+        memory = Memory(title="Harbour", user_id=self.user.id)
+        db.session.add(memory)
+        db.session.flush()
+        filenames = [f"cascade_test_{memory.id}_{i}.jpg" for i in range(3)]
+        for filename in filenames:
+            open(photo_path(filename), 'w').close()
+            db.session.add(Photo(filename=filename, memory_id=memory.id))
+        memory.set_tags(["Sea"])
+        db.session.commit()
+        memory_id = memory.id
+        
+        # A rolled back delete keeps the files
+        db.session.delete(memory)
+        db.session.flush()
+        db.session.rollback()
+        self.assertTrue(all(os.path.exists(photo_path(name)) for name in filenames))
+        
+        self._delete(memory)
+        self.assertFalse(any(os.path.exists(photo_path(name)) for name in filenames))
+        self.assertNotIn('photo', [s.split()[2] for s in self.statements])
+        self.assertEqual(Photo.query.filter_by(memory_id=memory_id).count(), 0)
+        self.assertEqual(db.session.query(memory_tags).filter_by(memory_id=memory_id).count(), 0)
+
+
+class TestKeysetPagination(BaseTestCase):
+    """Test seek pagination over (sort column, id)"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        # Repeated dates exercise the id tie-breaker, None the NULL segment
+        dates = [datetime(2024, 1, 1), datetime(2024, 3, 1), None, datetime(2024, 3, 1),
+                 datetime(2023, 6, 1), None, datetime(2024, 3, 1), datetime(2022, 1, 1)]
+        for i, visit_date in enumerate(dates):
+            db.session.add(Memory(title=f"Memory {i}", visit_date=visit_date, user_id=self.user.id))
+        db.session.commit()
+        self.memories = Memory.query.filter_by(user_id=self.user.id).all()
+    
+    def _walk(self, descending, limit=3):
+        query = Memory.query.filter_by(user_id=self.user.id)
+        seen, cursor = [], None
+        while True:
+            page = keyset_page(query, Memory.visit_date, Memory.id, cursor=cursor,
+                               limit=limit, descending=descending)
+            self.assertLessEqual(len(page.items), limit)
+            seen.extend(memory.id for memory in page.items)
+            if not page.has_more:
+                return seen
+            cursor = page.next_cursor
+    
+    def test_descending_walk_puts_nulls_last(self):
+        dated = sorted((m for m in self.memories if m.visit_date), key=lambda m: (m.visit_date, m.id), reverse=True)
+        undated = sorted((m.id for m in self.memories if not m.visit_date), reverse=True)
+        self.assertEqual(self._walk(descending=True), [m.id for m in dated] + undated)
+    
+    def test_ascending_walk_puts_nulls_first(self):
+        dated = sorted((m for m in self.memories if m.visit_date), key=lambda m: (m.visit_date, m.id))
+        undated = sorted(m.id for m in self.memories if not m.visit_date)
+        for limit in (1, 2, 5, 20):
+            self.assertEqual(self._walk(descending=False, limit=limit), undated + [m.id for m in dated])
+    
+    def test_rows_added_before_the_cursor_do_not_shift_pages(self):
+        query = Memory.query.filter_by(user_id=self.user.id)
+        first = keyset_page(query, Memory.visit_date, Memory.id, limit=3, descending=True)
+        db.session.add(Memory(title="Newest", visit_date=datetime(2025, 1, 1), user_id=self.user.id))
+        db.session.commit()
+        
+        second = keyset_page(query, Memory.visit_date, Memory.id, cursor=first.next_cursor,
+                             limit=3, descending=True)
+        first_ids = {m.id for m in first.items}
+        self.assertFalse(first_ids & {m.id for m in second.items})
+        self.assertNotIn("Newest", [m.title for m in second.items])
+    
+    def test_invalid_cursors_are_rejected(self):
+        query = Memory.query.filter_by(user_id=self.user.id)
+        for cursor in ('not-a-cursor', encode_cursor(Memory.emotional_rating, 3, 1)):
+            with self.assertRaises(ValueError):
+                keyset_page(query, Memory.visit_date, Memory.id, cursor=cursor)
+
+
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestFullTextSearch(BaseTestCase):
+    """Test the plan and memory search indexes"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.other = User.query.filter_by(username="admin").first()
+    
+    def _plan(self, title, destination, user=None, **kwargs):
+        plan = TravelPlan(title=title, destination=destination, start_date=datetime(2025, 6, 1),
+                          end_date=datetime(2025, 6, 5), user_id=(user or self.user).id, **kwargs)
+        db.session.add(plan)
+        db.session.commit()
+        return plan
+    
+    def _search_plans(self, text, user=None):
+        query = TravelPlan.query.filter_by(user_id=(user or self.user).id)
+        return [plan.title for plan in ranked(query, TravelPlan, PLAN_INDEX, query_words(text)).all()]
+    
+    def _search_memories(self, text):
+        query = Memory.query.filter_by(user_id=self.user.id)
+        return [memory.title for memory in ranked(query, Memory, MEMORY_INDEX, query_words(text)).all()]
+    
+    def test_plan_documents_follow_plans_and_items(self):
+        plan = self._plan("Spring trip", "Kyoto, Japan", interests="temples")
+        self.assertEqual(self._search_plans("kyo"), ["Spring trip"])
+        self.assertEqual(self._search_plans("templ"), ["Spring trip"])
+        
+        item = ItineraryItem(day=1, activity="Fushimi Inari hike", notes="bring water", travel_plan_id=plan.id)
+        db.session.add(item)
+        db.session.commit()
+        self.assertEqual(self._search_plans("inari water"), ["Spring trip"])
+        
+        item.activity = "Tea ceremony"
+        db.session.commit()
+        self.assertEqual(self._search_plans("inari"), [])
+        self.assertEqual(self._search_plans("ceremony"), ["Spring trip"])
+        
+        db.session.delete(plan)
+        db.session.commit()
+        self.assertEqual(self._search_plans("kyoto"), [])
+        remaining = db.session.execute(text("SELECT count(*) FROM plan_search")).scalar()
+        self.assertEqual(remaining, 0)
+    
+    def test_memory_documents_include_tags(self):
+        memory = Memory(title="Night market", location="Taipei", description="Dumplings everywhere",
+                        user_id=self.user.id)
+        db.session.add(memory)
+        db.session.flush()
+        memory.set_tags(["street-food"])
+        db.session.commit()
+        
+        self.assertEqual(self._search_memories("dumpling"), ["Night market"])
+        self.assertEqual(self._search_memories("street food"), ["Night market"])
+        
+        memory.set_tags(["snacks"])
+        db.session.commit()
+        self.assertEqual(self._search_memories("street"), [])
+        self.assertEqual(self._search_memories("snack"), ["Night market"])
+        
+        # Core writes skip the session hooks and reindex explicitly
+        db.session.execute(memory_tags.delete().where(memory_tags.c.memory_id == memory.id))
+        reindex_memories(db.session.connection(), [memory.id])
+        db.session.commit()
+        self.assertEqual(self._search_memories("snack"), [])
+        self.assertEqual(self._search_memories("dumpling"), ["Night market"])
+    
+    def test_results_are_ranked_and_scoped_to_the_user(self):
+        self._plan("Museums and more", "Berlin", interests="lisbon someday")
+        self._plan("Lisbon weekend", "Lisbon, Portugal")
+        self._plan("Lisbon for admin", "Lisbon", user=self.other)
+        
+        self.assertEqual(self._search_plans("lisbon"), ["Lisbon weekend", "Museums and more"])
+        self.assertEqual(self._search_plans("lisbon", user=self.other), ["Lisbon for admin"])
+        self.assertEqual(self._search_plans("lisbon rome"), [])
+    
+    def test_query_words_ignore_search_syntax(self):
+        self.assertEqual(query_words('"Paris" OR NEAR(x*) -tokyo'), ['paris', 'or', 'near', 'x', 'tokyo'])
+        plan = self._plan("Quotes", "Paris")
+        self.assertEqual(self._search_plans('paris" OR "*'), [])
+        self.assertEqual(self._search_plans('"paris"'), ["Quotes"])
+    
+    def test_search_is_fast_on_a_large_account(self):
+        destinations = ["Paris", "Tokyo", "Lima", "Cairo", "Oslo", "Quito", "Hanoi", "Perth"]
+        for i in range(2000):
+            plan = TravelPlan(title=f"Trip {i}", destination=destinations[i % len(destinations)],
+                              interests="food art hiking" if i % 3 else "beaches",
+                              start_date=datetime(2025, 1, 1) + timedelta(days=i % 365),
+                              end_date=datetime(2025, 1, 3) + timedelta(days=i % 365), user_id=self.user.id)
+            plan.itinerary_items.append(ItineraryItem(day=1, activity=f"Activity {i} downtown", notes="booked"))
+            db.session.add(plan)
+        db.session.commit()
+        
+        query = TravelPlan.query.filter_by(user_id=self.user.id)
+        start_time = time.time()
+        for _ in range(5):
+            results = ranked(query, TravelPlan, PLAN_INDEX, query_words("lim hik")).limit(12).all()
+        query_time = (time.time() - start_time) / 5
+        
+        print(f"Full-text plan search: {query_time * 1000:.1f} ms")
+        self.assertEqual(len(results), 12)
+        self.assertLess(query_time, 0.05, "Plan search should be under 50 ms")
+
+
+class TestSpatialIndex(BaseTestCase):
+    """Test the R-tree point indexes and bounding-box queries"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.other = User.query.filter_by(username="admin").first()
+    
+    def _memory(self, title, lat, lng, user=None):
+        memory = Memory(title=title, lat=lat, lng=lng, user_id=(user or self.user).id)
+        db.session.add(memory)
+        db.session.commit()
+        return memory
+    
+    def _memories_in(self, bbox, user=None):
+        query = Memory.query.filter_by(user_id=(user or self.user).id)
+        return sorted(m.title for m in in_bbox(query, Memory, MEMORY_POINTS, BoundingBox.parse(bbox)))
+    
+    def _entries(self, table):
+        return db.session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+    
+    def test_parse_bbox(self):
+        bbox = BoundingBox.parse("2.2,48.8,2.5,48.9")
+        self.assertEqual(bbox.parts(), [(2.2, 48.8, 2.5, 48.9)])
+        self.assertEqual(len(BoundingBox.parse("170,-10,-170,10").parts()), 2)
+        self.assertEqual(BoundingBox.parse("190,0,200,10").parts(), [(-170.0, 0.0, -160.0, 10.0)])
+        self.assertEqual(BoundingBox.parse("-500,-95,500,95").parts(), [(-180.0, -90.0, 180.0, 90.0)])
+        for value in (None, "", "1,2,3", "a,b,c,d", "0,10,1,5", "nan,0,1,1"):
+            with self.assertRaises(ValueError):
+                BoundingBox.parse(value)
+    
+    def test_entries_follow_coordinates(self):
+        memory = self._memory("Louvre", 48.8606, 2.3376)
+        self._memory("No coordinates", None, None)
+        self.assertEqual(self._entries("memory_geo"), 1)
+        self.assertEqual(self._memories_in("2.3,48.85,2.4,48.87"), ["Louvre"])
+        
+        memory.lat, memory.lng = 35.6586, 139.7454
+        db.session.commit()
+        self.assertEqual(self._memories_in("2.3,48.85,2.4,48.87"), [])
+        self.assertEqual(self._memories_in("139,35,140,36"), ["Louvre"])
+        
+        memory.lat = None
+        db.session.commit()
+        self.assertEqual(self._entries("memory_geo"), 0)
+        
+        memory.lat = 35.6586
+        db.session.commit()
+        db.session.delete(memory)
+        db.session.commit()
+        self.assertEqual(self._entries("memory_geo"), 0)
+    
+    def test_plan_delete_removes_item_entries(self):
+        plan = TravelPlan(title="Rome", destination="Rome", start_date=datetime(2025, 6, 1),
+                          end_date=datetime(2025, 6, 3), user_id=self.user.id)
+        db.session.add(plan)
+        db.session.flush()
+        for i in range(3):
+            db.session.add(ItineraryItem(day=1, activity=f"Stop {i}", lat=41.9 + i / 100, lng=12.49,
+                                         travel_plan_id=plan.id))
+        db.session.commit()
+        self.assertEqual(self._entries("itinerary_item_geo"), 3)
+        
+        items = in_bbox(ItineraryItem.query, ItineraryItem, ITEM_POINTS, BoundingBox.parse("12.4,41.89,12.5,41.915")).all()
+        self.assertEqual(sorted(item.activity for item in items), ["Stop 0", "Stop 1"])
+        
+        db.session.delete(plan)
+        db.session.commit()
+        self.assertEqual(self._entries("itinerary_item_geo"), 0)
+    
+    def test_queries_are_scoped_and_cross_the_antimeridian(self):
+        self._memory("Fiji", -17.8, 179.5)
+        self._memory("Samoa", -13.8, -179.5)
+        self._memory("Auckland", -36.8, 174.7)
+        self._memory("Admin's Fiji", -17.8, 179.4, user=self.other)
+        
+        self.assertEqual(self._memories_in("179,-20,-179,-10"), ["Fiji", "Samoa"])
+        self.assertEqual(self._memories_in("179,-20,-179,-10", user=self.other), ["Admin's Fiji"])
+        self.assertEqual(self._memories_in("-180,-90,180,90"), ["Auckland", "Fiji", "Samoa"])
+    
+    def test_radius_query_is_exact_and_sorted(self):
+        self._memory("Eiffel Tower", 48.8584, 2.2945)
+        self._memory("Louvre", 48.8606, 2.3376)
+        self._memory("Versailles", 48.8049, 2.1204)
+        
+        nearby = within_radius(Memory.query, Memory, MEMORY_POINTS, 48.8584, 2.2945, 5)
+        self.assertEqual([memory.title for memory, _ in nearby], ["Eiffel Tower", "Louvre"])
+        self.assertAlmostEqual(nearby[1][1], 3.15, delta=0.05)
+    
+    def test_bbox_query_uses_rtree(self):
+        rng = random.Random(42)
+        for i in range(5000):
+            db.session.add(Memory(title=f"Point {i}", lat=rng.uniform(-60, 60), lng=rng.uniform(-170, 170),
+                                  user_id=self.user.id))
+        db.session.commit()
+        
+        query = in_bbox(Memory.query.filter_by(user_id=self.user.id), Memory, MEMORY_POINTS,
+                        BoundingBox.parse("0,0,10,10"))
+        statement = query.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = " ".join(row[3] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {statement}")))
+        self.assertIn("VIRTUAL TABLE INDEX", plan)
+        
+        start_time = time.time()
+        results = query.all()
+        query_time = time.time() - start_time
+        print(f"Bounding-box query: {query_time * 1000:.1f} ms, found {len(results)} memories")
+        self.assertTrue(results)
+        self.assertTrue(all(0 <= m.lat <= 10 and 0 <= m.lng <= 10 for m in results))
+        self.assertLess(query_time, 0.05, "Bounding-box query should be under 50 ms")
+
+
+class TestPointClustering(BaseTestCase):
+    """Test the per-user map cluster hierarchies and their invalidation"""
+    
+    WORLD = BoundingBox.parse("-180,-85,180,85")
+    
+    def setUp(self):
+        super().setUp()
+        clustering.clear()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.other = User.query.filter_by(username="admin").first()
+    
+    def tearDown(self):
+        clustering.clear()
+        super().tearDown()
+    
+    def _plan(self, user, *coordinates):
+        plan = TravelPlan(title="Trip", destination="Somewhere", start_date=datetime(2025, 6, 1),
+                          end_date=datetime(2025, 6, 3), user_id=user.id)
+        db.session.add(plan)
+        db.session.flush()
+        for lat, lng in coordinates:
+            db.session.add(ItineraryItem(day=1, activity="Stop", lat=lat, lng=lng, travel_plan_id=plan.id))
+        db.session.commit()
+        return plan
+    
+    def test_clusters_split_as_the_map_zooms_in(self):
+        hierarchy = ClusterHierarchy([
+            ('memory', 1, 48.8584, 2.2945),   # Eiffel Tower
+            ('memory', 2, 48.8606, 2.3376),   # Louvre
+            ('item', 3, 48.8049, 2.1204),     # Versailles
+            ('memory', 4, 35.6586, 139.7454), # Tokyo Tower
+        ])
+        self.assertEqual(hierarchy.count, 4)
+        
+        paris, tokyo = hierarchy.clusters(self.WORLD, 2)
+        self.assertEqual((paris.count, paris.counts), (3, {'memory': 2, 'item': 1}))
+        self.assertEqual(paris.representatives, [('item', 3), ('memory', 1), ('memory', 2)])
+        self.assertAlmostEqual(paris.lat, (48.8584 + 48.8606 + 48.8049) / 3)
+        self.assertEqual((tokyo.count, tokyo.expansion_zoom), (1, None))
+        
+        # Versailles splits off first, then the Eiffel Tower and the Louvre
+        self.assertEqual(hierarchy.clusters(BoundingBox.parse("2,48.7,2.5,49"), paris.expansion_zoom - 1)[0].count, 3)
+        self.assertEqual(sorted(c.count for c in hierarchy.clusters(self.WORLD, paris.expansion_zoom)), [1, 1, 2])
+        self.assertEqual(len(hierarchy.clusters(self.WORLD, MAX_CLUSTER_ZOOM)), 4)
+        self.assertEqual(len(hierarchy.clusters(self.WORLD, 30)), 4)
+        
+        # Only cells overlapping the view, also across the antimeridian
+        self.assertEqual([c.count for c in hierarchy.clusters(BoundingBox.parse("130,30,150,40"), 6)], [1])
+        self.assertEqual(hierarchy.clusters(BoundingBox.parse("170,-20,-170,20"), 6), [])
+    
+    def test_writes_by_other_workers_invalidate(self):
+        db.session.add(Memory(title="Louvre", lat=48.8606, lng=2.3376, user_id=self.user.id))
+        db.session.commit()
+        hierarchy = hierarchy_for(self.user.id, ['memories'])
+        
+        # Another process adds a point; its flush bumps the stored revision, not this process's cache
+        db.session.execute(text("INSERT INTO memory (title, lat, lng, user_id, created_at) "
+                                "VALUES ('Orsay', 48.86, 2.3266, :user_id, CURRENT_TIMESTAMP)"),
+                           {'user_id': self.user.id})
+        db.session.execute(text("UPDATE fragment_revision SET revision = revision + 1 WHERE key = :key"),
+                           {'key': f'user_points:{self.user.id}'})
+        db.session.commit()
+        rebuilt = hierarchy_for(self.user.id, ['memories'])
+        self.assertIsNot(rebuilt, hierarchy)
+        self.assertEqual(rebuilt.count, 2)
+    
+    def test_hierarchy_is_cached_until_points_change(self):
+        memory = Memory(title="Louvre", lat=48.8606, lng=2.3376, user_id=self.user.id)
+        db.session.add(memory)
+        db.session.commit()
+        
+        hierarchy = hierarchy_for(self.user.id, ['memories'])
+        self.assertIs(hierarchy_for(self.user.id, ['memories']), hierarchy)
+        
+        # Writes that do not move points keep the hierarchy
+        memory.title = "Musee du Louvre"
+        db.session.commit()
+        self.assertIs(hierarchy_for(self.user.id, ['memories']), hierarchy)
+        
+        memory.lat, memory.lng = 35.6586, 139.7454
+        db.session.commit()
+        moved = hierarchy_for(self.user.id, ['memories'])
+        self.assertIsNot(moved, hierarchy)
+        self.assertEqual(moved.clusters(BoundingBox.parse("130,30,150,40"), 4)[0].representatives,
+                         [('memory', memory.id)])
+        
+        # Rolled back writes do not invalidate
+        memory.lat = 10
+        db.session.flush()
+        db.session.rollback()
+        self.assertIs(hierarchy_for(self.user.id, ['memories']), moved)
+        
+        db.session.delete(memory)
+        db.session.commit()
+        self.assertEqual(hierarchy_for(self.user.id, ['memories']).count, 0)
+    
+    def test_shared_plan_items_invalidate_every_viewer(self):
+        plan = self._plan(self.other, (41.9, 12.49), (41.91, 12.5))
+        share = PlanShare(travel_plan_id=plan.id, shared_user_id=self.user.id, status='pending')
+        db.session.add(share)
+        db.session.commit()
+        self.assertEqual(hierarchy_for(self.user.id, ['items']).count, 0)
+        
+        share.status = 'accepted'
+        db.session.commit()
+        self.assertEqual(hierarchy_for(self.user.id, ['items']).count, 2)
+        self.assertEqual(hierarchy_for(self.other.id, ['items', 'plans']).count, 3)
+        
+        db.session.add(ItineraryItem(day=2, activity="Colosseum", lat=41.89, lng=12.49, travel_plan_id=plan.id))
+        db.session.commit()
+        self.assertEqual(hierarchy_for(self.user.id, ['items']).count, 3)
+        self.assertEqual(hierarchy_for(self.other.id, ['items', 'plans']).count, 4)
+        
+        db.session.delete(plan)
+        db.session.commit()
+        self.assertEqual(hierarchy_for(self.user.id, ['items']).count, 0)
+        self.assertEqual(hierarchy_for(self.other.id, ['items', 'plans']).count, 0)
+    
+    def test_clustering_is_fast_on_a_large_account(self):
+        rng = random.Random(7)
+        for i in range(5000):
+            db.session.add(Memory(title=f"Point {i}", lat=rng.uniform(-60, 60), lng=rng.uniform(-170, 170),
+                                  user_id=self.user.id))
+        db.session.commit()
+        
+        start_time = time.time()
+        hierarchy = hierarchy_for(self.user.id, ['memories'])
+        build_time = time.time() - start_time
+        
+        start_time = time.time()
+        world = hierarchy.clusters(self.WORLD, 3)
+        city = hierarchy.clusters(BoundingBox.parse("0,0,1,1"), 12)
+        query_time = time.time() - start_time
+        print(f"Cluster hierarchy: built in {build_time * 1000:.1f} ms, "
+              f"queried in {query_time * 1000:.2f} ms ({len(world)} clusters at zoom 3)")
+        
+        self.assertEqual(sum(cluster.count for cluster in world), 5000)
+        self.assertLess(len(world), 500)
+        self.assertTrue(all(0 <= cluster.lat <= 1.1 and -0.1 <= cluster.lng <= 1.1 for cluster in city))
+        self.assertLess(build_time, 2.0, "Building the hierarchy should be under 2 s")
+        self.assertLess(query_time, 0.05, "Cluster queries should be under 50 ms")
+
+
+class TestHeatmapTiles(BaseTestCase):
+    """Test rendering and on-disk caching of heatmap tiles"""
+    
+    def setUp(self):
+        super().setUp()
+        clustering.clear()
+        self.tile_dir = tempfile.mkdtemp()
+        self.app.config['HEATMAP_TILE_DIR'] = self.tile_dir
+        self.user = User.query.filter_by(username="testuser").first()
+    
+    def tearDown(self):
+        self.app.config.pop('HEATMAP_TILE_DIR', None)
+        shutil.rmtree(self.tile_dir, ignore_errors=True)
+        clustering.clear()
+        super().tearDown()
+    
+    def _memory(self, lat, lng):
+        memory = Memory(title="Somewhere", lat=lat, lng=lng, user_id=self.user.id)
+        db.session.add(memory)
+        db.session.commit()
+        return memory
+    
+    def _tile(self, z, x, y):
+        return heatmap.tile(self.user.id, ['memories', 'items'], z, x, y)
+    
+    def test_tile_draws_points_near_it(self):
+        self._memory(48.8584, 2.2945)
+        self._memory(48.8606, 2.3376)
+        
+        # Paris is in tile 8/129/88
+        path, _ = self._tile(8, 129, 88)
+        image = Image.open(path)
+        self.assertEqual((image.size, image.mode), ((256, 256), 'RGBA'))
+        alpha = image.getchannel('A')
+        self.assertGreater(alpha.getextrema()[1], 0)
+        self.assertEqual(alpha.getpixel((0, 255)), 0)
+        
+        self.assertIsNone(self._tile(8, 10, 10))
+        self.assertEqual(Image.open(BytesIO(heatmap.empty_tile())).getextrema()[3], (0, 0))
+        self.assertFalse(heatmap.valid_tile(2, 4, 0))
+        self.assertFalse(heatmap.valid_tile(heatmap.MAX_HEATMAP_ZOOM + 1, 0, 0))
+    
+    def test_only_tiles_near_a_change_are_rendered_again(self):
+        memory = self._memory(48.8584, 2.2945)
+        self._memory(35.6586, 139.7454)
+        
+        with mock.patch.object(heatmap, 'render', wraps=heatmap.render) as render:
+            paris, _ = self._tile(8, 129, 88)
+            tokyo, _ = self._tile(8, 227, 100)
+            self.assertEqual(self._tile(8, 129, 88)[0], paris)
+            self.assertEqual(render.call_count, 2)
+            
+            # Moving the Paris memory leaves the Tokyo tile alone
+            memory.lat, memory.lng = 48.87, 2.30
+            db.session.commit()
+            moved, _ = self._tile(8, 129, 88)
+            self.assertEqual(self._tile(8, 227, 100)[0], tokyo)
+            self.assertEqual(render.call_count, 3)
+        
+        self.assertNotEqual(moved, paris)
+        self.assertFalse(os.path.exists(paris))
+        self.assertTrue(os.path.exists(moved))
+        
+        # Unrelated writes keep the fingerprint
+        memory.title = "Eiffel Tower"
+        db.session.commit()
+        self.assertEqual(self._tile(8, 129, 88)[0], moved)
+    
+    def test_tiles_follow_writes_of_other_workers(self):
+        self._memory(48.8584, 2.2945)
+        path, key = self._tile(8, 129, 88)
+        
+        # Another process adds a point near Paris and bumps the stored revision
+        db.session.execute(text("INSERT INTO memory (title, lat, lng, user_id, created_at) "
+                                "VALUES ('Louvre', 48.8606, 2.3376, :user_id, CURRENT_TIMESTAMP)"),
+                           {'user_id': self.user.id})
+        db.session.execute(text("UPDATE fragment_revision SET revision = revision + 1 WHERE key = :key"),
+                           {'key': f'user_points:{self.user.id}'})
+        db.session.commit()
+        new_path, new_key = self._tile(8, 129, 88)
+        self.assertNotEqual(new_key, key)
+        self.assertFalse(os.path.exists(path))
+    
+    def test_emptied_tile_is_removed(self):
+        memory = self._memory(48.8584, 2.2945)
+        path, _ = self._tile(8, 129, 88)
+        
+        db.session.delete(memory)
+        db.session.commit()
+        self.assertIsNone(self._tile(8, 129, 88))
+        self.assertFalse(os.path.exists(path))
+    
+    def test_prune_old_and_excess_tiles(self):
+        self._memory(48.8584, 2.2945)
+        self._memory(35.6586, 139.7454)
+        paris, _ = self._tile(8, 129, 88)
+        tokyo, _ = self._tile(8, 227, 100)
+        
+        # Tiles not served for 40 days are removed, with their directories
+        old = time.time() - 40 * 86400
+        os.utime(paris, (old, old))
+        self.assertEqual(heatmap.prune_tiles(max_age_days=30, max_mb=512)[0], 1)
+        self.assertFalse(os.path.exists(os.path.dirname(paris)))
+        self.assertTrue(os.path.exists(tokyo))
+        
+        # Serving a tile marks it as recently used, so it outlives older ones under the size cap
+        paris, _ = self._tile(8, 129, 88)
+        os.utime(tokyo, (old, old))
+        self.assertEqual(self._tile(8, 129, 88)[0], paris)
+        removed, size = heatmap.prune_tiles(max_age_days=60, max_mb=os.path.getsize(paris) / (1024 * 1024))
+        self.assertEqual((removed, size), (1, os.path.getsize(paris)))
+        self.assertFalse(os.path.exists(tokyo))
+        
+        # The tests use the module-level app, without create_app()'s commands
+        if 'prune-heatmap-tiles' not in self.app.cli.commands:
+            register_commands(self.app, db)
+        result = self.app.test_cli_runner().invoke(args=['prune-heatmap-tiles', '--max-mb', '0'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Removed 1 tile file(s)', result.output)
+        self.assertFalse(os.path.exists(paris))
+    
+    def test_tiles_render_quickly_on_a_large_account(self):
+        rng = random.Random(11)
+        for i in range(5000):
+            db.session.add(Memory(title=f"Point {i}", lat=rng.uniform(-60, 60), lng=rng.uniform(-170, 170),
+                                  user_id=self.user.id))
+        db.session.commit()
+        clustering.hierarchy_for(self.user.id, ['memories', 'items'])
+        
+        start_time = time.time()
+        for x in range(4):
+            for y in range(4):
+                self._tile(2, x, y)
+        render_time = (time.time() - start_time) / 16
+        
+        start_time = time.time()
+        self._tile(2, 1, 1)
+        cached_time = time.time() - start_time
+        print(f"Heatmap tiles: {render_time * 1000:.1f} ms to render, {cached_time * 1000:.2f} ms cached")
+        self.assertLess(render_time, 0.25, "Rendering a tile should be under 250 ms")
+        self.assertLess(cached_time, 0.02, "A cached tile should be found in under 20 ms")
+
+
+class TestBulkItineraryImport(BaseTestCase):
+    """Test the speed of bulk itinerary imports"""
+    
+    def test_large_csv_imports_in_seconds(self):
+        user = User.query.filter_by(username="testuser").first()
+        plan = TravelPlan(title="Long Trip", destination="Everywhere", start_date=datetime(2025, 1, 1),
+                          end_date=datetime(2025, 12, 31), user_id=user.id)
+        db.session.add(plan)
+        db.session.commit()
+        
+        rng = random.Random(5)
+        activities = ["Museum visit", "Dinner", "Train to next city", "Hotel check-in", "Hiking", "Market"]
+        lines = ["day,time,activity,location,lat,lng,cost,notes"]
+        for i in range(20000):
+            lines.append(f"{1 + i % 365},{8 + i % 12}:{i % 60:02d},{rng.choice(activities)} {i},Place {i},"
+                         f"{rng.uniform(-60, 60):.5f},{rng.uniform(-170, 170):.5f},{rng.uniform(0, 200):.2f},")
+        content = ("\n".join(lines) + "\n").encode('utf-8')
+        
+        start_time = time.time()
+        result = import_items(plan, BytesIO(content), 'csv')
+        import_time = time.time() - start_time
+        print(f"Bulk import: {result.imported} rows in {import_time:.2f} s")
+        
+        self.assertEqual((result.imported, result.error_count), (20000, 0))
+        db.session.refresh(plan)
+        self.assertEqual(plan.item_count, 20000)
+        self.assertLess(import_time, 10.0, "Importing 20,000 rows should take seconds")
+
+
+class TestDataExport(BaseTestCase):
+    """Test streaming exports of a user's data"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        other = User(username="exportother", email="exportother@example.com")
+        other.set_password("password")
+        db.session.add(other)
+        plan = TravelPlan(title="Export Trip", destination="Lisbon", start_date=datetime(2025, 5, 1),
+                          end_date=datetime(2025, 5, 3), user_id=self.user.id)
+        db.session.add(plan)
+        db.session.flush()
+        db.session.add(ItineraryItem(day=1, time="09:00", activity="Tram 28, \"Alfama\"", cost=3.0,
+                                     travel_plan_id=plan.id))
+        memory = Memory(title="Belem", location="Lisbon", visit_date=datetime(2025, 5, 2),
+                        description="Pastéis", user_id=self.user.id)
+        memory.set_tags(["food", "lisbon"])
+        db.session.add(memory)
+        db.session.add(Memory(title="Not mine", visit_date=datetime(2025, 5, 2), user_id=other.id))
+        db.session.flush()
+        self.photo_name = f"export_test_{memory.id}.jpg"
+        self.photo_bytes = os.urandom(200000)
+        os.makedirs(os.path.dirname(photo_path(self.photo_name)), exist_ok=True)
+        with open(photo_path(self.photo_name), 'wb') as photo_file:
+            photo_file.write(self.photo_bytes)
+        db.session.add(Photo(filename=self.photo_name, memory_id=memory.id))
+        db.session.add(Photo(filename="export_test_missing.jpg", memory_id=memory.id))
+        db.session.commit()
+        self.plan, self.memory = plan, memory
+    
+    def tearDown(self):
+        if os.path.exists(photo_path(self.photo_name)):
+            os.remove(photo_path(self.photo_name))
+        super().tearDown()
+    
+    def test_ndjson_and_csv_contain_only_own_rows(self):
+        lines = list(exports.export_chunks(exports.DATASETS['memories'], self.user.id, 'ndjson'))
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['title'] for row in rows], ["Belem"])
+        self.assertEqual(rows[0]['visit_date'], "2025-05-02T00:00:00")
+        self.assertEqual(rows[0]['description'], "Pastéis")
+        
+        text_csv = "".join(exports.export_chunks(exports.DATASETS['items'], self.user.id, 'csv'))
+        rows = list(csv.DictReader(StringIO(text_csv)))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['activity'], 'Tram 28, "Alfama"')
+        self.assertEqual(int(rows[0]['plan_id']), self.plan.id)
+        
+        tags = "".join(exports.export_chunks(exports.DATASETS['tags'], self.user.id, 'csv')).splitlines()
+        self.assertEqual(tags, ["memory_id,tag", f"{self.memory.id},food", f"{self.memory.id},lisbon"])
+    
+    def test_archive_has_datasets_photos_and_summary(self):
+        chunks = list(exports.archive_chunks(self.user.id))
+        self.assertGreater(len(chunks), 1, "The archive should be produced in pieces")
+        
+        with zipfile.ZipFile(BytesIO(b"".join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            names = archive.namelist()
+            for name in ("plans", "items", "memories", "tags", "photos"):
+                self.assertIn(f"{name}.ndjson", names)
+            self.assertEqual(archive.read(f"photos/{self.memory.id}/{self.photo_name}"), self.photo_bytes)
+            summary = json.loads(archive.read("export.json"))
+        self.assertEqual(summary['counts']['memories'], 1)
+        self.assertEqual(summary['counts']['photos'], 2)
+        self.assertEqual(summary['missing_photos'], ["export_test_missing.jpg"])
+    
+    def test_large_export_streams_in_bounded_chunks(self):
+        rows = [{'day': 1 + i % 3, 'activity': f"Walk {i}", 'cost': i % 50, 'notes': "x" * 40,
+                 'travel_plan_id': self.plan.id} for i in range(20000)]
+        db.session.execute(ItineraryItem.__table__.insert(), rows)
+        db.session.commit()
+        
+        start_time = time.time()
+        largest, total = 0, 0
+        for chunk in exports.archive_chunks(self.user.id):
+            largest = max(largest, len(chunk))
+            total += len(chunk)
+        export_time = time.time() - start_time
+        print(f"Archive export: {total} bytes in {export_time:.2f} s, largest chunk {largest} bytes")
+        
+        self.assertLess(largest, 4 * exports.FILE_CHUNK_SIZE)
+        self.assertLess(export_time, 10.0)
+        
+        count = sum(1 for _ in exports.csv_chunks(exports.DATASETS['items'], self.user.id))
+        self.assertGreaterEqual(count, 20000 // exports.CHUNK_ROWS)
@@ -2,8 +2,30 @@ import unittest
 from datetime import datetime, timedelta
 from .base import BaseTestCase
 from app.models.user import User
-from app.models.travel_plan import TravelPlan, ItineraryItem
-from app import db
+from app.models.travel_plan import TravelPlan, ItineraryItem, recompute_plan_totals, recompute_plan_geo
+from app.expense_categories import apply_category, category_totals
+from app.trending import CountMinSketch, REBUILD_AFTER, TrendingTracker, tracker, trending_destinations
+from app import fragment_cache
+from app.itinerary_time import parse_time, format_minutes
+from app.models.memory import Memory
+from app import db, clustering
+from app.commands import register_commands
+from app.itinerary_import import ImportFileError, detect_format, import_items
+from app.itinerary_batch import BatchError, apply_operations
+from app.itinerary_sync import changes_since
+from app import itinerary_sync, plan_events
+from app.search import PLAN_INDEX, ranked
+from app import plan_access as plan_access_module
+from app.plan_access import load_plan_access, plan_access, plan_access_required
+from app.models.travel_plan import PlanShare
+from flask_login import login_user
+from werkzeug.exceptions import Forbidden, NotFound
+from io import BytesIO
+from unittest import mock
+import json
+import os
+import tempfile
+from sqlalchemy import text
 
 class TestPlannerModel(BaseTestCase):
     """Test case for the TravelPlan model"""
@@ -78,6 +100,39 @@ class TestPlannerModel(BaseTestCase):
         items = plan.itinerary_items.all()
         total_cost = sum(item.cost for item in items if item.cost)
         self.assertEqual(total_cost, 60.0)
+    
+    def test_category_classified_on_write(self):
+        """Test that itinerary items are categorized when saved"""
+        plan = TravelPlan.query.filter_by(title="Test Vacation").first()
+        categories = {item.activity: item.category for item in plan.itinerary_items}
+        self.assertEqual(categories["Visit Museum"], "Sightseeing")
+        self.assertEqual(categories["Lunch"], "Food")
+        
+        # Changing the activity reclassifies the item
+        item = plan.itinerary_items.filter_by(activity="Lunch").first()
+        item.activity = "Taxi to the airport"
+        db.session.commit()
+        self.assertEqual(item.category, "Transport")
+    
+    def test_category_override(self):
+        """Test that a user chosen category survives later edits"""
+        item = ItineraryItem(day=2, activity="Lunch cruise", cost=80.0,
+                             travel_plan_id=self.plan.id)
+        apply_category(item, "entertainment")
+        db.session.add(item)
+        db.session.commit()
+        self.assertEqual(item.category, "Entertainment")
+        self.assertTrue(item.category_overridden)
+        
+        item.activity = "Dinner cruise"
+        db.session.commit()
+        self.assertEqual(item.category, "Entertainment")
+    
+    def test_category_totals(self):
+        """Test that category totals are grouped in the database"""
+        totals = category_totals(plan_id=self.plan.id)
+        self.assertEqual(totals, {"Sightseeing": 20.0, "Food": 40.0})
+        self.assertEqual(category_totals(user_id=self.user.id), totals)
 
 class TestPlannerRoutes(BaseTestCase):
     """Test cases for planner routes"""
@@ -124,5 +179,844 @@ class TestPlannerRoutes(BaseTestCase):
         self.assertIn(b'New Test Trip', response.data)
         self.assertIn(b'Paris, France', response.data)
 
+class TestTrendingDestinations(BaseTestCase):
+    """Test case for the cross-user trending destination sketches"""
+    
+    def setUp(self):
+        super().setUp()
+        tracker.reset()
+    
+    def _create_plan(self, user, destination):
+        plan = TravelPlan(
+            title=f"Trip to {destination}",
+            destination=destination,
+            start_date=datetime.utcnow() + timedelta(days=10),
+            end_date=datetime.utcnow() + timedelta(days=15),
+            user_id=user.id
+        )
+        db.session.add(plan)
+        db.session.commit()
+        return plan
+    
+    def test_count_min_sketch_never_underestimates(self):
+        """Test that estimates are at least the true counts"""
+        sketch = CountMinSketch(width=16, depth=3)
+        for i in range(100):
+            sketch.add(f"city-{i % 20}")
+        for i in range(20):
+            self.assertGreaterEqual(sketch.estimate(f"city-{i}"), 5)
+    
+    def test_buckets_expire_from_window(self):
+        """Test that counts leave the window once their bucket is too old"""
+        local = TrendingTracker()
+        now = datetime(2025, 5, 20, 12, 0)
+        local.record('Paris, France', now=now)
+        local.record('Paris, France', now=now)
+        local.record('Rome, Italy', now=now + timedelta(hours=2))
+        
+        self.assertEqual(local.top('day', now=now + timedelta(hours=2)),
+                         [('Paris, France', 2), ('Rome, Italy', 1)])
+        self.assertEqual(local.top('day', now=now + timedelta(hours=25)),
+                         [('Rome, Italy', 1)])
+        self.assertEqual(local.top('week', now=now + timedelta(hours=25))[0],
+                         ('Paris, France', 2))
+    
+    def test_trending_across_users(self):
+        """Test that committed plans from every user feed the ranking"""
+        user = User.query.filter_by(username="testuser").first()
+        admin = User.query.filter_by(username="admin").first()
+        
+        # The first lookup warms the sketches from existing plans
+        self._create_plan(user, "Tokyo, Japan")
+        self.assertEqual(trending_destinations('week'),
+                         [{'destination': 'Tokyo, Japan', 'count': 1}])
+        
+        # Later plans are counted incrementally
+        self._create_plan(admin, "Lisbon, Portugal")
+        self._create_plan(admin, "lisbon, portugal")
+        self.assertEqual(trending_destinations('week', limit=1),
+                         [{'destination': 'Lisbon, Portugal', 'count': 2}])
+    
+    def test_plans_of_other_workers_counted_after_a_bucket(self):
+        """Test that the sketches are rebuilt to pick up plans committed elsewhere"""
+        user = User.query.filter_by(username="testuser").first()
+        plan = self._create_plan(user, "Tokyo, Japan")
+        self.assertEqual(trending_destinations('week'),
+                         [{'destination': 'Tokyo, Japan', 'count': 1}])
+        
+        # Another worker's plan reaches the database without passing through this process
+        db.session.execute(TravelPlan.__table__.insert().values(
+            title="Elsewhere", destination="Tokyo, Japan", destination_id=plan.destination_id,
+            start_date=plan.start_date, end_date=plan.end_date, user_id=user.id,
+            created_at=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(trending_destinations('week')[0]['count'], 1)
+        
+        tracker.loaded_at -= REBUILD_AFTER
+        self.assertEqual(trending_destinations('week')[0]['count'], 2)
+    
+    def test_rolled_back_plans_not_counted(self):
+        """Test that plans are only counted once committed"""
+        user = User.query.filter_by(username="testuser").first()
+        trending_destinations('week')
+        
+        plan = TravelPlan(title="Maybe", destination="Oslo, Norway",
+                          start_date=datetime.utcnow(), end_date=datetime.utcnow(),
+                          user_id=user.id)
+        db.session.add(plan)
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(trending_destinations('week'), [])
+
+
+class TestFragmentCache(BaseTestCase):
+    """Test case for revision-keyed template fragment caching"""
+    
+    def setUp(self):
+        super().setUp()
+        fragment_cache.clear()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Cache Trip", destination="Paris, France",
+                               start_date=datetime(2025, 6, 1), end_date=datetime(2025, 6, 3),
+                               user_id=self.user.id)
+        db.session.add(self.plan)
+        db.session.commit()
+        self.renders = 0
+    
+    def _render(self, *keys):
+        def caller():
+            self.renders += 1
+            return f"<p>render {self.renders}</p>"
+        return fragment_cache.cache_fragment('test_block', *keys, caller=caller)
+    
+    def test_fragment_reused_until_revision_changes(self):
+        """Test that a fragment renders once per data revision"""
+        key = ('plan_day', self.plan.id, 1)
+        self.assertEqual(self._render(key), self._render(key))
+        self.assertEqual(self.renders, 1)
+        
+        fragment_cache.bump(key)
+        self._render(key)
+        self.assertEqual(self.renders, 2)
+    
+    def test_revisions_shared_between_workers(self):
+        """Test that a write committed by another worker invalidates this worker's fragments"""
+        key = ('plan', self.plan.id)
+        self._render(key)
+        # Another process renames the plan; its flush bumps the stored revision
+        db.session.execute(text("UPDATE fragment_revision SET revision = revision + 1 WHERE key = :key"),
+                           {'key': f'plan:{self.plan.id}'})
+        db.session.commit()
+        self._render(key)
+        self.assertEqual(self.renders, 2)
+    
+    def test_item_writes_bump_only_their_day(self):
+        """Test that committing an item invalidates its old and new day"""
+        item = ItineraryItem(day=1, activity="Louvre", travel_plan_id=self.plan.id)
+        db.session.add(item)
+        db.session.commit()
+        day1 = fragment_cache.revision(('plan_day', self.plan.id, 1))
+        day3 = fragment_cache.revision(('plan_day', self.plan.id, 3))
+        self.assertEqual(day1, 1)
+        
+        item.day = 2
+        db.session.commit()
+        self.assertEqual(fragment_cache.revision(('plan_day', self.plan.id, 1)), day1 + 1)
+        self.assertEqual(fragment_cache.revision(('plan_day', self.plan.id, 2)), 1)
+        self.assertEqual(fragment_cache.revision(('plan_day', self.plan.id, 3)), day3)
+    
+    def test_rollback_does_not_bump(self):
+        """Test that uncommitted writes leave revisions untouched"""
+        before = fragment_cache.revision(('user_plans', self.user.id))
+        self.plan.title = "Renamed"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(fragment_cache.revision(('user_plans', self.user.id)), before)
+    
+    def test_memory_tag_write_bumps_owner(self):
+        """Test that tagging a memory invalidates the owner's memory fragments"""
+        memory = Memory(title="Eiffel Tower", user_id=self.user.id)
+        db.session.add(memory)
+        db.session.commit()
+        before = fragment_cache.revision(('user_memories', self.user.id))
+        
+        memory.set_tags(["Landmark"])
+        db.session.commit()
+        self.assertEqual(fragment_cache.revision(('user_memories', self.user.id)), before + 1)
+
+
+class TestItineraryTime(BaseTestCase):
+    """Test case for minutes-since-midnight itinerary times"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Time Trip", destination="Rome, Italy",
+                               start_date=datetime(2025, 7, 1), end_date=datetime(2025, 7, 2),
+                               user_id=self.user.id)
+        db.session.add(self.plan)
+        db.session.commit()
+    
+    def test_parse_time_formats(self):
+        """Test parsing of the time formats found in stored items"""
+        self.assertEqual(parse_time("14:30"), 870)
+        self.assertEqual(parse_time("9:30 AM"), 570)
+        self.assertEqual(parse_time("2:05 pm"), 845)
+        self.assertEqual(parse_time("12am"), 0)
+        self.assertEqual(parse_time("12:15 PM"), 735)
+        self.assertIsNone(parse_time("Morning"))
+        self.assertIsNone(parse_time("25:00"))
+        self.assertIsNone(parse_time(""))
+        self.assertEqual(format_minutes(870), "2:30 PM")
+        self.assertEqual(format_minutes(870, clock='24h'), "14:30")
+    
+    def test_items_sort_chronologically(self):
+        """Test that "10:00" sorts after "9:30 AM" on the same day"""
+        for time, activity in (("10:00", "Colosseum"), ("9:30 AM", "Breakfast"), (None, "Free time")):
+            db.session.add(ItineraryItem(day=1, time=time, activity=activity,
+                                         travel_plan_id=self.plan.id))
+        db.session.commit()
+        
+        items = ItineraryItem.query.filter_by(travel_plan_id=self.plan.id) \
+            .order_by(ItineraryItem.day, ItineraryItem.minutes).all()
+        self.assertEqual([item.activity for item in items], ["Free time", "Breakfast", "Colosseum"])
+        self.assertEqual(items[1].time, "09:30")
+        self.assertEqual(items[1].minutes, 570)
+    
+    def test_time_update_reparses(self):
+        """Test that changing the time text updates the minutes"""
+        item = ItineraryItem(day=1, time="8:00 AM", activity="Vatican", travel_plan_id=self.plan.id)
+        db.session.add(item)
+        db.session.commit()
+        
+        item.time = "3:45 PM"
+        db.session.commit()
+        self.assertEqual(item.minutes, 945)
+        self.assertEqual(item.time, "15:45")
+        
+        item.time = "After lunch"
+        db.session.commit()
+        self.assertIsNone(item.minutes)
+        self.assertEqual(item.time, "After lunch")
+
+
+class TestPlanTotals(BaseTestCase):
+    """Test case for the denormalized plan cost and item counters"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Totals Trip", destination="Berlin, Germany",
+                               start_date=datetime(2025, 8, 1), end_date=datetime(2025, 8, 3),
+                               user_id=self.user.id)
+        self.other = TravelPlan(title="Other Trip", destination="Munich, Germany",
+                                start_date=datetime(2025, 9, 1), end_date=datetime(2025, 9, 2),
+                                user_id=self.user.id)
+        db.session.add_all([self.plan, self.other])
+        db.session.commit()
+    
+    def test_counters_follow_item_writes(self):
+        """Test that inserts, updates, moves and deletes keep the counters exact"""
+        museum = ItineraryItem(day=1, activity="Museum", cost=12.5, travel_plan_id=self.plan.id)
+        walk = ItineraryItem(day=2, activity="Walk", travel_plan_id=self.plan.id)
+        db.session.add_all([museum, walk])
+        db.session.commit()
+        self.assertEqual((self.plan.total_cost, self.plan.item_count), (12.5, 2))
+        
+        museum.cost = 20
+        db.session.commit()
+        self.assertEqual(self.plan.total_cost, 20)
+        
+        museum.travel_plan_id = self.other.id
+        db.session.commit()
+        self.assertEqual((self.plan.total_cost, self.plan.item_count), (0, 1))
+        self.assertEqual((self.other.total_cost, self.other.item_count), (20, 1))
+        
+        db.session.delete(walk)
+        db.session.commit()
+        self.assertEqual(self.plan.item_count, 0)
+    
+    def test_rollback_restores_counters(self):
+        """Test that counters roll back with the item writes"""
+        db.session.add(ItineraryItem(day=1, activity="Tour", cost=30, travel_plan_id=self.plan.id))
+        db.session.flush()
+        self.assertEqual(self.plan.total_cost, 30)
+        db.session.rollback()
+        self.assertEqual((self.plan.total_cost, self.plan.item_count), (0, 0))
+    
+    def test_repair_recomputes_counters(self):
+        """Test that the repair helper fixes drifted counters"""
+        db.session.add(ItineraryItem(day=1, activity="Zoo", cost=15, travel_plan_id=self.plan.id))
+        db.session.commit()
+        db.session.execute(TravelPlan.__table__.update().values(total_cost=999, item_count=7))
+        db.session.commit()
+        
+        recompute_plan_totals(db.session.connection())
+        db.session.commit()
+        self.assertEqual((self.plan.total_cost, self.plan.item_count), (15, 1))
+        self.assertEqual((self.other.total_cost, self.other.item_count), (0, 0))
+    
+    def test_geo_summary_follows_coordinates(self):
+        """Test that the centroid and bounding box track items with coordinates"""
+        self.assertIsNone(self.plan.bounds)
+        self.assertIsNone(self.plan.coordinates)
+        
+        gate = ItineraryItem(day=1, activity="Brandenburg Gate", lat=52.5, lng=13.3,
+                             travel_plan_id=self.plan.id)
+        tower = ItineraryItem(day=1, activity="TV Tower", lat=52.6, lng=13.5,
+                              travel_plan_id=self.plan.id)
+        db.session.add_all([gate, tower, ItineraryItem(day=2, activity="Rest", travel_plan_id=self.plan.id)])
+        db.session.commit()
+        self.assertEqual(self.plan.geo_count, 2)
+        self.assertAlmostEqual(self.plan.centroid_lat, 52.55)
+        self.assertAlmostEqual(self.plan.centroid_lng, 13.4)
+        self.assertEqual(self.plan.bounds, [[52.5, 13.3], [52.6, 13.5]])
+        
+        tower.lat, tower.lng = None, None
+        db.session.commit()
+        self.assertEqual(self.plan.bounds, [[52.5, 13.3], [52.5, 13.3]])
+        self.assertEqual(self.plan.coordinates, (52.5, 13.3))
+        
+        db.session.delete(gate)
+        db.session.commit()
+        self.assertIsNone(self.plan.bounds)
+        
+        recompute_plan_geo(db.session.connection(), [self.plan.id])
+        db.session.commit()
+        self.assertEqual(self.plan.geo_count, 0)
+
+
+class TestItineraryImport(BaseTestCase):
+    """Test case for bulk itinerary imports from CSV and JSON files"""
+    
+    def setUp(self):
+        super().setUp()
+        fragment_cache.clear()
+        clustering.clear()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Lisbon Trip", destination="Lisbon, Portugal",
+                               start_date=datetime(2025, 5, 1), end_date=datetime(2025, 5, 3),
+                               user_id=self.user.id)
+        db.session.add(self.plan)
+        db.session.commit()
+    
+    def _import(self, content, file_format='csv', **kwargs):
+        return import_items(self.plan, BytesIO(content.encode('utf-8')), file_format, **kwargs)
+    
+    def _items(self):
+        return ItineraryItem.query.filter_by(travel_plan_id=self.plan.id).order_by(ItineraryItem.id).all()
+    
+    def test_rows_are_stored_like_items_added_one_by_one(self):
+        """Test that imported rows get parsed times, categories and derived data"""
+        clustering.hierarchy_for(self.user.id, ['items'])
+        revision = fragment_cache.revision(('plan_day', self.plan.id, 2))
+        
+        result = self._import(
+            "Day,Time,Activity,Location,Latitude,Longitude,Cost,Category,Notes\n"
+            "1,9am,Breakfast at a pastelaria,Belem,38.697,-9.206,6.5,,\n"
+            "2,14:30,Tram 28 ride,Alfama,38.711,-9.13,3,,Sit on the right\n"
+            "2,,Sunset walk,,,,,Sightseeing,\n"
+        )
+        self.assertEqual((result.rows, result.imported, result.error_count), (3, 3, 0))
+        
+        breakfast, tram, walk = self._items()
+        self.assertEqual((breakfast.time, breakfast.minutes), ("09:00", 540))
+        self.assertEqual((tram.day, tram.minutes, tram.notes), (2, 870, "Sit on the right"))
+        self.assertEqual((breakfast.category, breakfast.category_overridden), ("Food", False))
+        self.assertEqual((walk.category, walk.category_overridden, walk.cost), ("Sightseeing", True, None))
+        
+        # Derived data the session hooks would have written
+        db.session.refresh(self.plan)
+        self.assertEqual((self.plan.item_count, self.plan.total_cost, self.plan.geo_count), (3, 9.5, 2))
+        self.assertEqual(ranked(TravelPlan.query, TravelPlan, PLAN_INDEX, ["tram"]).all(), [self.plan])
+        self.assertEqual(db.session.execute(text("SELECT count(*) FROM itinerary_item_geo")).scalar(), 2)
+        self.assertGreater(fragment_cache.revision(('plan_day', self.plan.id, 2)), revision)
+        self.assertEqual(clustering.hierarchy_for(self.user.id, ['items']).count, 2)
+    
+    def test_invalid_rows_are_reported(self):
+        """Test that row errors import nothing unless invalid rows are skipped"""
+        content = ("day,activity,time,cost,lat,lng\n"
+                   "1,Castle,10:00,12,,\n"
+                   "0,Too early,,,,\n"
+                   "4,Too late,,,,\n"
+                   "two,,,free,38.7,\n"
+                   "3,Fado night,in the evening of course,,,\n"
+                   "3,Dinner,20:00,-5,91,0\n")
+        result = self._import(content)
+        self.assertEqual((result.imported, result.error_count), (0, 5))
+        self.assertEqual([error['row'] for error in result.errors], [3, 4, 5, 6, 7])
+        self.assertIn('day must be between 1 and 3', result.errors[0]['errors'])
+        self.assertEqual(len(result.errors[2]['errors']), 4)
+        self.assertEqual(self._items(), [])
+        
+        result = self._import(content, skip_invalid=True)
+        self.assertEqual((result.imported, result.error_count), (1, 5))
+        self.assertEqual([item.activity for item in self._items()], ["Castle"])
+    
+    def test_json_arrays_and_lines_are_streamed(self):
+        """Test that JSON rows are decoded across read boundaries"""
+        rows = [{"day": 1 + i % 3, "activity": f"Stop {i}", "lat": 38.7, "lng": -9.1 - i / 100,
+                 "notes": "x" * 50} for i in range(40)]
+        with mock.patch('app.itinerary_import.CHUNK_SIZE', 64):
+            self.assertEqual(self._import(json.dumps(rows, indent=2), 'json').imported, 40)
+            result = self._import("\n".join(json.dumps(row) for row in rows[:5]) + "\n[1]\n", 'json')
+        self.assertEqual(result.errors, [{'row': 6, 'errors': ['Each row must be an object']}])
+        self.assertEqual(len(self._items()), 40)
+    
+    def test_unreadable_files_import_nothing(self):
+        """Test that file-level problems raise and roll back"""
+        for content, file_format in (("activity,time\nMuseum,10:00\n", 'csv'),
+                                     ('[{"day": 1, "activity": "Museum"}, {"day": 2,', 'json'),
+                                     ('[{"day": 1, "activity": "Museum"}', 'json')):
+            with self.assertRaises(ImportFileError):
+                self._import(content, file_format)
+        with self.assertRaises(ImportFileError):
+            import_items(self.plan, BytesIO(b"day,activity\n1,Caf\xe9\n"), 'csv')
+        self.assertEqual(self._items(), [])
+        
+        self.assertEqual(detect_format('trip.JSONL'), 'json')
+        self.assertEqual(detect_format(None, 'text/csv'), 'csv')
+        with self.assertRaises(ImportFileError):
+            detect_format('trip.xlsx')
+    
+    def test_import_command(self):
+        """Test the flask import-itinerary command"""
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as csv_file:
+            csv_file.write("day,activity\n1,Oceanarium\n2,\n")
+        # The tests use the module-level app, without create_app()'s commands
+        if 'import-itinerary' not in self.app.cli.commands:
+            register_commands(self.app, db)
+        try:
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=['import-itinerary', str(self.plan.id), path])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("Row 3: activity is required", result.output)
+            
+            result = runner.invoke(args=['import-itinerary', str(self.plan.id), path, '--skip-invalid'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 1 of 2 row(s)", result.output)
+        finally:
+            os.remove(path)
+        self.assertEqual([item.activity for item in self._items()], ["Oceanarium"])
+
+
+class TestItineraryBatch(BaseTestCase):
+    """Test case for batched itinerary changes"""
+    
+    def setUp(self):
+        super().setUp()
+        fragment_cache.clear()
+        clustering.clear()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Porto Trip", destination="Porto, Portugal",
+                               start_date=datetime(2025, 6, 1), end_date=datetime(2025, 6, 3),
+                               user_id=self.user.id)
+        db.session.add(self.plan)
+        db.session.flush()
+        self.items = [
+            ItineraryItem(day=1, time="09:00", activity="Breakfast at a cafe", cost=8,
+                          lat=41.14, lng=-8.61, travel_plan_id=self.plan.id),
+            ItineraryItem(day=1, time="11:00", activity="Livraria Lello", cost=10, travel_plan_id=self.plan.id),
+            ItineraryItem(day=2, time="20:00", activity="Port tasting", cost=25, travel_plan_id=self.plan.id),
+        ]
+        db.session.add_all(self.items)
+        db.session.commit()
+        self.ids = [item.id for item in self.items]
+    
+    def _items(self):
+        return ItineraryItem.query.filter_by(travel_plan_id=self.plan.id).order_by(ItineraryItem.id).all()
+    
+    def test_operations_apply_in_one_transaction(self):
+        """Test that moves, retimes, updates, deletes and adds are applied together"""
+        clustering.hierarchy_for(self.user.id, ['items'])
+        revision = fragment_cache.revision(('plan_day', self.plan.id, 3))
+        breakfast, lello, tasting = self.ids
+        
+        result = apply_operations(self.plan, [
+            {'op': 'move', 'id': lello, 'day': 3, 'time': '10am'},
+            {'op': 'retime', 'id': breakfast, 'time': ''},
+            {'op': 'update', 'id': tasting, 'activity': 'Dinner by the river', 'cost': 40},
+            {'op': 'delete', 'id': breakfast},
+            {'op': 'add', 'ref': 'new-1', 'day': 3, 'activity': 'Ribeira walk', 'lat': 41.14, 'lng': -8.61},
+        ])
+        
+        new_id = result.added['new-1']
+        self.assertEqual(result.deleted, [breakfast])
+        self.assertEqual([item['id'] for item in result.items], [tasting, new_id, lello])
+        self.assertEqual(result.items[2]["time_display"], "10:00 AM")
+        
+        items = {item.id: item for item in self._items()}
+        self.assertEqual(set(items), {lello, tasting, new_id})
+        self.assertEqual((items[lello].day, items[lello].time, items[lello].minutes), (3, "10:00", 600))
+        self.assertEqual((items[tasting].category, items[tasting].cost), ("Food", 40))
+        self.assertEqual(items[new_id].category, "Sightseeing")
+        
+        db.session.refresh(self.plan)
+        self.assertEqual((self.plan.item_count, self.plan.total_cost, self.plan.geo_count), (3, 50, 1))
+        self.assertEqual(ranked(TravelPlan.query, TravelPlan, PLAN_INDEX, ["river"]).all(), [self.plan])
+        self.assertEqual(db.session.execute(text("SELECT id FROM itinerary_item_geo")).scalars().all(), [new_id])
+        self.assertGreater(fragment_cache.revision(('plan_day', self.plan.id, 3)), revision)
+        self.assertEqual(clustering.hierarchy_for(self.user.id, ['items']).count, 1)
+    
+    def test_invalid_operations_change_nothing(self):
+        """Test that one invalid operation rejects the whole batch"""
+        breakfast, lello, tasting = self.ids
+        other_plan = TravelPlan(title="Other", destination="Braga", start_date=datetime(2025, 7, 1),
+                                end_date=datetime(2025, 7, 2), user_id=self.user.id)
+        db.session.add(other_plan)
+        db.session.flush()
+        stranger = ItineraryItem(day=1, activity="Bom Jesus", travel_plan_id=other_plan.id)
+        db.session.add(stranger)
+        db.session.commit()
+        
+        with self.assertRaises(BatchError) as raised:
+            apply_operations(self.plan, [
+                {'op': 'move', 'id': lello, 'day': 2},
+                {'op': 'delete', 'id': tasting},
+                {'op': 'retime', 'id': tasting, 'time': '21:00'},
+                {'op': 'move', 'id': breakfast, 'day': 4},
+                {'op': 'delete', 'id': stranger.id},
+                {'op': 'add', 'day': 1},
+            ])
+        self.assertEqual([error['operation'] for error in raised.exception.errors], [2, 3, 4, 5])
+        self.assertIn('day must be between 1 and 3', raised.exception.errors[1]['errors'])
+        
+        with self.assertRaises(BatchError) as raised:
+            apply_operations(self.plan, [{'op': 'move', 'id': lello}, {'op': 'retime', 'id': lello, 'cost': 1},
+                                         {'op': 'rename'}])
+        self.assertEqual(len(raised.exception.errors), 3)
+        with self.assertRaises(BatchError):
+            apply_operations(self.plan, [])
+        
+        db.session.rollback()
+        self.assertEqual([(item.day, item.time) for item in self._items()],
+                         [(1, "09:00"), (1, "11:00"), (2, "20:00")])
+    
+    def test_unchanged_items_are_not_written(self):
+        """Test that moving an item to where it already is writes nothing"""
+        revision = fragment_cache.revision(('plan', self.plan.id))
+        result = apply_operations(self.plan, [{'op': 'move', 'id': self.ids[1], 'day': 1, 'time': '11:00'}])
+        self.assertEqual(result.to_dict(), {'items': [], 'added': {}, 'deleted': []})
+        self.assertEqual(fragment_cache.revision(('plan', self.plan.id)), revision)
+    
+    def test_items_without_cost_keep_none(self):
+        """Test that an item without a cost is unchanged by a no-op retime"""
+        free = ItineraryItem(day=2, time="10:00", activity="Ribeira walk", travel_plan_id=self.plan.id)
+        db.session.add(free)
+        db.session.commit()
+        revision = fragment_cache.revision(('plan', self.plan.id))
+        
+        result = apply_operations(self.plan, [{'op': 'retime', 'id': free.id, 'time': '10:00'}])
+        self.assertEqual(result.to_dict(), {'items': [], 'added': {}, 'deleted': []})
+        self.assertEqual(fragment_cache.revision(('plan', self.plan.id)), revision)
+        
+        apply_operations(self.plan, [{'op': 'retime', 'id': free.id, 'time': '10:30'}])
+        db.session.refresh(free)
+        self.assertEqual((free.minutes, free.cost), (630, None))
+
+
+class TestItinerarySync(BaseTestCase):
+    """Test case for per-plan revisions and itinerary deltas"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        self.plan = TravelPlan(title="Seville Trip", destination="Seville, Spain",
+                               start_date=datetime(2025, 9, 1), end_date=datetime(2025, 9, 3),
+                               user_id=self.user.id)
+        db.session.add(self.plan)
+        db.session.commit()
+    
+    def _add(self, activity, day=1):
+        item = ItineraryItem(day=day, activity=activity, travel_plan_id=self.plan.id)
+        db.session.add(item)
+        db.session.commit()
+        return item
+    
+    def _ids(self, changes):
+        return ([item['id'] for item in changes['inserted']], [item['id'] for item in changes['updated']],
+                changes['deleted'])
+    
+    def test_orm_writes_are_logged(self):
+        """Test that each commit of item changes is one revision with inserts, updates and deletes"""
+        self.assertEqual(self.plan.revision, 0)
+        alcazar, cathedral = self._add("Alcazar"), self._add("Cathedral")
+        self.assertEqual(self.plan.revision, 2)
+        
+        self.assertEqual(self._ids(changes_since(self.plan, 0)), ([alcazar.id, cathedral.id], [], []))
+        self.assertEqual(self._ids(changes_since(self.plan, 2)), ([], [], []))
+        
+        alcazar.time = "10:00"
+        db.session.delete(cathedral)
+        flamenco = self._add("Flamenco show")
+        db.session.delete(flamenco)
+        db.session.commit()
+        self.assertEqual(self.plan.revision, 4)
+        
+        changes = changes_since(self.plan, 2)
+        # The flamenco show was added and removed after revision 2, so it is left out
+        self.assertEqual(self._ids(changes), ([], [alcazar.id], [cathedral.id]))
+        self.assertEqual(changes['updated'][0]['time_display'], "10:00 AM")
+        self.assertEqual(self._ids(changes_since(self.plan, 0)), ([alcazar.id], [], []))
+        self.assertIsNone(changes_since(self.plan, 5))
+        self.assertIsNone(changes_since(self.plan, None))
+    
+    def test_items_moved_between_plans(self):
+        """Test that an item moved to another plan is deleted from one and inserted into the other"""
+        item = self._add("Plaza de Espana")
+        other = TravelPlan(title="Cordoba Trip", destination="Cordoba, Spain", start_date=datetime(2025, 9, 4),
+                           end_date=datetime(2025, 9, 5), user_id=self.user.id)
+        db.session.add(other)
+        db.session.commit()
+        
+        item.travel_plan_id = other.id
+        db.session.commit()
+        self.assertEqual(self._ids(changes_since(self.plan, 1)), ([], [], [item.id]))
+        self.assertEqual(self._ids(changes_since(other, 0)), ([item.id], [], []))
+    
+    def test_core_writes_are_logged(self):
+        """Test that bulk imports and batch changes are logged like ORM writes"""
+        result = import_items(self.plan, BytesIO(b"day,activity\n1,Metropol Parasol\n2,Triana market\n"), 'csv')
+        self.assertEqual(result.imported, 2)
+        db.session.refresh(self.plan)
+        self.assertEqual(self.plan.revision, 1)
+        parasol, market = [item.id for item in ItineraryItem.query.filter_by(travel_plan_id=self.plan.id)
+                           .order_by(ItineraryItem.id)]
+        
+        apply_operations(self.plan, [{'op': 'move', 'id': parasol, 'day': 3},
+                                     {'op': 'delete', 'id': market},
+                                     {'op': 'add', 'day': 1, 'activity': 'Tapas crawl'}])
+        self.assertEqual(self.plan.revision, 2)
+        tapas = ItineraryItem.query.filter_by(activity='Tapas crawl').one().id
+        changes = changes_since(self.plan, 1)
+        if tapas == market:
+            # SQLite reused the deleted item's id for the new one
+            self.assertEqual(self._ids(changes), ([tapas], [parasol], []))
+        else:
+            self.assertEqual(self._ids(changes), ([tapas], [parasol], [market]))
+        self.assertEqual(sorted(self._ids(changes_since(self.plan, 0))[0]), sorted([parasol, tapas]))
+    
+    def test_compacted_log_falls_back_to_snapshot(self):
+        """Test that old deletions are compacted away and older revisions need a snapshot"""
+        with mock.patch.object(itinerary_sync, 'MAX_DELETED', 3), mock.patch.object(itinerary_sync, 'KEEP_DELETED', 1):
+            items = [self._add(f"Stop {i}") for i in range(5)]
+            for item in items:
+                db.session.delete(item)
+                db.session.commit()
+        
+        self.assertEqual((self.plan.revision, self.plan.change_floor), (10, 8))
+        count = db.session.execute(text("SELECT count(*) FROM itinerary_change WHERE travel_plan_id = :id"),
+                                   {'id': self.plan.id}).scalar()
+        self.assertEqual(count, 2)
+        self.assertIsNone(changes_since(self.plan, 5))
+        self.assertEqual(self._ids(changes_since(self.plan, 8)), ([], [], [items[3].id, items[4].id]))
+
+
+class TestPlanEvents(BaseTestCase):
+    """Test case for the live itinerary event streams"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        plan = TravelPlan(title="Porto Trip", destination="Porto, Portugal",
+                          start_date=datetime(2025, 10, 1), end_date=datetime(2025, 10, 3),
+                          user_id=self.user.id)
+        db.session.add(plan)
+        db.session.commit()
+        self.plan_id = plan.id
+        plan_events.set_backend(None)
+        self.addCleanup(plan_events.set_backend, None)
+    
+    def _add(self, activity, day=1):
+        db.session.add(ItineraryItem(day=day, activity=activity, travel_plan_id=self.plan_id))
+        db.session.commit()
+    
+    def _parse(self, text):
+        fields = dict(line.split(': ', 1) for line in text.strip().split('\n'))
+        return fields.get('id'), fields['event'], json.loads(fields['data'])
+    
+    def test_revisions_published_on_commit(self):
+        """Test that committed item changes are published and rolled back ones are not"""
+        with mock.patch.object(plan_events, 'publish') as publish:
+            self._add("Livraria Lello")
+            publish.assert_called_once_with(self.plan_id, 1)
+            
+            publish.reset_mock()
+            db.session.add(ItineraryItem(day=1, activity="Port cellars", travel_plan_id=self.plan_id))
+            db.session.flush()
+            db.session.rollback()
+            publish.assert_not_called()
+            self._add("Ribeira")
+            publish.assert_called_once_with(self.plan_id, 2)
+    
+    def test_stream_sends_changes(self):
+        """Test that an open stream sends the changes committed after it started"""
+        events = plan_events.stream(self.plan_id)
+        self.assertEqual(next(events), f'retry: {plan_events.RETRY_MILLISECONDS}\n\n')
+        self.assertEqual(self._parse(next(events)), ('0', 'ready', {'revision': 0}))
+        self.assertEqual(plan_events.hub.subscriber_count(self.plan_id), 1)
+        
+        self._add("Clerigos Tower")
+        event_id, name, data = self._parse(next(events))
+        self.assertEqual((event_id, name, data['since'], data['revision']), ('1', 'changes', 0, 1))
+        self.assertEqual([item['activity'] for item in data['inserted']], ["Clerigos Tower"])
+        
+        events.close()
+        self.assertEqual(plan_events.hub.subscriber_count(self.plan_id), 0)
+    
+    def test_reconnect_with_last_event_id(self):
+        """Test that a reconnecting stream catches up, or is told to reload"""
+        self._add("Bolhao market")
+        self._add("Serralves")
+        
+        events = plan_events.stream(self.plan_id, last_event_id=1)
+        next(events)
+        event_id, name, data = self._parse(next(events))
+        self.assertEqual((event_id, name, len(data['inserted'])), ('2', 'changes', 1))
+        events.close()
+        
+        events = plan_events.stream(self.plan_id, last_event_id=7)  # Ahead of the plan
+        next(events)
+        self.assertEqual(self._parse(next(events)), ('2', 'reset', {'revision': 2}))
+        events.close()
+    
+    def test_heartbeats_and_end(self):
+        """Test that idle streams send heartbeats and end after the maximum time"""
+        with mock.patch.object(plan_events, 'HEARTBEAT_SECONDS', 0.01), \
+                mock.patch.object(plan_events, 'MAX_STREAM_SECONDS', 0.1):
+            events = list(plan_events.stream(self.plan_id))
+        self.assertEqual(self._parse(events[1])[1], 'ready')
+        self.assertIn(': heartbeat\n\n', events[2:])
+    
+    def test_deleted_plan_ends_stream(self):
+        """Test that deleting the plan ends its streams"""
+        events = plan_events.stream(self.plan_id)
+        next(events), next(events)
+        db.session.delete(db.session.get(TravelPlan, self.plan_id))
+        db.session.commit()
+        plan_events.publish(self.plan_id, 1)
+        self.assertEqual(self._parse(next(events))[1], 'deleted')
+        self.assertEqual(list(events), [])
+    
+    def test_file_backend_shares_events(self):
+        """Test that events published by one process reach the subscribers of another"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.log')
+            hubs = [plan_events.Hub(), plan_events.Hub()]
+            backends = [plan_events.FileBackend(hub, path, poll_seconds=0.01) for hub in hubs]
+            try:
+                subscription = hubs[1].subscribe(self.plan_id)
+                other = hubs[1].subscribe(self.plan_id + 1)
+                backends[0].publish(self.plan_id, {'plan_id': self.plan_id, 'revision': 3})
+                self.assertTrue(subscription.wait(2))
+                self.assertFalse(other.wait(0.05))
+            finally:
+                for backend in backends:
+                    backend.close()
+    
+    def test_unknown_backend(self):
+        """Test that a misconfigured backend is reported"""
+        with mock.patch.dict(self.app.config, {'PLAN_EVENTS_BACKEND': 'carrier-pigeon'}):
+            with self.assertRaises(ValueError):
+                plan_events.backend()
+
+
+class TestPlanAccess(BaseTestCase):
+    """Test case for plan access checks"""
+    
+    def setUp(self):
+        super().setUp()
+        self.owner = User.query.filter_by(username="testuser").first()
+        self.other = User.query.filter_by(username="admin").first()
+        self.plan = TravelPlan(title="Kyoto Trip", destination="Kyoto, Japan", start_date=datetime(2025, 11, 1),
+                               end_date=datetime(2025, 11, 4), user_id=self.owner.id)
+        db.session.add(self.plan)
+        db.session.commit()
+    
+    def _share(self, status='accepted', can_edit=False):
+        share = PlanShare(travel_plan_id=self.plan.id, shared_user_id=self.other.id, status=status, can_edit=can_edit)
+        db.session.add(share)
+        db.session.commit()
+        return share
+    
+    def _capabilities(self, user_id):
+        access = load_plan_access(self.plan.id, user_id)
+        return access.can_view, access.can_edit, access.is_owner
+    
+    def test_capabilities(self):
+        """Test what owners, collaborators, public viewers and others may do"""
+        self.assertEqual(self._capabilities(self.owner.id), (True, True, True))
+        self.assertEqual(self._capabilities(self.other.id), (False, False, False))
+        self.assertIsNone(load_plan_access(self.plan.id + 1, self.owner.id))
+        
+        share = self._share(status='pending', can_edit=True)
+        self.assertEqual(self._capabilities(self.other.id), (False, False, False))
+        share.status = 'accepted'
+        db.session.commit()
+        self.assertEqual(self._capabilities(self.other.id), (True, True, False))
+        share.can_edit = False
+        db.session.commit()
+        self.assertEqual(self._capabilities(self.other.id), (True, False, False))
+        
+        db.session.delete(share)
+        self.plan.is_public = True
+        db.session.commit()
+        self.assertEqual(self._capabilities(self.other.id), (True, False, False))
+        self.assertEqual(self._capabilities(None), (True, False, False))
+    
+    def test_memoized_per_request(self):
+        """Test that the access of a plan is loaded once per request"""
+        with mock.patch.object(plan_access_module, 'load_plan_access', wraps=load_plan_access) as load:
+            with self.app.app_context(), self.app.test_request_context():
+                login_user(self.owner)
+                first = plan_access(self.plan.id)
+                self.assertIs(plan_access(self.plan.id), first)
+                self.assertTrue(first.is_owner)
+                self.assertIsNone(plan_access(self.plan.id + 1))
+                self.assertEqual(load.call_count, 2)
+            with self.app.app_context(), self.app.test_request_context():
+                login_user(self.owner)
+                plan_access(self.plan.id)
+                self.assertEqual(load.call_count, 3)
+    
+    def test_decorator(self):
+        """Test that refused users get the configured response and missing plans a 404"""
+        def view(plan_id):
+            return 'ok'
+        
+        def url_for(endpoint, **values):
+            return f"{endpoint}:{values.get('plan_id')}"
+        
+        self._share(can_edit=False)
+        with mock.patch.object(plan_access_module, 'url_for', url_for), self.app.test_request_context():
+            login_user(self.other)
+            self.assertEqual(plan_access_required('view')(view)(plan_id=self.plan.id), 'ok')
+            
+            response, status = plan_access_required('edit')(view)(plan_id=self.plan.id)
+            self.assertEqual((status, response.get_json()['success']), (403, False))
+            
+            # Collaborators who can not edit are sent back to the plan
+            response = plan_access_required('edit', response='page')(view)(plan_id=self.plan.id)
+            self.assertEqual(response.location, f'planner.view_plan:{self.plan.id}')
+            response = plan_access_required('own', response='page')(view)(plan_id=self.plan.id)
+            self.assertEqual(response.location, f'planner.view_plan:{self.plan.id}')
+            
+            # Others are sent to their own plans
+            db.session.delete(PlanShare.query.one())
+            db.session.commit()
+            with self.app.app_context(), self.app.test_request_context():
+                login_user(self.other)
+                response = plan_access_required('view', response='page')(view)(plan_id=self.plan.id)
+                self.assertEqual(response.location, 'planner.index:None')
+            
+            with self.assertRaises(Forbidden):
+                plan_access_required('own', response='abort')(view)(plan_id=self.plan.id)
+            with self.assertRaises(NotFound):
+                plan_access_required('view')(view)(plan_id=self.plan.id + 1)
+        with self.assertRaises(ValueError):
+            plan_access_required('admin')
+
+
 if __name__ == '__main__':
     unittest.main()
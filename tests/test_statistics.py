@@ -5,9 +5,17 @@ Tests the routes, data calculations, and API endpoints for statistics
 import unittest
 import json
 from datetime import datetime, timedelta
+from unittest import mock
 from .base import BaseTestCase
 from app.models.user import User
-from app.models.travel_plan import TravelPlan
+from app.models.travel_plan import TravelPlan, ItineraryItem
+from app.models.destination import Destination
+from app.destinations import parse_destination
+from app.routes.statistics import calculate_travel_statistics
+from app import country_graph
+from app.distributions import TDigest, get_digests, percentile_summary
+from app import distributions
+from app.models.stat_digest import StatDigest
 from app import db
 
 
@@ -246,5 +254,233 @@ class TestStatisticsCalculations(BaseTestCase):
         # Future enhancement: Make calculation functions testable directly
 
 
+class TestDestinationNormalization(BaseTestCase):
+    """Test case for normalized destinations used by the statistics"""
+    
+    def setUp(self):
+        """Set up plans that refer to the same places in different ways"""
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        
+        for title, destination in [("Trip 1", "Paris, France"),
+                                   ("Trip 2", "Paris"),
+                                   ("Trip 3", "kyoto,  japan"),
+                                   ("Trip 4", "Moab, Utah, USA")]:
+            db.session.add(TravelPlan(
+                title=title,
+                destination=destination,
+                start_date=datetime.now() + timedelta(days=10),
+                end_date=datetime.now() + timedelta(days=12),
+                user_id=self.user.id
+            ))
+        db.session.commit()
+    
+    def test_destination_resolved_on_write(self):
+        """Test that plans are linked to a normalized destination"""
+        plan = TravelPlan.query.filter_by(title="Trip 3").first()
+        self.assertEqual(plan.resolved_destination.name, "Kyoto, Japan")
+        self.assertEqual(plan.resolved_destination.country_code, "JP")
+        
+        plan = TravelPlan.query.filter_by(title="Trip 4").first()
+        self.assertEqual(plan.resolved_destination.city, "Moab")
+        self.assertEqual(plan.resolved_destination.country_code, "US")
+    
+    def test_same_place_shares_destination(self):
+        """Test that "Paris" and "Paris, France" resolve to one destination"""
+        first = TravelPlan.query.filter_by(title="Trip 1").first()
+        second = TravelPlan.query.filter_by(title="Trip 2").first()
+        self.assertEqual(first.destination_id, second.destination_id)
+        self.assertEqual(Destination.query.count(), 3)
+    
+    def test_destination_updated_on_edit(self):
+        """Test that editing the destination text re-resolves it"""
+        plan = TravelPlan.query.filter_by(title="Trip 2").first()
+        plan.destination = "Tokyo"
+        db.session.commit()
+        self.assertEqual(plan.resolved_destination.name, "Tokyo, Japan")
+    
+    def test_region_is_not_a_country(self):
+        """Test that a city qualified by a state or province is not matched to a country"""
+        for text, key, name in [("Paris, Texas", "paris, texas|", "Paris, Texas"),
+                                ("london, ontario", "london, ontario|", "London, Ontario"),
+                                ("Sydney, Nova Scotia", "sydney, nova scotia|", "Sydney, Nova Scotia")]:
+            parsed = parse_destination(text)
+            self.assertEqual((parsed.key, parsed.name, parsed.country_code), (key, name, None))
+            self.assertIsNone(parsed.lat)
+        self.assertEqual(parse_destination("Moab, Utah, USA").key, "moab|US")
+        
+        plan = TravelPlan(title="Trip 5", destination="Paris, Texas", start_date=datetime.now(),
+                          end_date=datetime.now() + timedelta(days=1), user_id=self.user.id)
+        db.session.add(plan)
+        db.session.commit()
+        paris = TravelPlan.query.filter_by(title="Trip 1").first()
+        self.assertNotEqual(plan.destination_id, paris.destination_id)
+        self.assertIsNone(plan.resolved_destination.country_code)
+        self.assertEqual(plan.resolved_destination.name, "Paris, Texas")
+    
+    def test_visited_countries(self):
+        """Test that visited cities and countries come from destinations"""
+        stats = calculate_travel_statistics(self.user)
+        self.assertEqual(stats['visited_countries'], ['France', 'Japan', 'United States'])
+        self.assertEqual(stats['visited_cities'].count('Paris'), 2)
+
+
+class TestNearbyCountries(BaseTestCase):
+    """Test case for the country adjacency graph recommender"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+        country_graph.clear_cache()
+    
+    def test_graph_is_symmetric(self):
+        """Test that every border is listed in both directions"""
+        graph = country_graph.load_country_graph()
+        for code, neighbours in graph.items():
+            for neighbour in neighbours:
+                self.assertIn(code, graph[neighbour])
+    
+    def test_multi_source_bfs(self):
+        """Test hop distances from several visited countries at once"""
+        distances = country_graph.countries_within({'FR', 'JP'}, max_hops=2)
+        self.assertEqual(distances['ES'], 1)
+        self.assertEqual(distances['KR'], 1)
+        self.assertEqual(distances['PT'], 2)
+        self.assertNotIn('FR', distances)
+        self.assertNotIn('US', distances)
+    
+    def test_ranking_prefers_popular_countries(self):
+        """Test that countries at the same distance are ranked by visits"""
+        ranked = country_graph.rank_nearby_countries({'PT'}, max_hops=2,
+                                                     visit_counts={'FR': 1, 'MA': 5})
+        self.assertEqual(ranked[0]['code'], 'ES')
+        self.assertEqual([c['code'] for c in ranked[1:3]], ['MA', 'FR'])
+    
+    def test_cached_until_visited_countries_change(self):
+        """Test that results are cached per user and refreshed on change"""
+        first = country_graph.nearby_countries_for_user(self.user.id, ['Spain'])
+        self.assertIs(country_graph.nearby_countries_for_user(self.user.id, ['España']), first)
+        
+        second = country_graph.nearby_countries_for_user(self.user.id, ['Spain', 'Japan'])
+        self.assertIsNot(second, first)
+        self.assertIn('South Korea', [c['name'] for c in second])
+
+
+class TestPercentileDigests(BaseTestCase):
+    """Test case for t-digest percentile statistics"""
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.query.filter_by(username="testuser").first()
+    
+    def _create_plan(self, destination, days, costs_by_day):
+        start = datetime(2025, 6, 1)
+        plan = TravelPlan(title=f"Trip to {destination}", destination=destination,
+                          start_date=start, end_date=start + timedelta(days=days - 1),
+                          user_id=self.user.id)
+        db.session.add(plan)
+        db.session.flush()
+        for day, costs in costs_by_day.items():
+            for cost in costs:
+                db.session.add(ItineraryItem(day=day, activity="Activity", cost=cost,
+                                             travel_plan_id=plan.id))
+        db.session.commit()
+        return plan
+    
+    def test_tdigest_quantiles(self):
+        """Test digest accuracy and that merged digests match a single one"""
+        left, right, whole = TDigest(), TDigest(), TDigest()
+        for value in range(1, 1001):
+            (left if value % 2 else right).add(value)
+            whole.add(value)
+        merged = TDigest.from_dict(left.to_dict()).merge(right)
+        
+        self.assertEqual(merged.count, 1000)
+        for digest in (whole, merged):
+            self.assertAlmostEqual(digest.quantile(0.5), 500, delta=10)
+            self.assertAlmostEqual(digest.quantile(0.99), 990, delta=5)
+        self.assertLess(len(whole.to_dict()['centroids']), 200)
+    
+    def test_user_percentiles(self):
+        """Test daily spend, duration and activity cost percentiles for a user"""
+        self._create_plan("Paris, France", 3, {1: [10, 20], 2: [50]})
+        self._create_plan("Rome, Italy", 5, {1: [40]})
+        
+        summary = percentile_summary('user', self.user.id)
+        self.assertEqual(summary['activity_cost']['count'], 4)
+        self.assertEqual(summary['daily_spend']['count'], 3)
+        self.assertEqual(summary['trip_duration']['count'], 2)
+        self.assertEqual(summary['daily_spend']['p50'], 40)
+        self.assertEqual(summary['trip_duration']['p99'], 5)
+    
+    def test_digests_follow_item_changes(self):
+        """Test that edits and deletions are reflected without a full rebuild"""
+        plan = self._create_plan("Paris, France", 3, {1: [10], 2: [20]})
+        percentile_summary('user', self.user.id)
+        
+        item = plan.itinerary_items.filter_by(day=2).first()
+        item.cost = 500
+        db.session.commit()
+        self.assertTrue(StatDigest.query.filter_by(scope='user', scope_id=self.user.id).first().stale)
+        self.assertEqual(percentile_summary('user', self.user.id)['activity_cost']['p99'], 500)
+        
+        db.session.delete(item)
+        db.session.commit()
+        summary = percentile_summary('user', self.user.id)
+        self.assertEqual(summary['activity_cost']['count'], 1)
+        self.assertEqual(summary['activity_cost']['p50'], 10)
+    
+    def test_reads_do_not_commit(self):
+        """Test that re-merging stale digests leaves the transaction to the caller"""
+        self._create_plan("Paris, France", 3, {1: [10]})
+        self.user.home_address = "Not saved"
+        get_digests('user', self.user.id)
+        db.session.rollback()
+        db.session.expire_all()
+        self.assertIsNone(self.user.home_address)
+    
+    def test_second_read_does_not_recompute(self):
+        """Test that re-merged digests are kept even though reads never commit"""
+        self._create_plan("Paris, France", 3, {1: [10]})
+        db.session.execute(StatDigest.__table__.delete().where(StatDigest.scope == 'plan'))
+        db.session.commit()
+        first = get_digests('user', self.user.id)
+        db.session.rollback()
+        with mock.patch.object(distributions, '_remerge') as remerge:
+            second = get_digests('user', self.user.id)
+        remerge.assert_not_called()
+        self.assertEqual(second['daily_spend'].quantile(0.5), first['daily_spend'].quantile(0.5))
+        self.assertEqual(StatDigest.query.filter_by(scope='plan').count(), len(distributions.METRICS))
+    
+    def test_store_replaces_digest(self):
+        """Test that storing a digest twice replaces it instead of failing"""
+        connection = db.session.connection()
+        for value in (5, 7):
+            digest = TDigest()
+            digest.add(value)
+            distributions._store(connection, 'user', self.user.id, 'daily_spend', digest)
+        rows = StatDigest.query.filter_by(scope='user', scope_id=self.user.id, metric='daily_spend').all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(TDigest.from_dict(json.loads(rows[0].data)).quantile(0.5), 7)
+    
+    def test_destination_percentiles(self):
+        """Test that destination digests combine every user's trips"""
+        admin = User.query.filter_by(username="admin").first()
+        plan = self._create_plan("Paris, France", 2, {1: [30]})
+        db.session.add(TravelPlan(title="Admin trip", destination="paris",
+                                  start_date=datetime(2025, 7, 1), end_date=datetime(2025, 7, 7),
+                                  user_id=admin.id))
+        db.session.commit()
+        
+        summary = percentile_summary('destination', plan.destination_id)
+        self.assertEqual(summary['trip_duration']['count'], 2)
+        
+        db.session.delete(plan)
+        db.session.commit()
+        summary = percentile_summary('destination', plan.destination_id)
+        self.assertEqual(summary['trip_duration']['count'], 1)
+        self.assertEqual(StatDigest.query.filter_by(scope='plan', scope_id=plan.id).count(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()